@@ -77,6 +77,28 @@ def get_sys_latency(nphases, cas_latency):
 def get_sys_phase(nphases, sys_latency, cas_latency):
     return sys_latency*nphases - cas_latency
 
+# Minimum latency (MC clk) between a READ (half-burst READ with chop) and a following WRITE command.
+def get_rtw_latency(phy_settings, chop=False):
+    rtw_latency = getattr(phy_settings, "rtw_latency", None)
+    if rtw_latency is not None:
+        return rtw_latency
+    cl = getattr(phy_settings, "cl", None)
+    # Without CWL based writes, wait for the read data to be returned.
+    if cl is None or phy_settings.memtype not in ["DDR2", "DDR3", "DDR4"]:
+        return phy_settings.read_latency
+    # Read to Write turnaround on the DRAM bus (DRAM clk): RL + BL/2 - WL + 2, the 2 extra clocks
+    # covering DQS postamble/preamble and ODT switching (RL + BL/4 - WL + 2 after a BC4 READ).
+    nphases = phy_settings.nphases
+    rdphase = phy_settings.rdphase
+    wrphase = phy_settings.wrphase
+    trtw    = cl + burst_lengths[phy_settings.memtype]//(4 if chop else 2) + 2 - phy_settings.cwl
+    # Use worst case phase offset when phases are configurable at runtime.
+    if isinstance(rdphase, Signal) or isinstance(wrphase, Signal):
+        offset = nphases - 1
+    else:
+        offset = rdphase - wrphase
+    return max(math.ceil((trtw + offset)/nphases), 1)
+
 # PHY Pads Transformers ----------------------------------------------------------------------------
 
 class PHYPadsReducer:
@@ -222,6 +244,7 @@ class PhySettings(Settings):
             cwl: Optional[int] = None,  # latency (DRAM clk) from WRITE command to first data
             cmd_latency: Optional[int] = None,  # additional command latency (MC clk)
             cmd_delay: Optional[int] = None,  # used to force cmd delay during initialization in BIOS
+            rtw_latency: Optional[int] = None,  # force READ to WRITE command latency (MC clk)
             bitslips: int = 0,  # number of write/read bitslip taps
             delays: int = 0,  # number of write/read delay taps
             # PHY training capabilities
@@ -254,6 +277,13 @@ class PhySettings(Settings):
         if tdqs is not None:
             self.tdqs = tdqs
 
+    # Optional DDR3/DDR4 burst chop:
+    # MR0 is set to on-the-fly BL8/BC4 and half-bursts (BC4) are selected per command (A12). The
+    # DFIInjector sets A12 on software READ/WRITE commands so that these remain BL8.
+    def add_burst_chop(self):
+        assert self.memtype in ["DDR3", "DDR4"]
+        self.burst_chop = True
+
     # Optional RDIMM configuration
     def set_rdimm(self, tck, rcd_pll_bypass, rcd_ca_cs_drive, rcd_odt_cke_drive, rcd_clk_drive):
         assert self.memtype == "DDR4"
@@ -261,19 +291,20 @@ class PhySettings(Settings):
         self.set_attributes(locals())
 
 class GeomSettings(Settings):
-    def __init__(self, bankbits, rowbits, colbits):
+    def __init__(self, bankbits, rowbits, colbits, bankgroupbits=0):
         self.set_attributes(locals())
         self.addressbits = max(rowbits, colbits)
 
 
 class TimingSettings(Settings):
-    def __init__(self, tRP, tRCD, tWR, tWTR, tREFI, tRFC, tFAW, tCCD, tRRD, tRC, tRAS, tZQCS):
+    def __init__(self, tRP, tRCD, tWR, tWTR, tREFI, tRFC, tFAW, tCCD, tRRD, tRC, tRAS, tZQCS,
+        tWTR_S=None, tCCD_S=None, tRRD_S=None, tRFCpb=None):
         self.set_attributes(locals())
 
 # Layouts/Interface --------------------------------------------------------------------------------
 
-def cmd_layout(address_width):
-    return [
+def cmd_layout(address_width, tag_width=0, burst_width=0, with_chop=False):
+    layout = [
         ("valid",            1, DIR_M_TO_S),
         ("ready",            1, DIR_S_TO_M),
         ("we",               1, DIR_M_TO_S),
@@ -283,6 +314,19 @@ def cmd_layout(address_width):
         ("wdata_ready",      1, DIR_S_TO_M),
         ("rdata_valid",      1, DIR_S_TO_M)
     ]
+    if tag_width:
+        layout += [
+            ("tag",      tag_width, DIR_M_TO_S), # Master issuing the request.
+            ("data_tag", tag_width, DIR_S_TO_M), # Master of the request acked by wdata_ready/rdata_valid.
+        ]
+    if burst_width:
+        layout += [("burst", burst_width, DIR_M_TO_S)] # Number of words moved by the request - 1.
+    if with_chop:
+        layout += [
+            ("chop",       1, DIR_M_TO_S), # Half-burst (BC4) request, data on the first half of the word.
+            ("chop_upper", 1, DIR_M_TO_S), # Half-burst on the upper half of the word.
+        ]
+    return layout
 
 def data_layout(data_width):
     return [
@@ -307,6 +351,23 @@ def cmd_request_rw_layout(a, ba):
         ("is_write", 1)
     ]
 
+def get_cmd_tag_width(settings):
+    # Requests are only tagged with their master when BankMachines are allowed to reorder them.
+    if getattr(settings, "cmd_buffer_reordering", False):
+        return settings.cmd_buffer_tag_width
+    return 0
+
+def get_cmd_burst_width(settings):
+    # Requests only carry a burst length when native bursts are enabled.
+    burst_length = getattr(settings, "cmd_burst_length", 1)
+    if burst_length > 1:
+        return log2_int(burst_length)
+    return 0
+
+def get_cmd_chop(settings):
+    # Requests can only be half-bursts when the PHY is configured for on-the-fly burst chop.
+    return getattr(getattr(settings, "phy", None), "burst_chop", False)
+
 
 class LiteDRAMInterface(Record):
     def __init__(self, address_align, settings):
@@ -314,40 +375,69 @@ class LiteDRAMInterface(Record):
         self.address_align = address_align
         self.address_width = settings.geom.rowbits + settings.geom.colbits + rankbits - address_align
         self.data_width    = settings.phy.dfi_databits*settings.phy.nphases
+        self.tag_width     = get_cmd_tag_width(settings)
+        self.burst_width   = get_cmd_burst_width(settings)
+        self.with_chop     = get_cmd_chop(settings)
         self.nbanks   = settings.phy.nranks*(2**settings.geom.bankbits)
         self.nranks   = settings.phy.nranks
         self.settings = settings
 
-        layout = [("bank"+str(i), cmd_layout(self.address_width)) for i in range(self.nbanks)]
+        layout = [("bank"+str(i), cmd_layout(self.address_width, self.tag_width, self.burst_width, self.with_chop))
+            for i in range(self.nbanks)]
         layout += data_layout(self.data_width)
         Record.__init__(self, layout)
 
 # Ports --------------------------------------------------------------------------------------------
 
-def cmd_description(address_width):
-    return [
+atomic_ops = {
+    "add":  1, # Fetch-and-add.
+    "swap": 2, # Swap.
+    "cas":  3, # Compare-and-swap.
+    "min":  4, # Signed minimum.
+    "max":  5, # Signed maximum.
+    "minu": 6, # Unsigned minimum.
+    "maxu": 7, # Unsigned maximum.
+}
+
+def cmd_description(address_width, burst_width=0, with_chop=False, with_atomics=False):
+    layout = [
         ("we",               1), # Write (1) or Read (0).
         ("addr", address_width)  # Address (in Controller's words).
     ]
+    if burst_width:
+        layout += [("burst", burst_width)] # Number of consecutive words - 1.
+    if with_chop:
+        layout += [
+            ("chop",       1), # Half-burst (BC4), data on the first half of the word.
+            ("chop_upper", 1), # Half-burst on the upper half of the word.
+        ]
+    if with_atomics:
+        layout += [("atomic", 3)] # Atomic operation (0: None, see atomic_ops).
+    return layout
 
-def wdata_description(data_width):
-    return [
+def wdata_description(data_width, with_atomics=False):
+    layout = [
         ("data",    data_width), # Write Data.
         ("we",   data_width//8), # Write Data byte enable.
     ]
+    if with_atomics:
+        layout += [("compare", data_width)] # Compare Data (compare-and-swap).
+    return layout
 
 def rdata_description(data_width):
     return [("data", data_width)] # Read Data.
 
 class LiteDRAMNativePort(Settings):
-    def __init__(self, mode, address_width, data_width, clock_domain="sys", id=0):
+    def __init__(self, mode, address_width, data_width, clock_domain="sys", id=0, burst_width=0,
+        with_chop=False, with_atomics=False):
         self.set_attributes(locals())
 
         self.flush = Signal()
         self.lock  = Signal()
+        self.hold  = Signal() # Keep the bank granted to the port (atomic read-modify-writes).
 
-        self.cmd   = stream.Endpoint(cmd_description(address_width))
-        self.wdata = stream.Endpoint(wdata_description(data_width))
+        self.cmd   = stream.Endpoint(cmd_description(address_width, burst_width, with_chop, with_atomics))
+        self.wdata = stream.Endpoint(wdata_description(data_width, with_atomics))
         self.rdata = stream.Endpoint(rdata_description(data_width))
 
         # retro-compatibility # FIXME: remove
@@ -355,9 +445,17 @@ class LiteDRAMNativePort(Settings):
         self.dw = self.data_width
         self.cd = self.clock_domain
 
-    def get_bank_address(self, bank_bits, cba_shift):
+    def get_bank_address(self, bank_bits, cba_shift, xor=False):
         cba_upper = cba_shift + bank_bits
-        return self.cmd.addr[cba_shift:cba_upper]
+        ba = self.cmd.addr[cba_shift:cba_upper]
+        if xor:
+            # Permutation-based interleaving: XOR bank bits with the bits just above them.
+            ba = ba ^ self.cmd.addr[cba_upper:cba_upper + bank_bits]
+        return ba
+
+    def get_burst_max(self, addr):
+        # Bursts can't cross a 2**burst_width words boundary.
+        return (2**self.burst_width - 1) - addr[:self.burst_width]
 
     def get_row_column_address(self, bank_bits, rca_bits, cba_shift):
         cba_upper = cba_shift + bank_bits
@@ -375,6 +473,7 @@ class LiteDRAMNativePort(Settings):
             self.wdata.connect(port.wdata),
             port.rdata.connect(self.rdata),
             port.flush.eq(self.flush),
+            port.hold.eq(self.hold),
             self.lock.eq(port.lock),
         ]
 
@@ -22,7 +22,8 @@ class LiteDRAMCore(Module, AutoCSR):
             nranks        = phy.settings.nranks,
             databits      = phy.settings.dfi_databits,
             nphases       = phy.settings.nphases,
-            is_clam_shell = phy.settings.is_clam_shell)
+            is_clam_shell = phy.settings.is_clam_shell,
+            burst_chop    = getattr(phy.settings, "burst_chop", False))
         self.comb += self.dfii.master.connect(phy.dfi)
 
         self.submodules.controller = controller = LiteDRAMController(
@@ -8,6 +8,8 @@
 """LiteDRAM BankMachine (Rows/Columns management)."""
 
 import math
+from functools import reduce
+from operator import or_
 
 from migen import *
 
@@ -15,6 +17,7 @@ from litex.soc.interconnect import stream
 
 from litedram.common import *
 from litedram.core.multiplexer import *
+from litedram.core.perfmon import bank_events_layout
 
 # AddressSlicer ------------------------------------------------------------------------------------
 
@@ -48,6 +51,90 @@ class _AddressSlicer:
                 address[:split]
             )
 
+# ReorderQueue -------------------------------------------------------------------------------------
+
+class _ReorderQueue(Module):
+    """Command queue serving row hits first (FR-FCFS)
+
+    Replacement for the `cmd_buffer_lookahead` FIFO. Entries are kept in arrival order (entry 0 is
+    the oldest one) and `source` presents the oldest entry targeting the currently opened row, or
+    the oldest entry when there is no such entry.
+
+    An entry is only allowed to bypass older entries of other masters (different `tag`), so the
+    order of the requests of a given master is preserved (LiteDRAMNativePort returns data in
+    order). To avoid starvation, the oldest entry is forced once it has been bypassed `max_age`
+    times.
+
+    Parameters
+    ----------
+    layout : list
+        Layout of the entries (must contain `addr` and `tag`)
+    depth : int
+        Number of entries
+    slicer : _AddressSlicer
+        Address slicer used to extract the row of the entries
+    row : Signal, in
+        Currently opened row
+    row_opened : Signal, in
+        Indicates that `row` is valid
+    max_age : int
+        Maximum number of times the oldest entry can be bypassed
+    """
+    def __init__(self, layout, depth, slicer, row, row_opened, max_age):
+        self.sink   = sink   = stream.Endpoint(layout)
+        self.source = source = stream.Endpoint(layout)
+
+        # # #
+
+        entry_layout = layout + [("valid", 1), ("age", bits_for(max_age))]
+        entries = [Record(entry_layout) for _ in range(depth)]
+        fields  = [name for name, _ in layout]
+
+        level = Signal(max=depth + 1)
+        sel   = Signal(max=max(depth, 2))
+        push  = Signal()
+        pop   = Signal()
+
+        # Selection --------------------------------------------------------------------------------
+        candidates = []
+        for i, entry in enumerate(entries):
+            blocked = reduce(or_, [e.valid & (e.tag == entry.tag) for e in entries[:i]], 0)
+            row_hit = row_opened & (slicer.row(entry.addr) == row)
+            candidates.append(entry.valid & row_hit & ~blocked)
+        self.comb += sel.eq(0)
+        for i in reversed(range(depth)):
+            self.comb += If(candidates[i], sel.eq(i))
+        self.comb += If(entries[0].age == max_age, sel.eq(0))
+
+        self.comb += [
+            source.valid.eq(entries[0].valid),
+            [getattr(source, name).eq(Array(getattr(e, name) for e in entries)[sel]) for name in fields],
+            sink.ready.eq(level != depth),
+            push.eq(sink.valid & sink.ready),
+            pop.eq(source.valid & source.ready),
+        ]
+
+        # Update -----------------------------------------------------------------------------------
+        self.sync += level.eq(level + push - pop)
+        for i, entry in enumerate(entries):
+            # Entries younger than the popped one shift down, older ones get bypassed.
+            if i + 1 < depth:
+                shift = [entry.eq(entries[i + 1])]
+            else:
+                shift = [entry.valid.eq(0)]
+            self.sync += If(pop,
+                If(sel <= i,
+                    *shift
+                ).Elif(entry.age != max_age,
+                    entry.age.eq(entry.age + 1)
+                )
+            )
+            self.sync += If(push & ((level - pop) == i),
+                entry.valid.eq(1),
+                entry.age.eq(0),
+                [getattr(entry, name).eq(getattr(sink, name)) for name in fields]
+            )
+
 # BankMachine --------------------------------------------------------------------------------------
 
 class BankMachine(Module):
@@ -74,6 +161,39 @@ class BankMachine(Module):
      - there is a valid command in `cmd_buffer` - `cmd_buffer` becomes ready
        when the BankMachine sends wdata_ready/rdata_valid back to the crossbar
 
+    With `cmd_buffer_reordering`, requests are tagged with their master and
+    `cmd_buffer_lookahead` is a `_ReorderQueue` that serves row hits before
+    older row misses of other masters. The tag of the request being served is
+    returned on `data_tag` with wdata_ready/rdata_valid.
+
+    With a page policy (`page_timeout` and/or `with_page_learning`), an opened
+    row is precharged once the BankMachine has been idle for `page_timeout`
+    cycles. With learning, a saturating counter tracks whether the bank's
+    accesses would hit the previously opened row. When they mostly miss, the
+    bank switches to closed-page behaviour: the row is auto-precharged when no
+    other request is queued.
+
+    With `cmd_age_threshold`, the BankMachine reports on `age` how long the
+    request it is serving has been waiting, so that the Multiplexer can serve
+    the oldest requests first.
+
+    With native bursts (`cmd_burst_length`), a request moves `burst` + 1
+    consecutive words of a row: the BankMachine issues one column access per
+    word and only releases the request (and auto-precharges) after the last
+    one. Each access is acknowledged with wdata_ready/rdata_valid.
+
+    With burst chop (DDR3/DDR4 PHY settings with `burst_chop`), the mode
+    registers select the burst length on-the-fly: column accesses are issued
+    with A12 set (BL8), or cleared for `chop` requests (BC4, A2 selecting the
+    half of the word).
+
+    With `with_perfmon`, the BankMachine reports its events (row hits/misses/
+    conflicts, activates, precharges and command buffer occupancy) on `perf`.
+
+    With per-bank refresh (`refresh_per_bank`), the Refresher does not precharge the banks: the
+    BankMachine precharges its opened row itself before granting the refresh. With per-rank refresh
+    (`refresh_per_rank`), the row is also precharged by the BankMachine (respecting tRAS/tWR).
+
     Parameters
     ----------
     n : int
@@ -92,14 +212,30 @@ class BankMachine(Module):
     req : Record(cmd_layout)
         Stream of requests from LiteDRAMCrossbar
     refresh_req : Signal(), in
-        Indicates that refresh needs to be done, connects to Refresher.cmd.valid
+        Indicates that refresh needs to be done, connects to Refresher.cmd.valid (or to the bank's
+        Refresher.bank_lock bit with per-bank/per-rank refresh)
     refresh_gnt : Signal(), out
         Indicates that refresh permission has been granted, satisfying timings
     cmd : Endpoint(cmd_request_rw_layout)
         Stream of commands to the Multiplexer
+    page_timeout : Signal(16), in
+        Idle cycles before closing the opened row, 0 keeps rows opened (with page policy)
+    page_learning : Signal(), in
+        Enable learning of the page policy from the hit rate (with page policy)
+    page_closed : Signal(), out
+        Indicates that the learned policy is closed-page (with page policy)
+    nwrites : Signal, out
+        Number of queued write requests (with write batching)
+    age : Signal, out
+        Cycles the request being served has been waiting, saturating (with cmd_age_threshold)
+    perf : Record(bank_events_layout), out
+        Events for the performance monitor (with perfmon)
     """
     def __init__(self, n, address_width, address_align, nranks, settings):
-        self.req = req = Record(cmd_layout(address_width))
+        tag_width   = get_cmd_tag_width(settings)
+        burst_width = get_cmd_burst_width(settings)
+        with_chop   = get_cmd_chop(settings)
+        self.req = req = Record(cmd_layout(address_width, tag_width, burst_width, with_chop))
         self.refresh_req = refresh_req = Signal()
         self.refresh_gnt = refresh_gnt = Signal()
 
@@ -107,32 +243,115 @@ class BankMachine(Module):
         ba = settings.geom.bankbits + log2_int(nranks)
         self.cmd = cmd = stream.Endpoint(cmd_request_rw_layout(a, ba))
 
+        with_page_policy = (getattr(settings, "page_timeout", None) is not None or
+                            getattr(settings, "with_page_learning", False))
+        if with_page_policy:
+            self.page_timeout  = Signal(16)
+            self.page_learning = Signal()
+            self.page_closed   = Signal()
+
+        with_write_batching = getattr(settings, "write_high_watermark", None) is not None
+        if with_write_batching:
+            self.nwrites = Signal(max=settings.cmd_buffer_depth + 3)
+
+        age_threshold = getattr(settings, "cmd_age_threshold", None)
+        if age_threshold is not None:
+            self.age = Signal(max=max(2*age_threshold, 256))
+
+        with_perfmon = getattr(settings, "with_perfmon", False)
+        if with_perfmon:
+            self.perf = Record(bank_events_layout(settings.cmd_buffer_depth + 1))
+
         # # #
 
         auto_precharge = Signal()
 
+        slicer = _AddressSlicer(settings.geom.colbits, address_align)
+
+        row        = Signal(settings.geom.rowbits)
+        row_opened = Signal()
+
         # Command buffer ---------------------------------------------------------------------------
-        cmd_buffer_layout    = [("we", 1), ("addr", len(req.addr))]
-        cmd_buffer_lookahead = stream.SyncFIFO(
-            cmd_buffer_layout, settings.cmd_buffer_depth,
-            buffered=settings.cmd_buffer_buffered)
+        burst_last = Signal() # Column access to the last word of the request.
+        cmd_buffer_layout = [("we", 1), ("addr", len(req.addr))]
+        if tag_width:
+            cmd_buffer_layout += [("tag", tag_width)]
+        if burst_width:
+            cmd_buffer_layout += [("burst", burst_width)]
+        if with_chop:
+            cmd_buffer_layout += [("chop", 1), ("chop_upper", 1)]
+        if tag_width and settings.cmd_buffer_depth > 1:
+            cmd_buffer_lookahead = _ReorderQueue(
+                cmd_buffer_layout, settings.cmd_buffer_depth,
+                slicer     = slicer,
+                row        = row,
+                row_opened = row_opened,
+                max_age    = settings.cmd_buffer_max_age)
+        else:
+            cmd_buffer_lookahead = stream.SyncFIFO(
+                cmd_buffer_layout, settings.cmd_buffer_depth,
+                buffered=settings.cmd_buffer_buffered)
         cmd_buffer = stream.Buffer(cmd_buffer_layout) # 1 depth buffer to detect row change
         self.submodules += cmd_buffer_lookahead, cmd_buffer
         self.comb += [
-            req.connect(cmd_buffer_lookahead.sink, keep={"valid", "ready", "we", "addr"}),
+            req.connect(cmd_buffer_lookahead.sink, keep={"valid", "ready", "we", "addr", "tag", "burst",
+                "chop", "chop_upper"}),
             cmd_buffer_lookahead.source.connect(cmd_buffer.sink),
-            cmd_buffer.source.ready.eq(req.wdata_ready | req.rdata_valid),
+            cmd_buffer.source.ready.eq((req.wdata_ready | req.rdata_valid) & burst_last),
             req.lock.eq(cmd_buffer_lookahead.source.valid | cmd_buffer.source.valid),
         ]
+        if tag_width:
+            self.comb += req.data_tag.eq(cmd_buffer.source.tag)
+        if with_write_batching:
+            write_queued = req.valid & req.ready & req.we
+            write_done   = req.wdata_ready & burst_last
+            self.sync += \
+                If(write_queued & ~write_done,
+                    self.nwrites.eq(self.nwrites + 1)
+                ).Elif(~write_queued & write_done,
+                    self.nwrites.eq(self.nwrites - 1)
+                )
 
-        slicer = _AddressSlicer(settings.geom.colbits, address_align)
+        # Bursts: one column access per word, the column being incremented on each access.
+        addr = cmd_buffer.source.addr
+        if burst_width:
+            burst_count = Signal(burst_width)
+            addr        = Signal.like(cmd_buffer.source.addr)
+            self.comb += [
+                addr.eq(cmd_buffer.source.addr + burst_count),
+                burst_last.eq(burst_count == cmd_buffer.source.burst),
+            ]
+            self.sync += \
+                If(req.wdata_ready | req.rdata_valid,
+                    If(burst_last,
+                        burst_count.eq(0)
+                    ).Else(
+                        burst_count.eq(burst_count + 1)
+                    )
+                )
+        else:
+            self.comb += burst_last.eq(1)
+
+        if age_threshold is not None:
+            # Age of the request at the head of the command buffer: cleared when it is served (or
+            # when there is none), saturating at its maximum value (at least 2*cmd_age_threshold).
+            self.sync += \
+                If(~cmd_buffer.source.valid | cmd_buffer.source.ready,
+                    self.age.eq(0)
+                ).Elif(self.age != (2**len(self.age) - 1),
+                    self.age.eq(self.age + 1)
+                )
 
         # Row tracking -----------------------------------------------------------------------------
-        row        = Signal(settings.geom.rowbits)
-        row_opened = Signal()
         row_hit    = Signal()
         row_open   = Signal()
         row_close  = Signal()
+
+        page_expired = Signal() # Opened row idle for too long (page policy).
+        row_unneeded = Signal() # No request for the row being activated (page policy).
+        refresh_close = Signal() # Close the opened row for a per-bank/per-rank refresh.
+        if getattr(settings, "refresh_per_bank", False) or getattr(settings, "refresh_per_rank", False):
+            self.comb += refresh_close.eq(refresh_req)
         self.comb += row_hit.eq(row == slicer.row(cmd_buffer.source.addr))
         self.sync += \
             If(row_close,
@@ -144,12 +363,16 @@ class BankMachine(Module):
 
         # Address generation -----------------------------------------------------------------------
         row_col_n_addr_sel = Signal()
+        col_a = (auto_precharge << 10) | slicer.col(addr)
+        if with_chop:
+            # On-the-fly burst length: A12 set for BL8, cleared for BC4 (A2 selecting the half).
+            col_a = col_a | Mux(cmd_buffer.source.chop, cmd_buffer.source.chop_upper << 2, 1 << 12)
         self.comb += [
             cmd.ba.eq(n),
             If(row_col_n_addr_sel,
                 cmd.a.eq(slicer.row(cmd_buffer.source.addr))
             ).Else(
-                cmd.a.eq((auto_precharge << 10) | slicer.col(cmd_buffer.source.addr))
+                cmd.a.eq(col_a)
             )
         ]
 
@@ -174,7 +397,7 @@ class BankMachine(Module):
                 If(cmd_buffer_lookahead.source.valid & cmd_buffer.source.valid,
                     If(slicer.row(cmd_buffer_lookahead.source.addr) !=
                        slicer.row(cmd_buffer.source.addr),
-                        auto_precharge.eq(row_close == 0)
+                        auto_precharge.eq((row_close == 0) & burst_last)
                     )
                 )
 
@@ -183,7 +406,11 @@ class BankMachine(Module):
         self.submodules.fsm = fsm = FSM()
         fsm.act("REGULAR",
             If(refresh_req,
-                NextState("REFRESH")
+                If(refresh_close & row_opened,
+                    NextState("PRECHARGE")
+                ).Else(
+                    NextState("REFRESH")
+                )
             ).Elif(cmd_buffer.source.valid,
                 If(row_opened,
                     If(row_hit,
@@ -206,6 +433,8 @@ class BankMachine(Module):
                 ).Else(  # ~row_opened
                     NextState("ACTIVATE")
                 )
+            ).Elif(page_expired,
+                NextState("PRECHARGE")
             )
         )
         fsm.act("PRECHARGE",
@@ -228,7 +457,11 @@ class BankMachine(Module):
             row_close.eq(1)
         )
         fsm.act("ACTIVATE",
-            If(trccon.ready,
+            # Row closed by page policy (idle precharge or closed-page auto-precharge) or for a
+            # per-bank refresh.
+            If(row_unneeded | refresh_close,
+                NextState("REGULAR")
+            ).Elif(trccon.ready,
                 row_col_n_addr_sel.eq(1),
                 row_open.eq(1),
                 cmd.valid.eq(1),
@@ -251,3 +484,83 @@ class BankMachine(Module):
         )
         fsm.delayed_enter("TRP", "ACTIVATE", settings.timing.tRP - 1)
         fsm.delayed_enter("TRCD", "REGULAR", settings.timing.tRCD - 1)
+
+        # Page policy ------------------------------------------------------------------------------
+        if with_page_policy:
+            # Learn if accesses would hit the previously opened row: reward row hits and
+            # re-activations of the same row, penalize activations of another row.
+            hit_score = Signal(3, reset=2**3-1)
+            last_row  = Signal(settings.geom.rowbits)
+            activated = Signal() # Row activated for the current request.
+            activate  = cmd.valid & cmd.ready & row_open
+            access    = cmd.valid & cmd.ready & (cmd.is_read | cmd.is_write)
+            same_row  = slicer.row(cmd_buffer.source.addr) == last_row
+            hit       = Signal()
+            miss      = Signal()
+            self.sync += [
+                If(activate,
+                    last_row.eq(slicer.row(cmd_buffer.source.addr))
+                ),
+                If(activate,
+                    activated.eq(1)
+                ).Elif(access,
+                    activated.eq(0)
+                )
+            ]
+            self.comb += [
+                hit.eq((access & ~activated) | (activate & same_row)),
+                miss.eq(activate & ~same_row),
+            ]
+            self.sync += [
+                If(~self.page_learning,
+                    hit_score.eq(hit_score.reset)
+                ).Elif(hit & (hit_score != 2**3-1),
+                    hit_score.eq(hit_score + 1)
+                ).Elif(miss & (hit_score != 0),
+                    hit_score.eq(hit_score - 1)
+                )
+            ]
+            self.comb += self.page_closed.eq(~hit_score[-1])
+
+            # Closed-page: auto-precharge when no other request is queued.
+            self.comb += \
+                If(self.page_closed & cmd_buffer.source.valid & ~cmd_buffer_lookahead.source.valid,
+                    auto_precharge.eq((row_close == 0) & burst_last)
+                )
+
+            # Idle timeout: precharge the opened row when no request comes in time.
+            self.comb += row_unneeded.eq(~cmd_buffer.source.valid)
+            idle_count = Signal(16)
+            self.sync += \
+                If(fsm.ongoing("REGULAR") & row_opened & ~cmd_buffer.source.valid,
+                    If(~page_expired,
+                        idle_count.eq(idle_count + 1)
+                    )
+                ).Else(
+                    idle_count.eq(0)
+                )
+            self.comb += page_expired.eq((self.page_timeout != 0) & (idle_count >= self.page_timeout))
+
+        # Performance monitoring -------------------------------------------------------------------
+        if with_perfmon:
+            # Classify each request once, when it reaches the head of the command buffer.
+            classified = Signal()
+            head       = cmd_buffer.source.valid & ~classified
+            self.sync += \
+                If(cmd_buffer.source.valid & cmd_buffer.source.ready,
+                    classified.eq(0)
+                ).Elif(cmd_buffer.source.valid,
+                    classified.eq(1)
+                )
+            push  = cmd_buffer_lookahead.sink.valid & cmd_buffer_lookahead.sink.ready
+            pop   = cmd_buffer_lookahead.source.valid & cmd_buffer_lookahead.source.ready
+            level = self.perf.level
+            self.sync += level.eq(level + push - pop)
+            self.comb += [
+                self.perf.row_hit.eq(head & row_opened & row_hit),
+                self.perf.row_miss.eq(head & ~row_opened),
+                self.perf.row_conflict.eq(head & row_opened & ~row_hit),
+                self.perf.activate.eq(cmd.valid & cmd.ready & row_open),
+                self.perf.precharge.eq(cmd.valid & cmd.ready & (
+                    (cmd.is_cmd & cmd.ras & cmd.we) | (cmd.cas & auto_precharge))),
+            ]
@@ -9,6 +9,8 @@
 
 from migen import *
 
+from litex.soc.interconnect.csr import *
+
 from litedram.common import *
 from litedram.phy import dfi
 from litedram.core.refresher import Refresher
@@ -23,24 +25,70 @@ class ControllerSettings(Settings):
         cmd_buffer_depth    = 8,              # Depth of the command buffer (number of entries).
         cmd_buffer_buffered = False,          # Enable or disable buffered command mode.
 
+        # Native bursts.
+        cmd_burst_length    = 1,              # Maximum number of consecutive words moved by a port command,
+                                              # power of 2, bursts can't cross a cmd_burst_length boundary
+                                              # (1: disabled).
+
+        # Command reordering (FR-FCFS).
+        cmd_buffer_reordering = False,        # Serve row-hit requests before older row-miss requests.
+        cmd_buffer_max_age    = 16,           # Maximum number of times a request can be bypassed.
+        cmd_buffer_tag_width  = 4,            # Width of the master tag (up to 2**n crossbar ports).
+
+        # Request aging.
+        cmd_age_threshold   = None,           # Cycles after which a waiting request overrides row hits in the
+                                              # Multiplexer, ties broken by age (None: round-robin).
+
+        # Command choosers.
+        with_pipelined_choosers = False,      # Pre-select the Multiplexer candidates a cycle ahead (for high
+                                              # bank counts, adds a cycle of arbitration latency).
+
+        # Multi-bank masters.
+        read_reorder_depth  = 0,              # Reads a master can have pending across banks, returned in
+                                              # order by the crossbar (0: master locked to one bank).
+
+        # Posted writes.
+        wdata_buffer_depth  = 0,              # Write data/commands buffered per port, writes being scheduled
+                                              # once their data is resident (0: disabled).
+
         # Read/Write times.
         read_time           = 32,             # Maximum time (in cycles) allowed for a read operation before switching to a write.
         write_time          = 16,             # Maximum time (in cycles) allowed for a write operation before switching to a read.
 
+        # Ranks.
+        rank_to_rank_delay  = 2,              # Data bus turnaround (tRTRS, in DRAM clocks) between reads/writes
+                                              # to different ranks.
+
+        # Write batching.
+        write_high_watermark = None,          # Pending writes forcing a switch to writes (None: disabled).
+        write_low_watermark  = 0,             # Pending writes down to which writes are drained.
+
         # Bandwidth.
         with_bandwidth      = False,          # Enable bandwidth calculation and monitoring.
 
+        # Performance monitoring.
+        with_perfmon        = False,          # Enable row hit/miss/conflict, turnaround and occupancy counters.
+
         # Refresh.
         with_refresh        = True,           # Enable periodic refresh operations.
         refresh_cls         = Refresher,      # Class used for refresh logic.
         refresh_zqcs_freq   = 1e0,            # Frequency of ZQCS (ZQ Calibration Short) commands.
         refresh_postponing  = 1,              # Maximum number of refresh postponements allowed.
+        refresh_per_bank    = False,          # Use per-bank refreshes (REFpb, LPDDR4/LPDDR5 only).
+        refresh_per_rank    = False,          # Stagger refreshes across the ranks (multi-rank only).
+        refresh_pull_in     = 0,              # Maximum number of refreshes issued in advance when idle (0: disabled).
 
         # Auto-Precharge.
         with_auto_precharge = True,           # Enable auto-precharge after read/write operations.
 
+        # Page policy.
+        page_timeout        = None,           # Idle cycles before closing an opened row (None: disabled).
+        with_page_learning  = False,          # Switch banks between open/closed-page from their hit rate.
+
         # Address mapping.
-        address_mapping     = "ROW_BANK_COL", # Address mapping scheme (e.g., row-bank-column).
+        address_mapping     = "ROW_BANK_COL", # Address mapping scheme: ROW_BANK_COL, ROW_BANK_COL_XOR
+                                              # (bank bits XORed with the lowest row bits),
+                                              # BANK_ROW_COL or ROW_COL_BANK.
 
         # Bank byte alignment.
         bank_byte_alignment = 0):             # Minimum byte alignment between bank changes. Ensures a
@@ -52,6 +100,43 @@ class ControllerSettings(Settings):
         self.set_attributes(locals())
 
 
+# Page Policy --------------------------------------------------------------------------------------
+
+class PagePolicy(Module, AutoCSR):
+    """Runtime control of the BankMachines page policy
+
+    Parameters
+    ----------
+    bank_machines : [BankMachine, ...]
+        Bank machines to control
+    timeout : int
+        Default idle timeout (in cycles) before an opened row is precharged, 0 keeps rows opened
+    learning : bool
+        Default state of the page policy learning
+
+    Attributes
+    ----------
+    page_timeout : CSRStorage(16), in
+        Idle cycles before an opened row is precharged (0: keep rows opened)
+    page_learning : CSRStorage(), in
+        Switch banks between open/closed-page behaviour based on their hit rate
+    page_closed : CSRStatus(nbanks), out
+        Banks currently using closed-page behaviour
+    """
+    def __init__(self, bank_machines, timeout=0, learning=False):
+        self.page_timeout  = CSRStorage(16, reset=timeout)
+        self.page_learning = CSRStorage(reset=learning)
+        self.page_closed   = CSRStatus(len(bank_machines))
+
+        # # #
+
+        for n, bank_machine in enumerate(bank_machines):
+            self.comb += [
+                bank_machine.page_timeout.eq(self.page_timeout.storage),
+                bank_machine.page_learning.eq(self.page_learning.storage),
+                self.page_closed.status[n].eq(bank_machine.page_closed),
+            ]
+
 # Controller ---------------------------------------------------------------------------------------
 
 class LiteDRAMController(Module):
@@ -103,6 +188,16 @@ class LiteDRAMController(Module):
             self.submodules += bank_machine
             self.comb += getattr(interface, "bank"+str(n)).connect(bank_machine.req)
 
+        # Refresh pull-in: refreshes are issued in advance while no BankMachine has pending requests.
+        if self.settings.refresh_pull_in:
+            self.comb += self.refresher.idle.eq(~reduce(or_, [bm.req.valid | bm.req.lock for bm in bank_machines]))
+
+        # Page Policy ------------------------------------------------------------------------------
+        if self.settings.page_timeout is not None or self.settings.with_page_learning:
+            self.submodules.page_policy = PagePolicy(bank_machines,
+                timeout  = self.settings.page_timeout or 0,
+                learning = self.settings.with_page_learning)
+
         # Multiplexer ------------------------------------------------------------------------------
         self.submodules.multiplexer = Multiplexer(
             settings      = self.settings,
@@ -112,4 +207,7 @@ class LiteDRAMController(Module):
             interface     = interface)
 
     def get_csrs(self):
-        return self.multiplexer.get_csrs()
+        csrs = self.multiplexer.get_csrs()
+        if hasattr(self, "page_policy"):
+            csrs += self.page_policy.get_csrs()
+        return csrs
@@ -15,14 +15,354 @@ from migen import *
 from migen.genlib import roundrobin
 
 from litex.soc.interconnect import stream
+from litex.soc.interconnect.csr import *
 
 from litedram.common import *
 from litedram.core.controller import *
 from litedram.frontend.adapter import *
 
+# LiteDRAMPortQoS ----------------------------------------------------------------------------------
+
+class LiteDRAMPortQoS(Module, AutoCSR):
+    """Quality of Service of a crossbar port
+
+    Bank arbiters only consider the requesting ports of the highest priority
+    class, then serve them in a weighted round-robin: a granted port keeps the
+    bank for `weight` commands before it is handed over to another port.
+
+    Bandwidth can optionally be capped with a token bucket: the port earns
+    `rate`/256 command per cycle, up to `burst` commands, and is not arbitrated
+    when out of tokens.
+
+    Parameters
+    ----------
+    priority : int
+        Default priority class of the port (0-3, higher classes are served first)
+    weight : int
+        Default number of consecutive commands granted to the port
+    rate : int
+        Default bandwidth cap, in 1/256 command per cycle (0: disabled)
+    burst : int
+        Size of the token bucket, in commands
+
+    Attributes
+    ----------
+    priority : CSRStorage(2), in
+        Priority class of the port
+    weight : CSRStorage(8), in
+        Number of consecutive commands granted to the port
+    rate : CSRStorage(8), in
+        Bandwidth cap, in 1/256 command per cycle (0: disabled)
+    accepted : Signal(), in
+        Command accepted from the port
+    allowed : Signal(), out
+        Port has enough tokens to issue a command
+    """
+    def __init__(self, priority=0, weight=1, rate=0, burst=8):
+        assert 0 <= priority < 4
+        assert 1 <= weight  < 256
+        assert 0 <= rate    < 256
+        assert burst >= 1
+        self.priority = CSRStorage(2, reset=priority)
+        self.weight   = CSRStorage(8, reset=weight)
+        self.rate     = CSRStorage(8, reset=rate)
+        self.accepted = Signal()
+        self.allowed  = Signal()
+
+        # # #
+
+        # Token bucket (in 1/256 command).
+        tokens     = Signal(max=(burst + 1)*256, reset=burst*256)
+        tokens_max = burst*256
+        tokens_nxt = Signal(max=(burst + 2)*256)
+        self.comb += [
+            tokens_nxt.eq(tokens + self.rate.storage),
+            If(self.accepted,
+                tokens_nxt.eq(tokens + self.rate.storage - 256)
+            ),
+            self.allowed.eq((self.rate.storage == 0) | (tokens >= 256)),
+        ]
+        self.sync += [
+            tokens.eq(tokens_nxt),
+            If(tokens_nxt > tokens_max,
+                tokens.eq(tokens_max)
+            )
+        ]
+
+# LiteDRAMPortLatency ------------------------------------------------------------------------------
+
+class LiteDRAMPortLatency(Module, AutoCSR):
+    """Latency monitor of a crossbar port
+
+    Measures the command-accept latency (cycles between a command becoming
+    valid and its acceptance) and the read round-trip latency (cycles between
+    a read command being accepted and its data being returned) of a port.
+
+    For each of them, a histogram with log2 buckets (bucket 0: 0 cycle, bucket
+    n: [2^(n-1), 2^n) cycles, last bucket saturating) and the count/min/max/sum
+    of the latencies are kept. They are copied to the status registers when
+    user writes to the `update` register (the histogram bucket being selected by
+    `bucket`) and cleared when user writes to the `reset` register.
+
+    For burst reads, the round-trip latency is measured on the first word.
+
+    The timestamps of the pending reads are kept in a FIFO of `depth` entries:
+    new reads have to be blocked while it is full (`allowed`), otherwise the
+    latencies would be attributed to the wrong commands.
+
+    Parameters
+    ----------
+    port : LiteDRAMNativePort
+        Port to monitor (crossbar side)
+    depth : int
+        Maximum number of reads pending on the port
+    nbuckets : int
+        Number of histogram buckets
+    verbose : bool
+        Display each latency in simulation
+    with_rdata_ready : bool
+        Read data is only returned when `rdata.ready` is set (otherwise on
+        `rdata.valid` alone, as done by the crossbar without reorder buffer)
+
+    Attributes
+    ----------
+    allowed : Signal(), out
+        A new read can be accepted on the port
+    update : CSR, in
+        Copy the current values to the status registers
+    reset : CSR, in
+        Clear the current values
+    bucket : CSRStorage, in
+        Histogram bucket copied to `cmd_histogram`/`read_histogram`
+    cmd_count, read_count : CSRStatus(32), out
+        Number of latencies measured
+    cmd_min, read_min : CSRStatus(16), out
+        Minimum latency
+    cmd_max, read_max : CSRStatus(16), out
+        Maximum latency (saturating)
+    cmd_sum, read_sum : CSRStatus(48), out
+        Sum of the latencies
+    cmd_histogram, read_histogram : CSRStatus(32), out
+        Number of latencies falling in the selected bucket
+    """
+    def __init__(self, port, depth, nbuckets=16, verbose=False, with_rdata_ready=False):
+        self.allowed = Signal()
+        self.update  = CSR()
+        self.reset   = CSR()
+        self.bucket  = CSRStorage(bits_for(nbuckets - 1))
+
+        self.cmd_count      = CSRStatus(32)
+        self.cmd_min        = CSRStatus(16)
+        self.cmd_max        = CSRStatus(16)
+        self.cmd_sum        = CSRStatus(48)
+        self.cmd_histogram  = CSRStatus(32)
+
+        self.read_count     = CSRStatus(32)
+        self.read_min       = CSRStatus(16)
+        self.read_max       = CSRStatus(16)
+        self.read_sum       = CSRStatus(48)
+        self.read_histogram = CSRStatus(32)
+
+        # # #
+
+        # Command-accept latency.
+        cmd_accepted = Signal()
+        cmd_latency  = Signal(16)
+        cmd_wait     = Signal(16)
+        self.comb += [
+            cmd_accepted.eq(port.cmd.valid & port.cmd.ready),
+            cmd_latency.eq(cmd_wait),
+        ]
+        self.sync += [
+            If(~port.cmd.valid | port.cmd.ready,
+                cmd_wait.eq(0)
+            ).Elif(cmd_wait != (2**16 - 1),
+                cmd_wait.eq(cmd_wait + 1)
+            )
+        ]
+
+        # Read round-trip latency: timestamp of the accepted reads.
+        timestamp = Signal(16)
+        self.sync += timestamp.eq(timestamp + 1)
+        timestamps_layout = [("timestamp", 16)]
+        if port.burst_width:
+            timestamps_layout += [("burst", port.burst_width)]
+        timestamps = stream.SyncFIFO(timestamps_layout, depth)
+        self.submodules += timestamps
+        read_data     = Signal()
+        read_returned = Signal()
+        read_latency  = Signal(16)
+        self.comb += [
+            self.allowed.eq(timestamps.sink.ready),
+            timestamps.sink.valid.eq(cmd_accepted & ~port.cmd.we),
+            timestamps.sink.timestamp.eq(timestamp),
+            read_data.eq(port.rdata.valid & timestamps.source.valid),
+            read_returned.eq(read_data),
+            timestamps.source.ready.eq(read_data),
+            read_latency.eq(timestamp - timestamps.source.timestamp),
+        ]
+        if with_rdata_ready:
+            self.comb += If(~port.rdata.ready, read_data.eq(0))
+        if port.burst_width:
+            # Only measure the first word of a burst and release the timestamp after the last one.
+            beat = Signal(port.burst_width)
+            self.comb += [
+                timestamps.sink.burst.eq(port.cmd.burst),
+                read_returned.eq(read_data & (beat == 0)),
+                timestamps.source.ready.eq(read_data & (beat == timestamps.source.burst)),
+            ]
+            self.sync += \
+                If(timestamps.source.valid & timestamps.source.ready,
+                    beat.eq(0)
+                ).Elif(read_data,
+                    beat.eq(beat + 1)
+                )
+
+        for name, valid, latency in [
+            ("cmd",  cmd_accepted,  cmd_latency),
+            ("read", read_returned, read_latency)]:
+            count     = Signal(32)
+            min_      = Signal(16, reset=2**16 - 1)
+            max_      = Signal(16)
+            sum_      = Signal(48)
+            histogram = Array(Signal(32) for _ in range(nbuckets))
+
+            # Log2 bucket of the latency.
+            bucket = Signal(max=nbuckets)
+            self.comb += bucket.eq(0)
+            for i in range(1, nbuckets):
+                self.comb += If(latency >= 2**(i - 1), bucket.eq(i))
+
+            self.sync += [
+                If(self.reset.wr_stb,
+                    count.eq(0),
+                    min_.eq(min_.reset),
+                    max_.eq(0),
+                    sum_.eq(0),
+                    [h.eq(0) for h in histogram]
+                ).Elif(valid,
+                    count.eq(count + 1),
+                    If(latency < min_, min_.eq(latency)),
+                    If(latency > max_, max_.eq(latency)),
+                    sum_.eq(sum_ + latency),
+                    histogram[bucket].eq(histogram[bucket] + 1)
+                ),
+                If(self.update.wr_stb,
+                    getattr(self, name + "_count").status.eq(count),
+                    getattr(self, name + "_min").status.eq(min_),
+                    getattr(self, name + "_max").status.eq(max_),
+                    getattr(self, name + "_sum").status.eq(sum_),
+                    getattr(self, name + "_histogram").status.eq(histogram[self.bucket.storage])
+                )
+            ]
+            if verbose:
+                self.sync += If(valid,
+                    Display("port{} {} latency: %0d cycles".format(port.id, name), latency)
+                )
+
+# LiteDRAMReorderBuffer ----------------------------------------------------------------------------
+
+class LiteDRAMReorderBuffer(Module):
+    """Returns the reads of a master in order
+
+    Reads of a master pending in several banks can complete out of order
+    (they stay in order within a bank). An entry is allocated with the bank of
+    each read in command order, data returned by a bank fills the oldest entry
+    of this bank and entries are delivered in order. Data filling the oldest
+    entry bypasses the buffer.
+
+    Parameters
+    ----------
+    depth : int
+        Number of reads the master can have pending (power of 2)
+    data_width : int
+        Width of the read data
+    nbanks : int
+        Number of banks
+
+    Attributes
+    ----------
+    alloc : Signal(), in
+        Read accepted from the master, allocates an entry
+    alloc_bank : Signal(max=nbanks), in
+        Bank of the allocated read
+    full : Signal(), out
+        No entry available
+    fill : Signal(), in
+        Read data returned by a bank
+    fill_bank : Signal(max=nbanks), in
+        Bank returning the read data
+    fill_data : Signal(data_width), in
+        Read data
+    source : Endpoint(rdata_description), out
+        Read data in command order
+    """
+    def __init__(self, depth, data_width, nbanks):
+        assert depth >= 2
+        self.alloc      = Signal()
+        self.alloc_bank = Signal(max=max(nbanks, 2))
+        self.full       = Signal()
+        self.fill       = Signal()
+        self.fill_bank  = Signal(max=max(nbanks, 2))
+        self.fill_data  = Signal(data_width)
+        self.source     = source = stream.Endpoint(rdata_description(data_width))
+
+        # # #
+
+        banks   = Array(Signal(max=max(nbanks, 2)) for _ in range(depth))
+        filled  = Array(Signal() for _ in range(depth))
+        produce = Signal(log2_int(depth))
+        consume = Signal(log2_int(depth))
+        level   = Signal(max=depth + 1)
+
+        mem    = Memory(data_width, depth)
+        wrport = mem.get_port(write_capable=True)
+        rdport = mem.get_port(async_read=True)
+        self.specials += mem, wrport, rdport
+
+        # Oldest entry of the bank returning data.
+        fill_index = Signal(log2_int(depth))
+        for i in reversed(range(depth)):
+            index = Signal(log2_int(depth))
+            self.comb += [
+                index.eq(consume + i),
+                If((level > i) & (banks[index] == self.fill_bank) & ~filled[index],
+                    fill_index.eq(index)
+                )
+            ]
+        bypass = Signal()
+        self.comb += [
+            self.full.eq(level == depth),
+            bypass.eq(self.fill & (fill_index == consume)),
+            wrport.adr.eq(fill_index),
+            wrport.dat_w.eq(self.fill_data),
+            wrport.we.eq(self.fill),
+            rdport.adr.eq(consume),
+            source.valid.eq((level != 0) & (filled[consume] | bypass)),
+            source.data.eq(Mux(filled[consume], rdport.dat_r, self.fill_data)),
+        ]
+        self.sync += [
+            If(self.alloc,
+                banks[produce].eq(self.alloc_bank),
+                produce.eq(produce + 1)
+            ),
+            If(self.fill & ~(bypass & source.ready),
+                filled[fill_index].eq(1)
+            ),
+            If(source.valid & source.ready,
+                filled[consume].eq(0),
+                consume.eq(consume + 1)
+            ),
+            If(self.alloc & ~(source.valid & source.ready),
+                level.eq(level + 1)
+            ).Elif(~self.alloc & (source.valid & source.ready),
+                level.eq(level - 1)
+            )
+        ]
+
 # LiteDRAMCrossbar ---------------------------------------------------------------------------------
 
-class LiteDRAMCrossbar(Module):
+class LiteDRAMCrossbar(Module, AutoCSR):
     """Multiplexes LiteDRAMController (slave) between ports (masters)
 
     To get a port to LiteDRAM, use the `get_port` method. It handles data width
@@ -51,6 +391,51 @@ class LiteDRAMCrossbar(Module):
     Data ready/valid signals for banks are routed from bankmachines with
     a latency that synchronizes them with the data coming over datapath.
 
+    With `controller.settings.read_reorder_depth`, a master is no longer
+    locked to a bank by its reads: it can have reads pending in several banks
+    and a LiteDRAMReorderBuffer returns them in order. Its writes stay locked
+    to a single bank so that write data is consumed in order.
+
+    Ports can be given a Quality of Service (priority class, weight and
+    bandwidth cap) through `get_port`, adjustable at runtime through the
+    CSRs of their LiteDRAMPortQoS (see its documentation). As soon as one
+    port uses it, a granted master loses its bank when another master of
+    higher priority is waiting or when it has used its weight.
+
+    With `controller.settings.wdata_buffer_depth`, the write data of each port
+    is buffered ahead of the scheduling of its writes by a
+    LiteDRAMNativePortWriteBuffer: a write is only presented to the banks
+    once its data is resident, so masters no longer have to provide the data
+    exactly when the controller requests it.
+
+    With `controller.settings.cmd_burst_length`, the ports operating at the
+    controller data width get a `burst` command field: a command moves
+    `burst` + 1 consecutive words and is expanded by the BankMachine into
+    column accesses of the same row, saving the arbitration and command
+    buffer entries of the following words. A burst can't cross a
+    `cmd_burst_length` words boundary.
+
+    With burst chop (`burst_chop` DDR3/DDR4 PHY settings), these ports also
+    get `chop`/`chop_upper` command fields: a chopped command is a half-burst
+    (BC4) moving the data of the first half of the word, from/to the lower
+    or upper half of the DRAM word.
+
+    With `with_atomics`, a port also accepts atomic commands (fetch-and-add,
+    swap, compare-and-swap, min/max), executed as read-modify-writes by a
+    LiteDRAMNativePortAtomic (see its documentation). During the
+    read-modify-write, the port `hold`s its bank: the bank arbiter keeps it
+    granted to the port so no other master can access the word in between.
+
+    With `with_latency_monitor`, the command-accept and read round-trip
+    latencies of a port are monitored by a LiteDRAMPortLatency (see its
+    documentation).
+
+    With `controller.settings.cmd_buffer_reordering`, requests are tagged with
+    their master and several masters can share a bank's command queue. Banks are
+    then no longer locked to a master: each master is instead locked to the bank
+    holding its pending requests, and data ready/valid signals are routed based
+    on the tag returned by the BankMachine.
+
     Parameters
     ----------
     controller : LiteDRAMInterface
@@ -65,6 +450,8 @@ class LiteDRAMCrossbar(Module):
         self.controller = controller
 
         self.rca_bits         = controller.address_width
+        self.burst_width      = controller.burst_width
+        self.with_chop        = controller.with_chop
         self.nbanks           = controller.nbanks
         self.nranks           = controller.nranks
         self.cmd_buffer_depth = controller.settings.cmd_buffer_depth
@@ -74,9 +461,19 @@ class LiteDRAMCrossbar(Module):
         self.bank_bits = log2_int(self.nbanks, False)
         self.rank_bits = log2_int(self.nranks, False)
 
-        self.masters = []
-
-    def get_port(self, mode="both", data_width=None, clock_domain="sys", reverse=False):
+        self.masters      = []
+        self.masters_qos  = []
+        self.masters_latency = []
+        self.with_atomics = False
+
+    def get_port(self, mode="both", data_width=None, clock_domain="sys", reverse=False,
+        priority = None,
+        weight   = None,
+        rate     = None,
+        burst    = 8,
+        with_atomics         = False,
+        with_latency_monitor = False,
+        latency_verbose      = False):
         if self.finalized:
             raise FinalizeError
 
@@ -90,9 +487,70 @@ class LiteDRAMCrossbar(Module):
             address_width = self.rca_bits + self.bank_bits - self.rank_bits,
             data_width    = self.controller.data_width,
             clock_domain  = "sys",
-            id            = len(self.masters))
+            id            = len(self.masters),
+            burst_width   = self.burst_width,
+            with_chop     = self.with_chop)
         self.masters.append(port)
 
+        # Quality of Service -----------------------------------------------------------------------
+        qos = None
+        if (priority, weight, rate) != (None, None, None):
+            qos = LiteDRAMPortQoS(
+                priority = priority or 0,
+                weight   = weight   or 1,
+                rate     = rate     or 0,
+                burst    = burst)
+            setattr(self.submodules, "port{}_qos".format(port.id), qos)
+            self.comb += qos.accepted.eq(port.cmd.valid & port.cmd.ready)
+        self.masters_qos.append(qos)
+
+        # Latency monitoring -----------------------------------------------------------------------
+        latency = None
+        if with_latency_monitor:
+            reorder_depth = getattr(self.controller.settings, "read_reorder_depth", 0)
+            max_reads     = max(self.cmd_buffer_depth + 2, reorder_depth)
+            latency       = LiteDRAMPortLatency(port,
+                depth            = max_reads + self.read_latency,
+                verbose          = latency_verbose,
+                with_rdata_ready = reorder_depth != 0)
+            setattr(self.submodules, "port{}_latency".format(port.id), latency)
+        self.masters_latency.append(latency)
+
+        # Atomic operations ------------------------------------------------------------------------
+        if with_atomics:
+            if mode != "both":
+                raise ValueError("Atomic operations require a read/write port")
+            new_port = LiteDRAMNativePort(
+                mode          = mode,
+                address_width = port.address_width,
+                data_width    = port.data_width,
+                clock_domain  = "sys",
+                id            = port.id,
+                burst_width   = port.burst_width,
+                with_chop     = port.with_chop,
+                with_atomics  = True)
+            self.submodules += LiteDRAMNativePortAtomic(new_port, port)
+            self.with_atomics = True
+            port = new_port
+
+        # Posted write buffer ----------------------------------------------------------------------
+        wdata_buffer_depth = getattr(self.controller.settings, "wdata_buffer_depth", 0)
+        if wdata_buffer_depth and mode in ["write", "both"]:
+            if wdata_buffer_depth < 2**self.burst_width:
+                raise ValueError("wdata_buffer_depth={} can't hold a burst of cmd_burst_length={}".format(
+                    wdata_buffer_depth, 2**self.burst_width))
+            new_port = LiteDRAMNativePort(
+                mode          = mode,
+                address_width = port.address_width,
+                data_width    = port.data_width,
+                clock_domain  = "sys",
+                id            = port.id,
+                burst_width   = port.burst_width,
+                with_chop     = port.with_chop,
+                with_atomics  = port.with_atomics)
+            self.submodules += LiteDRAMNativePortWriteBuffer(new_port, port, wdata_buffer_depth)
+            port = new_port
+
         # Clock domain crossing --------------------------------------------------------------------
         if clock_domain != "sys":
             new_port = LiteDRAMNativePort(
@@ -100,7 +558,10 @@ class LiteDRAMCrossbar(Module):
                 address_width = port.address_width,
                 data_width    = port.data_width,
                 clock_domain  = clock_domain,
-                id            = port.id)
+                id            = port.id,
+                burst_width   = port.burst_width,
+                with_chop     = port.with_chop,
+                with_atomics  = port.with_atomics)
             self.submodules += LiteDRAMNativePortCDC(new_port, port)
             port = new_port
 
@@ -127,14 +588,30 @@ class LiteDRAMCrossbar(Module):
         nmasters   = len(self.masters)
 
         # Address mapping --------------------------------------------------------------------------
+        # ROW_BANK_COL     : Banks interleaved on each row (or on bank_byte_alignment).
+        # ROW_BANK_COL_XOR : ROW_BANK_COL with bank bits XORed with the lowest row bits, spreading
+        #                    power-of-two strided accesses over the banks.
+        # BANK_ROW_COL     : Bank bits on top, each bank is a contiguous region.
+        # ROW_COL_BANK     : Banks interleaved on each controller word.
+        row_bank_col_shift = max(
+            controller.settings.geom.colbits - controller.address_align,
+            log2_int(getattr(controller.settings, "bank_byte_alignment", 0) //(controller.data_width // 8))
+        )
         cba_shifts = {
-            "ROW_BANK_COL": max(
-                controller.settings.geom.colbits - controller.address_align,
-                log2_int(getattr(controller.settings, "bank_byte_alignment", 0) //(controller.data_width // 8))
-            )
+            "ROW_BANK_COL"     : row_bank_col_shift,
+            "ROW_BANK_COL_XOR" : row_bank_col_shift,
+            "BANK_ROW_COL"     : self.rca_bits - self.rank_bits,
+            "ROW_COL_BANK"     : 0,
         }
-        cba_shift = cba_shifts[controller.settings.address_mapping]
-        m_ba      = [m.get_bank_address(self.bank_bits, cba_shift)for m in self.masters]
+        address_mapping = controller.settings.address_mapping
+        cba_shift = cba_shifts[address_mapping]
+        cba_xor   = address_mapping.endswith("_XOR")
+
+        # Bursts must stay in a row of a bank: consecutive words have to be consecutive columns.
+        if self.burst_width > min(cba_shift, controller.settings.geom.colbits - controller.address_align):
+            raise ValueError("cmd_burst_length={} exceeds the row words of {} mapping".format(
+                2**self.burst_width, address_mapping))
+        m_ba      = [m.get_bank_address(self.bank_bits, cba_shift, cba_xor) for m in self.masters]
         m_rca     = [m.get_row_column_address(self.bank_bits, self.rca_bits, cba_shift) for m in self.masters]
 
         master_readys       = [0]*nmasters
@@ -144,6 +621,36 @@ class LiteDRAMCrossbar(Module):
         arbiters = [roundrobin.RoundRobin(nmasters, roundrobin.SP_CE) for n in range(self.nbanks)]
         self.submodules += arbiters
 
+        # Quality of Service: ports without QoS get the lowest priority and a weight of 1.
+        with_qos = any(qos is not None for qos in self.masters_qos)
+        if with_qos:
+            m_priority = [0 if qos is None else qos.priority.storage for qos in self.masters_qos]
+            m_weight   = [1 if qos is None else qos.weight.storage   for qos in self.masters_qos]
+
+        # Multi-bank masters: reads can be pending in several banks and are returned in order by a
+        # reorder buffer, writes stay locked to the bank holding the pending writes of the master.
+        reorder_depth = getattr(controller.settings, "read_reorder_depth", 0)
+        if reorder_depth and self.burst_width:
+            raise ValueError("read_reorder_depth is not supported with cmd_burst_length")
+        if reorder_depth:
+            master_robs      = [LiteDRAMReorderBuffer(reorder_depth, controller.data_width, self.nbanks)
+                for _ in self.masters]
+            master_wbanks    = [Signal(max=max(self.nbanks, 2)) for _ in self.masters]
+            master_wpendings = [Signal(max=max(self.cmd_buffer_depth, 1) + 3) for _ in self.masters]
+            master_rbanks    = [Signal(max=max(self.nbanks, 2)) for _ in self.masters]
+            self.submodules += master_robs
+
+        # Tagged requests: track the bank holding the pending requests of each master.
+        tagged = controller.tag_width != 0
+        if tagged:
+            if nmasters > 2**controller.tag_width:
+                raise ValueError("{} ports exceed cmd_buffer_tag_width={}".format(
+                    nmasters, controller.tag_width))
+        if tagged and not reorder_depth:
+            master_banks    = [Signal(max=max(self.nbanks, 2)) for _ in self.masters]
+            master_pendings = [Signal(max=(max(self.cmd_buffer_depth, 1) + 3)*2**self.burst_width)
+                for _ in self.masters]
+
         for nb, arbiter in enumerate(arbiters):
             bank = getattr(controller, "bank"+str(nb))
 
@@ -151,32 +658,139 @@ class LiteDRAMCrossbar(Module):
             master_locked = []
             for nm, master in enumerate(self.masters):
                 locked = Signal()
-                for other_nb, other_arbiter in enumerate(arbiters):
-                    if other_nb != nb:
-                        other_bank = getattr(controller, "bank"+str(other_nb))
-                        locked = locked | (other_bank.lock & (other_arbiter.grant == nm))
+                if reorder_depth:
+                    self.comb += locked.eq(Mux(master.cmd.we,
+                        (master_wpendings[nm] != 0) & (master_wbanks[nm] != nb),
+                        master_robs[nm].full))
+                elif tagged:
+                    self.comb += locked.eq((master_pendings[nm] != 0) & (master_banks[nm] != nb))
+                else:
+                    for other_nb, other_arbiter in enumerate(arbiters):
+                        if other_nb != nb:
+                            other_bank = getattr(controller, "bank"+str(other_nb))
+                            locked = locked | (other_bank.lock & (other_arbiter.grant == nm))
                 master_locked.append(locked)
 
             # Arbitrate ----------------------------------------------------------------------------
+            # A master holding the bank (atomic read-modify-write) keeps it granted.
+            held = Signal()
+            if self.with_atomics:
+                self.comb += held.eq(Array(m.hold for m in self.masters)[arbiter.grant] &
+                    (Array(m_ba)[arbiter.grant] == nb))
             bank_selected  = [(ba == nb) & ~locked for ba, locked in zip(m_ba, master_locked)]
+            for nm, qos in enumerate(self.masters_qos):
+                if qos is not None:
+                    bank_selected[nm] = bank_selected[nm] & qos.allowed
+            for nm, (master, latency) in enumerate(zip(self.masters, self.masters_latency)):
+                if latency is not None:
+                    bank_selected[nm] = bank_selected[nm] & (latency.allowed | master.cmd.we)
             bank_requested = [bs & master.cmd.valid for bs, master in zip(bank_selected, self.masters)]
-            self.comb += [
-                arbiter.request.eq(Cat(*bank_requested)),
-                arbiter.ce.eq(~bank.valid & ~bank.lock)
-            ]
+            bank_valid     = Array(bank_requested)[arbiter.grant]
+            bank_ready     = bank.ready
+            if with_qos:
+                # Only arbitrate between the requesting masters of the highest priority class.
+                priority_max = Signal(2)
+                priority     = 0
+                for nm, requested in enumerate(bank_requested):
+                    priority = Mux(requested & (m_priority[nm] > priority), m_priority[nm], priority)
+                self.comb += priority_max.eq(priority)
+                bank_eligible = [br & (p == priority_max) for br, p in zip(bank_requested, m_priority)]
+                self.comb += arbiter.request.eq(Cat(*bank_eligible))
+
+                # Weighted round-robin: the granted master keeps the bank for its weight, then
+                # hands it over to another eligible master (or immediately if it is no longer
+                # eligible).
+                granted   = Signal(8)
+                exhausted = Signal()
+                switch    = Signal()
+                others    = reduce(or_, [be & (arbiter.grant != nm) for nm, be in enumerate(bank_eligible)])
+                self.comb += [
+                    exhausted.eq(granted >= Array(m_weight)[arbiter.grant]),
+                    switch.eq(others & (exhausted | ~Array(bank_eligible)[arbiter.grant]) & ~held),
+                ]
+                bank_valid = bank_valid & ~switch
+                bank_ready = bank_ready & ~switch
+                self.sync += [
+                    If(arbiter.ce,
+                        granted.eq(0)
+                    ).Elif(bank.valid & bank.ready & ~exhausted,
+                        granted.eq(granted + 1)
+                    )
+                ]
+                if tagged:
+                    self.comb += arbiter.ce.eq((~bank.valid |
+                        (bank.ready & (granted + 1 >= Array(m_weight)[arbiter.grant]))) & ~held)
+                else:
+                    self.comb += arbiter.ce.eq(~bank.valid & ~bank.lock & ~held)
+            else:
+                self.comb += arbiter.request.eq(Cat(*bank_requested))
+                if tagged:
+                    self.comb += arbiter.ce.eq((~bank.valid | bank.ready) & ~held)
+                else:
+                    self.comb += arbiter.ce.eq(~bank.valid & ~bank.lock & ~held)
 
             # Route requests -----------------------------------------------------------------------
             self.comb += [
                 bank.addr.eq(Array(m_rca)[arbiter.grant]),
                 bank.we.eq(Array(self.masters)[arbiter.grant].cmd.we),
-                bank.valid.eq(Array(bank_requested)[arbiter.grant])
+                bank.valid.eq(bank_valid)
             ]
-            master_readys = [master_ready | ((arbiter.grant == nm) & bank_selected[nm] & bank.ready)
+            if self.burst_width:
+                self.comb += bank.burst.eq(Array(self.masters)[arbiter.grant].cmd.burst)
+            if self.with_chop:
+                self.comb += [
+                    bank.chop.eq(Array(self.masters)[arbiter.grant].cmd.chop),
+                    bank.chop_upper.eq(Array(self.masters)[arbiter.grant].cmd.chop_upper),
+                ]
+            if tagged:
+                self.comb += bank.tag.eq(arbiter.grant)
+                data_grant = bank.data_tag
+            else:
+                data_grant = arbiter.grant
+            master_readys = [master_ready | ((arbiter.grant == nm) & bank_selected[nm] & bank_ready)
                 for nm, master_ready in enumerate(master_readys)]
-            master_wdata_readys = [master_wdata_ready | ((arbiter.grant == nm) & bank.wdata_ready)
+            master_wdata_readys = [master_wdata_ready | ((data_grant == nm) & bank.wdata_ready)
                 for nm, master_wdata_ready in enumerate(master_wdata_readys)]
-            master_rdata_valids = [master_rdata_valid | ((arbiter.grant == nm) & bank.rdata_valid)
+            master_rdata_valids = [master_rdata_valid | ((data_grant == nm) & bank.rdata_valid)
                 for nm, master_rdata_valid in enumerate(master_rdata_valids)]
+            if reorder_depth:
+                for nm in range(nmasters):
+                    self.comb += If((data_grant == nm) & bank.rdata_valid, master_rbanks[nm].eq(nb))
+
+        # Count pending writes of each master and allocate its reads in the reorder buffer.
+        if reorder_depth:
+            for nm, master in enumerate(self.masters):
+                accepted = master.cmd.valid & master_readys[nm]
+                acked    = master_wdata_readys[nm]
+                self.comb += [
+                    master_robs[nm].alloc.eq(accepted & ~master.cmd.we),
+                    master_robs[nm].alloc_bank.eq(m_ba[nm]),
+                ]
+                self.sync += [
+                    If(accepted & master.cmd.we,
+                        master_wbanks[nm].eq(m_ba[nm])
+                    ),
+                    If(accepted & master.cmd.we & ~acked,
+                        master_wpendings[nm].eq(master_wpendings[nm] + 1)
+                    ).Elif(~(accepted & master.cmd.we) & acked,
+                        master_wpendings[nm].eq(master_wpendings[nm] - 1)
+                    )
+                ]
+
+        # Count pending requests of each master (words accepted but not yet acked by the bank).
+        elif tagged:
+            for nm, master in enumerate(self.masters):
+                accepted = master.cmd.valid & master_readys[nm]
+                acked    = master_wdata_readys[nm] | master_rdata_valids[nm]
+                words    = 1
+                if self.burst_width:
+                    words = master.cmd.burst + 1
+                self.sync += [
+                    If(accepted,
+                        master_banks[nm].eq(m_ba[nm])
+                    ),
+                    master_pendings[nm].eq(master_pendings[nm] + Mux(accepted, words, 0) - acked)
+                ]
 
         # Delay write/read signals based on their latency
         for nm, master_wdata_ready in enumerate(master_wdata_readys):
@@ -193,12 +807,30 @@ class LiteDRAMCrossbar(Module):
                 master_rdata_valid = new_master_rdata_valid
             master_rdata_valids[nm] = master_rdata_valid
 
+        if reorder_depth:
+            for nm, master_rbank in enumerate(master_rbanks):
+                for i in range(self.read_latency):
+                    new_master_rbank = Signal.like(master_rbank)
+                    self.sync += new_master_rbank.eq(master_rbank)
+                    master_rbank = new_master_rbank
+                master_rbanks[nm] = master_rbank
+
         for master, master_ready in zip(self.masters, master_readys):
             self.comb += master.cmd.ready.eq(master_ready)
         for master, master_wdata_ready in zip(self.masters, master_wdata_readys):
             self.comb += master.wdata.ready.eq(master_wdata_ready)
-        for master, master_rdata_valid in zip(self.masters, master_rdata_valids):
-            self.comb += master.rdata.valid.eq(master_rdata_valid)
+        if reorder_depth:
+            for master, master_rdata_valid, master_rbank, rob in zip(
+                self.masters, master_rdata_valids, master_rbanks, master_robs):
+                self.comb += [
+                    rob.fill.eq(master_rdata_valid),
+                    rob.fill_bank.eq(master_rbank),
+                    rob.fill_data.eq(controller.rdata),
+                    rob.source.connect(master.rdata, omit={"first", "last"}),
+                ]
+        else:
+            for master, master_rdata_valid in zip(self.masters, master_rdata_valids):
+                self.comb += master.rdata.valid.eq(master_rdata_valid)
 
         # Route data writes ------------------------------------------------------------------------
         wdata_cases = {}
@@ -214,5 +846,6 @@ class LiteDRAMCrossbar(Module):
         self.comb += Case(Cat(*master_wdata_readys), wdata_cases)
 
         # Route data reads -------------------------------------------------------------------------
-        for master in self.masters:
-            self.comb += master.rdata.data.eq(controller.rdata)
+        if not reorder_depth:
+            for master in self.masters:
+                self.comb += master.rdata.data.eq(controller.rdata)
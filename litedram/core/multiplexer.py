@@ -10,17 +10,18 @@
 
 import math
 from functools import reduce
-from operator import or_, and_
+from operator import or_, and_, add
 
 from migen import *
 from migen.genlib.roundrobin import *
 from migen.genlib.coding import Decoder
 
 from litex.soc.interconnect import stream
-from litex.soc.interconnect.csr import AutoCSR
+from litex.soc.interconnect.csr import AutoCSR, CSRStorage
 
 from litedram.common import *
 from litedram.core.bandwidth import Bandwidth
+from litedram.core.perfmon import PerfMonitor, multiplexer_events_layout
 
 # _CommandChooser ----------------------------------------------------------------------------------
 
@@ -30,10 +31,28 @@ class _CommandChooser(Module):
     Uses RoundRobin to choose current request, filters requests based on
     `want_*` signals.
 
+    With `ages`, requests waiting for at least `age_threshold` cycles override
+    the others, row hits (reads/writes) are then preferred over other commands
+    and ties are broken by age (oldest first, RoundRobin between equal ages).
+    Saturated ages are equal, so the requests that waited that long are served
+    in RoundRobin order.
+
+    With `pipelined`, the candidates are pre-selected a cycle ahead: the
+    filtering/prioritization of the requests is registered before the
+    RoundRobin, so that it is not in the same path as the request selection.
+    The selection is speculative: the granted request is only presented on
+    `cmd` if it is still valid (and wanted), otherwise the RoundRobin moves on.
+
     Parameters
     ----------
     requests : [Endpoint(cmd_request_rw_layout), ...]
         Request streams to consider for arbitration
+    ages : [Signal, ...]
+        Cycles each request has been waiting (None: round-robin only)
+    age_threshold : int
+        Age from which a request overrides the others
+    pipelined : bool
+        Register the candidates before the RoundRobin
 
     Attributes
     ----------
@@ -45,14 +64,17 @@ class _CommandChooser(Module):
         Consider command requests (without ACT)
     want_activates : Signal, in
         Also consider ACT commands
+    avoid : Signal(len(requests)), in
+        Requests to only consider when no other request is valid
     cmd : Endpoint(cmd_request_rw_layout)
         Currently selected request stream (when ~cmd.valid, cas/ras/we are 0)
     """
-    def __init__(self, requests):
+    def __init__(self, requests, ages=None, age_threshold=0, pipelined=False):
         self.want_reads     = Signal()
         self.want_writes    = Signal()
         self.want_cmds      = Signal()
         self.want_activates = Signal()
+        self.avoid          = Signal(len(requests))
 
         a  = len(requests[0].a)
         ba = len(requests[0].ba)
@@ -73,13 +95,55 @@ class _CommandChooser(Module):
             self.comb += valids[i].eq(request.valid & (command | (read & write)))
 
 
+        preferred = Signal(n)
+        self.comb += preferred.eq(valids & ~self.avoid)
+
         arbiter = RoundRobin(n, SP_CE)
         self.submodules += arbiter
         choices = Array(valids[i] for i in range(n))
-        self.comb += [
-            arbiter.request.eq(valids),
-            cmd.valid.eq(choices[arbiter.grant])
-        ]
+        selected = Signal(n)
+        if pipelined:
+            self.sync += arbiter.request.eq(selected)
+        else:
+            self.comb += arbiter.request.eq(selected)
+        if ages is None:
+            self.comb += [
+                If(preferred != 0,
+                    selected.eq(preferred)
+                ).Else(
+                    selected.eq(valids)
+                )
+            ]
+        else:
+            hits = Signal(n)
+            olds = Signal(n)
+            for i, (request, age) in enumerate(zip(requests, ages)):
+                self.comb += [
+                    hits[i].eq(request.is_read | request.is_write),
+                    olds[i].eq(age >= age_threshold),
+                ]
+            candidates = Signal(n)
+            self.comb += [
+                If((valids & olds) != 0,
+                    candidates.eq(valids & olds)
+                ).Elif((preferred & hits) != 0,
+                    candidates.eq(preferred & hits)
+                ).Elif(preferred != 0,
+                    candidates.eq(preferred)
+                ).Else(
+                    candidates.eq(valids)
+                )
+            ]
+            # Only keep the oldest candidates.
+            age_max = Signal.like(ages[0])
+            oldest  = 0
+            for i, age in enumerate(ages):
+                oldest = Mux(candidates[i] & (age > oldest), age, oldest)
+            self.comb += [
+                age_max.eq(oldest),
+                selected.eq(candidates & Cat(*[age == age_max for age in ages])),
+            ]
+        self.comb += cmd.valid.eq(choices[arbiter.grant])
 
         for name in ["a", "ba", "is_read", "is_write", "is_cmd"]:
             choices = Array(getattr(req, name) for req in requests)
@@ -98,9 +162,14 @@ class _CommandChooser(Module):
                 If(cmd.valid & cmd.ready & (arbiter.grant == i),
                     request.ready.eq(1)
                 )
-        # Arbitrate if a command is being accepted or if the command is not valid to ensure a valid
-        # command is selected when cmd.ready goes high.
-        self.comb += arbiter.ce.eq(cmd.ready | ~cmd.valid)
+        # Arbitrate if a command is being accepted or if the command is not requested (not valid or
+        # avoided while others are valid) to ensure a valid command is selected when cmd.ready goes
+        # high. When pipelined, also arbitrate if the pre-selected command is no longer valid.
+        requested = Array(arbiter.request[i] for i in range(n))
+        if pipelined:
+            self.comb += arbiter.ce.eq(cmd.ready | ~requested[arbiter.grant] | ~cmd.valid)
+        else:
+            self.comb += arbiter.ce.eq(cmd.ready | ~requested[arbiter.grant])
 
     # helpers
     def accept(self):
@@ -124,7 +193,7 @@ class _Steerer(Module):
 
     cas/ras/we/is_write/is_read are connected only when `cmd.valid & cmd.ready`.
     Rank bits are decoded and used to drive cs_n in multi-rank systems,
-    STEER_REFRESH always enables all ranks.
+    STEER_REFRESH enables all ranks (or the `refresh_ranks` ones).
 
     Parameters
     ----------
@@ -135,6 +204,8 @@ class _Steerer(Module):
         always considered invalid (because of lack of the `valid` attribute).
     dfi : dfi.Interface
         DFI interface connected to PHY
+    refresh_ranks : Signal(nranks)
+        Ranks enabled by STEER_REFRESH (None: all ranks)
 
     Attributes
     ----------
@@ -143,7 +214,7 @@ class _Steerer(Module):
         DFI phase. The signals should take one of the values from STEER_* to
         select given source.
     """
-    def __init__(self, commands, dfi):
+    def __init__(self, commands, dfi, refresh_ranks=None):
         ncmd = len(commands)
         nph  = len(dfi.phases)
         self.sel = [Signal(max=ncmd) for i in range(nph)]
@@ -169,8 +240,9 @@ class _Steerer(Module):
                 rank_decoder = Decoder(nranks)
                 self.submodules += rank_decoder
                 self.comb += rank_decoder.i.eq((Array(cmd.ba[-rankbits:] for cmd in commands)[sel]))
-                if i == 0: # Select all ranks on refresh.
-                    self.sync += If(sel == STEER_REFRESH, phase.cs_n.eq(0)).Else(phase.cs_n.eq(~rank_decoder.o))
+                if i == 0: # Select all ranks (or the refreshed ones) on refresh.
+                    refresh_cs_n = 0 if refresh_ranks is None else ~refresh_ranks
+                    self.sync += If(sel == STEER_REFRESH, phase.cs_n.eq(refresh_cs_n)).Else(phase.cs_n.eq(~rank_decoder.o))
                 else:
                     self.sync += phase.cs_n.eq(~rank_decoder.o)
                 self.sync += phase.bank.eq(Array(cmd.ba[:-rankbits] for cmd in commands)[sel])
@@ -214,6 +286,18 @@ class Multiplexer(Module, AutoCSR):
         DFI connected to the PHY
     interface : LiteDRAMInterface
         Data interface connected directly to LiteDRAMCrossbar
+
+    Attributes
+    ----------
+    write_high_watermark : CSRStorage, in
+        Pending writes above which reads lose priority (with write batching)
+    write_low_watermark : CSRStorage, in
+        Pending writes down to which writes are drained (with write batching)
+    perf : Record(multiplexer_events_layout), out
+        Events for the performance monitor (with perfmon)
+    writing : Signal(), out
+        Direction currently served (1: writes, 0: reads), hint for the frontends batching
+        their reads/writes (ex. LiteDRAMAXI2Native)
     """
     def __init__(self,
             settings,
@@ -223,6 +307,8 @@ class Multiplexer(Module, AutoCSR):
             interface):
         assert(settings.phy.nphases == len(dfi.phases))
 
+        self.writing = Signal()
+
         ras_allowed = Signal(reset=1)
         cas_allowed = Signal(reset=1)
 
@@ -243,8 +329,11 @@ class Multiplexer(Module, AutoCSR):
 
         # Command choosing -------------------------------------------------------------------------
         requests = [bm.cmd for bm in bank_machines]
-        self.submodules.choose_cmd = choose_cmd = _CommandChooser(requests)
-        self.submodules.choose_req = choose_req = _CommandChooser(requests)
+        age_threshold = getattr(settings, "cmd_age_threshold", None)
+        ages = None if age_threshold is None else [bm.age for bm in bank_machines]
+        pipelined = getattr(settings, "with_pipelined_choosers", False)
+        self.submodules.choose_cmd = choose_cmd = _CommandChooser(requests, ages, age_threshold, pipelined)
+        self.submodules.choose_req = choose_req = _CommandChooser(requests, ages, age_threshold, pipelined)
         if settings.phy.nphases == 1:
             # When only 1 phase, use choose_req for all requests
             choose_cmd = choose_req
@@ -256,34 +345,123 @@ class Multiplexer(Module, AutoCSR):
                                         log2_int(len(bank_machines))))
         # nop must be 1st
         commands = [nop, choose_cmd.cmd, choose_req.cmd, refresher.cmd]
-        steerer = _Steerer(commands, dfi)
+        refresh_per_rank = getattr(settings, "refresh_per_rank", False)
+        steerer = _Steerer(commands, dfi, refresher.ranks if refresh_per_rank else None)
         self.submodules += steerer
 
+        # Bank groups ------------------------------------------------------------------------------
+        # With bank groups (DDR4), tRRD/tCCD/tWTR only apply between commands to the same bank group
+        # and the shorter tRRD_S/tCCD_S/tWTR_S between commands to different bank groups. Choosers
+        # then prefer alternating bank groups.
+        bankbits      = settings.geom.bankbits
+        bankgroupbits = getattr(settings.geom, "bankgroupbits", 0)
+        def bank_group(ba):
+            return ba[bankbits - bankgroupbits:bankbits]
+
+        def bank_group_timing(name):
+            if bankgroupbits == 0:
+                return None
+            return getattr(settings.timing, name + "_S", None)
+
+        def group_ready(txxd, chooser, valid, group, ngroups):
+            # Same group timing, tracked per group for the chooser's current command.
+            controllers = [tXXDController(txxd) for _ in range(ngroups)]
+            self.submodules += controllers
+            for n, controller in enumerate(controllers):
+                self.comb += controller.valid.eq(valid & (group(chooser.cmd.ba) == n))
+            return Array(controller.ready for controller in controllers)[group(chooser.cmd.ba)]
+
+        def bank_group_ready(txxd, chooser, valid):
+            return group_ready(txxd, chooser, valid, bank_group, 2**bankgroupbits)
+
+        if bankgroupbits:
+            def next_bank_group(chooser, valid):
+                last = Signal(bankgroupbits)
+                curr = Signal(bankgroupbits)
+                self.comb += If(valid, curr.eq(bank_group(chooser.cmd.ba))).Else(curr.eq(last))
+                self.sync += last.eq(curr)
+                return curr
+
+            next_cas_group = next_bank_group(choose_req,
+                choose_req.accept() & (choose_req.write() | choose_req.read()))
+            next_act_group = next_bank_group(choose_cmd,
+                choose_cmd.accept() & choose_cmd.activate())
+            avoid = Signal(len(requests))
+            for i, req in enumerate(requests):
+                is_act = req.is_cmd & req.ras & ~req.cas & ~req.we
+                is_cas = req.is_read | req.is_write
+                self.comb += avoid[i].eq(
+                    (is_cas & (bank_group(req.ba) == next_cas_group)) |
+                    (is_act & (bank_group(req.ba) == next_act_group)))
+            self.comb += choose_req.avoid.eq(avoid)
+            if choose_cmd is not choose_req:
+                self.comb += choose_cmd.avoid.eq(avoid)
+
+        # Ranks ------------------------------------------------------------------------------------
+        # With several ranks, tWTR only applies between commands to the same rank: reads to another
+        # rank than the one written to only wait for the data bus turnaround. Reads/writes to a rank
+        # other than the previous one are delayed by tRTRS (rank to rank switch, in DRAM clocks).
+        nranks   = settings.phy.nranks
+        rankbits = log2_int(nranks)
+        def rank(ba):
+            return ba[bankbits:bankbits + rankbits]
+
+        trtrs = math.ceil(getattr(settings, "rank_to_rank_delay", 0)/nphases)
+
         # tRRD timing (Row to Row delay) -----------------------------------------------------------
-        self.submodules.trrdcon = trrdcon = tXXDController(settings.timing.tRRD)
+        trrd_s = bank_group_timing("tRRD")
+        self.submodules.trrdcon = trrdcon = tXXDController(settings.timing.tRRD if trrd_s is None else trrd_s)
         self.comb += trrdcon.valid.eq(choose_cmd.accept() & choose_cmd.activate())
+        trrd_allowed = trrdcon.ready
+        if trrd_s is not None:
+            trrd_allowed = trrd_allowed & bank_group_ready(settings.timing.tRRD, choose_cmd, trrdcon.valid)
 
         # tFAW timing (Four Activate Window) -------------------------------------------------------
         self.submodules.tfawcon = tfawcon = tFAWController(settings.timing.tFAW)
         self.comb += tfawcon.valid.eq(choose_cmd.accept() & choose_cmd.activate())
 
         # RAS control ------------------------------------------------------------------------------
-        self.comb += ras_allowed.eq(trrdcon.ready & tfawcon.ready)
+        self.comb += ras_allowed.eq(trrd_allowed & tfawcon.ready)
 
         # tCCD timing (Column to Column delay) -----------------------------------------------------
-        self.submodules.tccdcon = tccdcon = tXXDController(settings.timing.tCCD)
+        tccd_s = bank_group_timing("tCCD")
+        self.submodules.tccdcon = tccdcon = tXXDController(settings.timing.tCCD if tccd_s is None else tccd_s)
         self.comb += tccdcon.valid.eq(choose_req.accept() & (choose_req.write() | choose_req.read()))
-
-        # CAS control ------------------------------------------------------------------------------
-        self.comb += cas_allowed.eq(tccdcon.ready)
+        tccd_allowed = tccdcon.ready
+        if tccd_s is not None:
+            tccd_allowed = tccd_allowed & bank_group_ready(settings.timing.tCCD, choose_req, tccdcon.valid)
+
+        # tRTRS timing (Rank to Rank switch) -------------------------------------------------------
+        if nranks > 1:
+            self.submodules.trtrscon = trtrscon = tXXDController((settings.timing.tCCD or 1) + trtrs)
+            self.comb += trtrscon.valid.eq(tccdcon.valid)
+            last_rank = Signal(rankbits)
+            self.sync += If(tccdcon.valid, last_rank.eq(rank(choose_req.cmd.ba)))
+            tccd_allowed = tccd_allowed & ((rank(choose_req.cmd.ba) == last_rank) | trtrscon.ready)
 
         # tWTR timing (Write to Read delay) --------------------------------------------------------
         write_latency = math.ceil(settings.phy.cwl / settings.phy.nphases)
-        self.submodules.twtrcon = twtrcon = tXXDController(
-            settings.timing.tWTR + write_latency +
-            # tCCD must be added since tWTR begins after the transfer is complete
-            settings.timing.tCCD if settings.timing.tCCD is not None else 0)
+        def twtr(twtr):
+            return (twtr + write_latency +
+                # tCCD must be added since tWTR begins after the transfer is complete
+                settings.timing.tCCD if settings.timing.tCCD is not None else 0)
+        twtr_s = bank_group_timing("tWTR")
+        twtr_rank = twtr(settings.timing.tWTR if twtr_s is None else twtr_s)
+        self.submodules.twtrcon = twtrcon = tXXDController(twtr_rank if nranks == 1 else twtr(trtrs))
         self.comb += twtrcon.valid.eq(choose_req.accept() & choose_req.write())
+        # Also covers READ entered from REFRESH (without going through WTR).
+        twtr_allowed = ~choose_req.read() | twtrcon.ready
+        if twtr_s is not None:
+            # READ is entered after tWTR_S, reads to bank groups written to also wait for tWTR.
+            twtr_allowed = twtr_allowed & (~choose_req.read() |
+                bank_group_ready(twtr(settings.timing.tWTR), choose_req, twtrcon.valid))
+        if nranks > 1:
+            # READ is entered after the rank switch, reads to the ranks written to also wait for tWTR.
+            twtr_allowed = twtr_allowed & (~choose_req.read() |
+                group_ready(twtr_rank, choose_req, twtrcon.valid, rank, nranks))
+
+        # CAS control ------------------------------------------------------------------------------
+        self.comb += cas_allowed.eq(tccd_allowed & twtr_allowed)
 
         # Read/write turnaround --------------------------------------------------------------------
         read_available = Signal()
@@ -316,11 +494,68 @@ class Multiplexer(Module, AutoCSR):
         read_time_en,   max_read_time = anti_starvation(settings.read_time)
         write_time_en, max_write_time = anti_starvation(settings.write_time)
 
+        # Write batching ---------------------------------------------------------------------------
+        # Without batching, switch to writes when no read is available and back to reads when no
+        # write is available. With batching, reads keep priority until the number of writes queued
+        # in the BankMachines reaches the high watermark, writes are then drained down to the low
+        # watermark (anti-starvation still applies in both cases). Writes that can't be issued (ex.
+        # row not opened yet) never hold the data bus.
+        write_switch = Signal() # Switch from READ to WRITE.
+        write_keep   = Signal() # Stay in WRITE.
+        if getattr(settings, "write_high_watermark", None) is None:
+            self.comb += [
+                write_switch.eq(write_available & (~read_available | max_read_time)),
+                write_keep.eq(write_available),
+            ]
+        else:
+            nwrites = Signal(max=sum(2**len(bm.nwrites) for bm in bank_machines))
+            self.write_high_watermark = CSRStorage(len(nwrites), reset=settings.write_high_watermark)
+            self.write_low_watermark  = CSRStorage(len(nwrites), reset=settings.write_low_watermark)
+            self.comb += [
+                nwrites.eq(reduce(add, [bm.nwrites for bm in bank_machines])),
+                write_switch.eq(write_available & (~read_available | max_read_time |
+                    (nwrites >= self.write_high_watermark.storage))),
+                write_keep.eq(write_available & (nwrites > self.write_low_watermark.storage)),
+            ]
+
+        # Read to Write turnaround -----------------------------------------------------------------
+        # With burst chop, the data bus is released earlier after a half-burst (BC4) READ: the
+        # turnaround then depends on the last READ (A12 cleared for BC4).
+        rtw_latency      = get_rtw_latency(settings.phy)
+        rtw_latency_chop = get_rtw_latency(settings.phy, chop=True)
+        rtw_switch       = [NextState("RTW")]
+        with_rtw_chop    = get_cmd_chop(settings) and (rtw_latency_chop < rtw_latency)
+        if with_rtw_chop:
+            rtw_chop       = Signal()
+            rtw_timer      = Signal(max=rtw_latency)
+            last_read_chop = Signal()
+            read_accepted  = choose_req.accept() & choose_req.read()
+            self.comb += rtw_chop.eq(Mux(read_accepted, ~choose_req.cmd.a[12], last_read_chop))
+            self.sync += If(read_accepted, last_read_chop.eq(~choose_req.cmd.a[12]))
+            if rtw_latency_chop > 1:
+                rtw_switch = [
+                    NextValue(rtw_timer, Mux(rtw_chop, rtw_latency_chop - 1, rtw_latency - 1)),
+                    NextState("RTW")
+                ]
+            else:
+                rtw_switch = [
+                    NextValue(rtw_timer, rtw_latency - 1),
+                    If(rtw_chop, NextState("WRITE")).Else(NextState("RTW"))
+                ]
+
         # Refresh ----------------------------------------------------------------------------------
-        self.comb += [bm.refresh_req.eq(refresher.cmd.valid) for bm in bank_machines]
         go_to_refresh = Signal()
-        bm_refresh_gnts = [bm.refresh_gnt for bm in bank_machines]
-        self.comb += go_to_refresh.eq(reduce(and_, bm_refresh_gnts))
+        if getattr(settings, "refresh_per_bank", False) or refresh_per_rank:
+            # Per-bank/per-rank refresh: only the BankMachines targeted by the Refresher are locked,
+            # the refresh is issued once they are granted (and tRRD/tFAW allow it).
+            bank_lock = refresher.bank_lock
+            self.comb += [bm.refresh_req.eq(bank_lock[n]) for n, bm in enumerate(bank_machines)]
+            bm_refresh_gnts = [bm.refresh_gnt | ~bank_lock[n] for n, bm in enumerate(bank_machines)]
+            self.comb += go_to_refresh.eq(refresher.cmd.valid & ras_allowed & reduce(and_, bm_refresh_gnts))
+        else:
+            self.comb += [bm.refresh_req.eq(refresher.cmd.valid) for bm in bank_machines]
+            bm_refresh_gnts = [bm.refresh_gnt for bm in bank_machines]
+            self.comb += go_to_refresh.eq(reduce(and_, bm_refresh_gnts))
 
         # Datapath ---------------------------------------------------------------------------------
         all_rddata = [p.rddata for p in dfi.phases]
@@ -358,11 +593,9 @@ class Multiplexer(Module, AutoCSR):
                 choose_req.cmd.ready.eq(cas_allowed)
             ),
             steerer_sel(steerer, access="read"),
-            If(write_available,
-                # TODO: switch only after several cycles of ~read_available?
-                If(~read_available | max_read_time,
-                    NextState("RTW")
-                )
+            # TODO: switch only after several cycles of ~read_available?
+            If(write_switch,
+                *rtw_switch
             ),
             If(go_to_refresh,
                 NextState("REFRESH")
@@ -380,7 +613,7 @@ class Multiplexer(Module, AutoCSR):
             ),
             steerer_sel(steerer, access="write"),
             If(read_available,
-                If(~write_available | max_write_time,
+                If(~write_keep | max_write_time,
                     NextState("WTR")
                 )
             ),
@@ -400,8 +633,33 @@ class Multiplexer(Module, AutoCSR):
                 NextState("READ")
             )
         )
-        # TODO: reduce this, actual limit is around (cl+1)/nphases
-        fsm.delayed_enter("RTW", "WRITE", settings.phy.read_latency-1)
+        if with_rtw_chop:
+            fsm.act("RTW",
+                NextValue(rtw_timer, rtw_timer - 1),
+                If(rtw_timer == 1,
+                    NextState("WRITE")
+                )
+            )
+        else:
+            fsm.delayed_enter("RTW", "WRITE", rtw_latency - 1)
+
+        # Direction hint ---------------------------------------------------------------------------
+        # Writes are served from the read to write turnaround until the write to read one.
+        self.comb += self.writing.eq(~(fsm.ongoing("READ") | fsm.ongoing("WTR") | fsm.ongoing("REFRESH")))
+
+        # Performance monitoring -------------------------------------------------------------------
+        if getattr(settings, "with_perfmon", False):
+            self.perf = perf = Record(multiplexer_events_layout)
+            self.comb += [
+                perf.read.eq(fsm.ongoing("READ")),
+                perf.write.eq(fsm.ongoing("WRITE")),
+                perf.refresh.eq(fsm.ongoing("REFRESH")),
+                perf.turnaround.eq(~perf.read & ~perf.write & ~perf.refresh),
+                perf.rtw.eq(perf.read & write_switch & ~go_to_refresh),
+                perf.wtr.eq(perf.write & read_available & (~write_keep | max_write_time) & ~go_to_refresh),
+                perf.refresh_stall.eq(refresher.cmd.valid),
+            ]
+            self.submodules.perfmon = PerfMonitor([bm.perf for bm in bank_machines], perf)
 
         if settings.with_bandwidth:
             data_width = settings.phy.dfi_databits*settings.phy.nphases
@@ -0,0 +1,178 @@
+#
+# This file is part of LiteDRAM.
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+"""LiteDRAM Performance Monitor."""
+
+from functools import reduce
+from operator import add
+
+from migen import *
+
+from litex.soc.interconnect.csr import *
+
+# Layouts ------------------------------------------------------------------------------------------
+
+def bank_events_layout(depth):
+    return [
+        ("row_hit",      1),               # Request targeting the opened row.
+        ("row_miss",     1),               # Request targeting a closed bank.
+        ("row_conflict", 1),               # Request targeting another row than the opened one.
+        ("activate",     1),               # ACTIVATE issued.
+        ("precharge",    1),               # PRECHARGE issued (explicit or auto-precharge).
+        ("level",        bits_for(depth)), # Number of requests in the command buffer.
+    ]
+
+multiplexer_events_layout = [
+    ("read",          1), # Multiplexer in READ state.
+    ("write",         1), # Multiplexer in WRITE state.
+    ("refresh",       1), # Multiplexer in REFRESH state.
+    ("turnaround",    1), # Multiplexer in RTW/WTR states.
+    ("rtw",           1), # Switch from READ to WRITE.
+    ("wtr",           1), # Switch from WRITE to READ.
+    ("refresh_stall", 1), # Refresh pending or in progress.
+]
+
+# PerfMonitor --------------------------------------------------------------------------------------
+
+class PerfMonitor(Module, AutoCSR):
+    """Counts LiteDRAM controller events
+
+    This module counts the events reported by the BankMachines and the
+    Multiplexer during a fixed time period, per BankMachine and in aggregate.
+    All counters are registered at the end of each period, so that a snapshot
+    of the last finished period is copied to the status registers when user
+    writes to the `update` register. Per-BankMachine counters are copied for
+    the BankMachine selected by `bank`.
+
+    Average command buffer occupancy can be computed as:
+        occupancy = occupancy_sum / 2^period_bits
+
+    Parameters
+    ----------
+    bank_events : [Record(bank_events_layout), ...]
+        Events reported by each BankMachine
+    multiplexer_events : Record(multiplexer_events_layout)
+        Events reported by the Multiplexer
+    period_bits : int, in
+        Defines length of measurement period = 2^period_bits
+
+    Attributes
+    ----------
+    update : CSR, in
+        Copy the values from last finished period to the status registers
+    bank : CSRStorage, in
+        BankMachine whose counters are copied to the `bank_*` status registers
+    bank_row_hits, row_hits : CSRStatus, out
+        Number of requests targeting the opened row
+    bank_row_misses, row_misses : CSRStatus, out
+        Number of requests targeting a closed bank
+    bank_row_conflicts, row_conflicts : CSRStatus, out
+        Number of requests targeting another row than the opened one
+    bank_activates, activates : CSRStatus, out
+        Number of ACTIVATE commands
+    bank_precharges, precharges : CSRStatus, out
+        Number of PRECHARGE commands (including auto-precharges)
+    bank_occupancy_sum, occupancy_sum : CSRStatus, out
+        Sum over the period of the number of requests in the command buffers
+    refresh_stalls : CSRStatus, out
+        Number of cycles with a refresh pending or in progress
+    rtw_turnarounds : CSRStatus, out
+        Number of READ to WRITE switches
+    wtr_turnarounds : CSRStatus, out
+        Number of WRITE to READ switches
+    read_cycles : CSRStatus, out
+        Number of cycles spent in the Multiplexer READ state
+    write_cycles : CSRStatus, out
+        Number of cycles spent in the Multiplexer WRITE state
+    refresh_cycles : CSRStatus, out
+        Number of cycles spent in the Multiplexer REFRESH state
+    turnaround_cycles : CSRStatus, out
+        Number of cycles spent in the Multiplexer RTW/WTR states
+    """
+    def __init__(self, bank_events, multiplexer_events, period_bits=24):
+        nbanks     = len(bank_events)
+        level_bits = len(bank_events[0].level)
+        bank_bits  = bits_for(nbanks)
+
+        self.update = CSR()
+        self.bank   = CSRStorage(bits_for(nbanks - 1))
+
+        self.bank_row_hits      = CSRStatus(period_bits + 1)
+        self.bank_row_misses    = CSRStatus(period_bits + 1)
+        self.bank_row_conflicts = CSRStatus(period_bits + 1)
+        self.bank_activates     = CSRStatus(period_bits + 1)
+        self.bank_precharges    = CSRStatus(period_bits + 1)
+        self.bank_occupancy_sum = CSRStatus(period_bits + level_bits)
+
+        self.row_hits      = CSRStatus(period_bits + bank_bits)
+        self.row_misses    = CSRStatus(period_bits + bank_bits)
+        self.row_conflicts = CSRStatus(period_bits + bank_bits)
+        self.activates     = CSRStatus(period_bits + bank_bits)
+        self.precharges    = CSRStatus(period_bits + bank_bits)
+        self.occupancy_sum = CSRStatus(period_bits + level_bits + bank_bits)
+
+        self.refresh_stalls    = CSRStatus(period_bits + 1)
+        self.rtw_turnarounds   = CSRStatus(period_bits + 1)
+        self.wtr_turnarounds   = CSRStatus(period_bits + 1)
+        self.read_cycles       = CSRStatus(period_bits + 1)
+        self.write_cycles      = CSRStatus(period_bits + 1)
+        self.refresh_cycles    = CSRStatus(period_bits + 1)
+        self.turnaround_cycles = CSRStatus(period_bits + 1)
+
+        # # #
+
+        # Register the events to ease timings.
+        banks = [Record(bank.layout) for bank in bank_events]
+        mux   = Record(multiplexer_events.layout)
+        self.sync += [bank_r.raw_bits().eq(bank.raw_bits()) for bank_r, bank in zip(banks, bank_events)]
+        self.sync += mux.raw_bits().eq(multiplexer_events.raw_bits())
+
+        counter = Signal(period_bits)
+        period  = Signal()
+        self.sync += Cat(counter, period).eq(counter + 1)
+
+        def count(csr, increment):
+            # Counter registered at the end of each period (without missing the event on the
+            # period boundary).
+            value   = Signal(len(csr.status))
+            value_r = Signal(len(csr.status))
+            self.sync += [
+                If(period,
+                    value_r.eq(value),
+                    value.eq(increment)
+                ).Else(
+                    value.eq(value + increment)
+                )
+            ]
+            return value_r
+
+        # Per-BankMachine and aggregate counters ---------------------------------------------------
+        for name, field in [
+            ("row_hits",      "row_hit"),
+            ("row_misses",    "row_miss"),
+            ("row_conflicts", "row_conflict"),
+            ("activates",     "activate"),
+            ("precharges",    "precharge"),
+            ("occupancy_sum", "level")]:
+            bank_csr = getattr(self, "bank_" + name)
+            bank_values = Array(count(bank_csr, getattr(bank, field)) for bank in banks)
+            total_value = count(getattr(self, name), reduce(add, [getattr(bank, field) for bank in banks]))
+            self.sync += If(self.update.wr_stb,
+                bank_csr.status.eq(bank_values[self.bank.storage]),
+                getattr(self, name).status.eq(total_value)
+            )
+
+        # Multiplexer counters ---------------------------------------------------------------------
+        for name, field in [
+            ("refresh_stalls",    "refresh_stall"),
+            ("rtw_turnarounds",   "rtw"),
+            ("wtr_turnarounds",   "wtr"),
+            ("read_cycles",       "read"),
+            ("write_cycles",      "write"),
+            ("refresh_cycles",    "refresh"),
+            ("turnaround_cycles", "turnaround")]:
+            csr   = getattr(self, name)
+            value = count(csr, getattr(mux, field))
+            self.sync += If(self.update.wr_stb, csr.status.eq(value))
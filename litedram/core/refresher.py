@@ -69,6 +69,50 @@ class RefreshExecuter(Module):
             ])
         ]
 
+# RefreshPerBankExecuter ---------------------------------------------------------------------------
+
+class RefreshPerBankExecuter(Module):
+    """Per-Bank Refresh Executer
+
+    Execute a per-bank refresh (REFpb) to the DRAM (LPDDR4/LPDDR5):
+    - Send a "Per-Bank Refresh" command to the targeted bank (already precharged by its BankMachine)
+    - Wait tRRD
+    """
+    def __init__(self, cmd, bank, trrd):
+        self.start = Signal()
+        self.done  = Signal()
+
+        # # #
+
+        self.sync += [
+            cmd.a.eq(  0),
+            cmd.ba.eq( 0),
+            cmd.cas.eq(0),
+            cmd.ras.eq(0),
+            cmd.we.eq( 0),
+            self.done.eq(0),
+            # Wait start
+            timeline(self.start, [
+                # Per-Bank Refresh
+                (0, [
+                    cmd.a.eq(  0),     # A10 low: single bank
+                    cmd.ba.eq( bank),
+                    cmd.cas.eq(1),
+                    cmd.ras.eq(1),
+                    cmd.we.eq( 0),
+                ]),
+                # Done after tRRD
+                (trrd, [
+                    cmd.a.eq(  0),
+                    cmd.ba.eq( 0),
+                    cmd.cas.eq(0),
+                    cmd.ras.eq(0),
+                    cmd.we.eq( 0),
+                    self.done.eq(1),
+                ]),
+            ])
+        ]
+
 # RefreshSequencer ---------------------------------------------------------------------------------
 
 class RefreshSequencer(Module):
@@ -153,6 +197,36 @@ class RefreshPostponer(Module):
             )
         ]
 
+# RefreshCredit ------------------------------------------------------------------------------------
+
+class RefreshCredit(Module):
+    """Refresh Credit
+
+    Track the refreshes done in advance (positive credit, up to `pull_in`) or postponed (negative
+    credit, up to `postponing`). Generate a request while the controller is idle and the credit is
+    not full, or when the maximum number of postponed refreshes is reached. A tREFI elapsing
+    before the forced refresh is done is still accounted (the credit saturates one step further).
+    """
+    def __init__(self, postponing=1, pull_in=8):
+        self.req_i  = Signal() # tREFI elapsed.
+        self.done   = Signal() # Refresh executed.
+        self.idle   = Signal() # Controller idle.
+        self.req_o  = Signal()
+        self.credit = Signal(min=-postponing - 1, max=pull_in + 1)
+
+        # # #
+
+        self.sync += [
+            If(self.req_i & ~self.done,
+                If(self.credit != -postponing - 1,
+                    self.credit.eq(self.credit - 1)
+                )
+            ).Elif(self.done & ~self.req_i,
+                self.credit.eq(self.credit + 1)
+            )
+        ]
+        self.comb += self.req_o.eq((self.credit <= -postponing) | (self.idle & (self.credit < pull_in)))
+
 # ZQCSExecuter ----------------------------------------------------------------------------------
 
 class ZQCSExecuter(Module):
@@ -218,6 +292,19 @@ class Refresher(Module):
     this allows the Controller to finish the current transaction and block next transactions. Once all
     transactions are done, the Refresher can execute the refresh Sequence and release the Controller.
 
+    With `settings.refresh_pull_in`, a refresh credit is tracked instead: refreshes are issued in
+    advance (up to `refresh_pull_in`) while the Controller is `idle` and postponed (up to
+    `postponing`) while it is busy.
+
+    With `settings.refresh_per_bank` (LPDDR4/LPDDR5), per-bank refreshes (REFpb) are rotated across
+    the banks every tREFI/nbanks instead. Only the BankMachines of the targeted bank (`bank_lock`)
+    are locked: they precharge their bank and stay locked for tRFCpb, while the other banks keep
+    being accessed. On LPDDR5 with 16 banks, a REFpb refreshes the (n, n+8) banks pair.
+
+    With `settings.refresh_per_rank` (multi-rank), refreshes are similarly staggered across the
+    ranks every tREFI/nranks. Only the BankMachines of the targeted rank are locked (`bank_lock`)
+    until tRFC after the refresh, and the refresh commands are only sent to this rank (`ranks`),
+    so that the other ranks keep being accessed.
     """
     def __init__(self, settings, clk_freq, zqcs_freq=1e0, postponing=1):
         assert postponing <= 8
@@ -225,6 +312,31 @@ class Refresher(Module):
         babits = settings.geom.bankbits + log2_int(settings.phy.nranks)
         self.cmd = cmd = stream.Endpoint(cmd_request_rw_layout(a=abits, ba=babits))
 
+        per_bank = getattr(settings, "refresh_per_bank", False)
+        if per_bank:
+            if settings.phy.memtype not in ["LPDDR4", "LPDDR5"]:
+                raise ValueError("Per-bank refresh is only supported on LPDDR4/LPDDR5.")
+            if postponing != 1:
+                raise ValueError("Refresh postponing is not supported with per-bank refresh.")
+            self.bank_lock = Signal(2**babits)
+
+        per_rank = getattr(settings, "refresh_per_rank", False)
+        if per_rank:
+            nranks = settings.phy.nranks
+            if nranks == 1:
+                raise ValueError("Per-rank refresh requires several ranks.")
+            if per_bank:
+                raise ValueError("Per-rank refresh can't be combined with per-bank refresh.")
+            if postponing != 1:
+                raise ValueError("Refresh postponing is not supported with per-rank refresh.")
+            self.bank_lock = Signal(2**babits)
+            self.ranks     = Signal(nranks)
+
+        pull_in = getattr(settings, "refresh_pull_in", 0)
+        if pull_in:
+            assert pull_in <= 8
+            self.idle = Signal()
+
         # # #
 
         wants_refresh = Signal()
@@ -233,19 +345,44 @@ class Refresher(Module):
         # Refresh Timer ----------------------------------------------------------------------------
         if settings.timing.tREFI < 100: # FIXME: Reduce Margin.
             raise ValueError("Clk/tREFI is ratio too low , please increase Clk frequency or disable Refresh.")
-        timer = RefreshTimer(settings.timing.tREFI)
+        trefi = settings.timing.tREFI
+        if per_bank:
+            # REFpb addresses the banks with BA0-2.
+            nrefbanks = min(2**settings.geom.bankbits, 8)
+            trefi     = trefi//nrefbanks
+        if per_rank:
+            # Each rank is still refreshed every tREFI.
+            trefi = trefi//nranks
+        timer = RefreshTimer(trefi)
         self.submodules.timer = timer
         self.comb += timer.wait.eq(~timer.done)
 
         # Refresh Postponer ------------------------------------------------------------------------
-        postponer = RefreshPostponer(postponing)
+        if pull_in:
+            postponer = RefreshCredit(postponing, pull_in)
+            self.comb += postponer.idle.eq(self.idle)
+        else:
+            postponer = RefreshPostponer(postponing)
         self.submodules.postponer = postponer
         self.comb += postponer.req_i.eq(self.timer.done)
         self.comb += wants_refresh.eq(postponer.req_o)
 
         # Refresh Sequencer ------------------------------------------------------------------------
-        sequencer = RefreshSequencer(cmd, settings.timing.tRP, settings.timing.tRFC, postponing)
+        if per_bank:
+            bank      = Signal(max=nrefbanks)
+            sequencer = RefreshPerBankExecuter(cmd, bank, max(settings.timing.tRRD or 1, 1))
+        elif per_rank:
+            # The rank is kept locked for tRFC by the FSM, releasing the commands right after the
+            # Auto Refresh.
+            rank      = Signal(max=nranks)
+            sequencer = RefreshExecuter(cmd, settings.timing.tRP, 1)
+        else:
+            # With a refresh credit, refreshes are executed one at a time.
+            count     = 1 if pull_in else postponing
+            sequencer = RefreshSequencer(cmd, settings.timing.tRP, settings.timing.tRFC, count)
         self.submodules.sequencer = sequencer
+        if pull_in:
+            self.comb += postponer.done.eq(sequencer.done)
 
         if settings.timing.tZQCS is not None:
             # ZQCS Timer ---------------------------------------------------------------------------
@@ -274,7 +411,69 @@ class Refresher(Module):
                 NextState("DO-REFRESH")
             )
         )
-        if settings.timing.tZQCS is None:
+        if per_bank or per_rank:
+            # The targeted bank/rank stays locked for tRFCpb/tRFC after the refresh, ZQCS locks all
+            # the banks.
+            if per_bank:
+                target = bank
+                trfc   = settings.timing.tRFCpb
+                if trfc is None:
+                    trfc = settings.timing.tRFC
+            else:
+                target = rank
+                trfc   = settings.timing.tRFC - 1 # Auto Refresh issued the cycle before done.
+            fsm.act("DO-REFRESH",
+                cmd.valid.eq(1),
+                If(sequencer.done,
+                    cmd.valid.eq(0),
+                    cmd.last.eq(1),
+                    NextState("TRFC")
+                )
+            )
+            fsm.delayed_enter("TRFC", "NEXT", trfc)
+            lock_all = Signal()
+            if settings.timing.tZQCS is None:
+                fsm.act("NEXT",
+                    NextValue(target, target + 1),
+                    NextState("IDLE")
+                )
+            else:
+                fsm.act("NEXT",
+                    NextValue(target, target + 1),
+                    If(wants_zqcs,
+                        NextState("WAIT-BANK-MACHINES-ZQCS")
+                    ).Else(
+                        NextState("IDLE")
+                    )
+                )
+                fsm.act("WAIT-BANK-MACHINES-ZQCS",
+                    cmd.valid.eq(1),
+                    If(cmd.ready,
+                        zqcs_executer.start.eq(1),
+                        NextState("DO-ZQCS")
+                    )
+                )
+                fsm.act("DO-ZQCS",
+                    cmd.valid.eq(1),
+                    If(zqcs_executer.done,
+                        cmd.valid.eq(0),
+                        cmd.last.eq(1),
+                        NextState("IDLE")
+                    )
+                )
+                self.comb += lock_all.eq(fsm.ongoing("WAIT-BANK-MACHINES-ZQCS") | fsm.ongoing("DO-ZQCS"))
+            lock = Signal()
+            self.comb += lock.eq(~fsm.ongoing("IDLE") & ~lock_all)
+            if per_bank:
+                for n in range(2**babits):
+                    self.comb += self.bank_lock[n].eq(lock_all | (lock & (bank == (n % nrefbanks))))
+            else:
+                bankbits = settings.geom.bankbits
+                for n in range(2**babits):
+                    self.comb += self.bank_lock[n].eq(lock_all | (lock & (rank == (n >> bankbits))))
+                for r in range(nranks):
+                    self.comb += self.ranks[r].eq(lock_all | (rank == r))
+        elif settings.timing.tZQCS is None:
             fsm.act("DO-REFRESH",
                 cmd.valid.eq(1),
                 If(sequencer.done,
@@ -13,7 +13,7 @@ from litex.soc.interconnect.csr import *
 # PhaseInjector ------------------------------------------------------------------------------------
 
 class PhaseInjector(Module, AutoCSR):
-    def __init__(self, phase):
+    def __init__(self, phase, burst_chop=False):
         self._command       = CSRStorage(fields=[
             CSRField("cs",   size=1, description="DFI chip select bus"),
             CSRField("we",   size=1, description="DFI write enable bus"),
@@ -61,12 +61,19 @@ class PhaseInjector(Module, AutoCSR):
             phase.wrdata.eq(self._wrdata.storage),
             phase.wrdata_mask.eq(0)
         ]
+        if burst_chop:
+            # MR0 in on-the-fly BL8/BC4 mode: keep software READ/WRITE commands in BL8 (A12 set).
+            assert len(phase.address) > 12
+            self.comb += If(self._command.fields.cas & ~self._command.fields.ras,
+                phase.address[12].eq(1)
+            )
         self.sync += If(phase.rddata_valid, self._rddata.status.eq(phase.rddata))
 
 # DFIInjector --------------------------------------------------------------------------------------
 
 class DFIInjector(Module, AutoCSR):
-    def __init__(self, addressbits, bankbits, nranks, databits, nphases=1, is_clam_shell=False):
+    def __init__(self, addressbits, bankbits, nranks, databits, nphases=1, is_clam_shell=False,
+        burst_chop=False):
         self.slave   = dfi.Interface(addressbits, bankbits, nranks, databits, nphases)
         self.master  = dfi.Interface(addressbits, bankbits, nranks*2 if is_clam_shell else nranks, databits, nphases)
         csr_dfi      = dfi.Interface(addressbits, bankbits, nranks*2 if is_clam_shell else nranks, databits, nphases)
@@ -85,7 +92,7 @@ class DFIInjector(Module, AutoCSR):
         ], description="Control DFI signals common to all phases")
 
         for n, phase in enumerate(csr_dfi.phases):
-            setattr(self.submodules, "pi" + str(n), PhaseInjector(phase))
+            setattr(self.submodules, "pi" + str(n), PhaseInjector(phase, burst_chop))
 
         # # #
 
@@ -21,6 +21,9 @@ class LiteDRAMNativePortCDC(Module):
         assert port_from.address_width == port_to.address_width
         assert port_from.data_width    == port_to.data_width
         assert port_from.mode          == port_to.mode
+        assert port_from.burst_width   == port_to.burst_width
+        assert port_from.with_chop     == port_to.with_chop
+        assert port_from.with_atomics  == port_to.with_atomics
 
         address_width = port_from.address_width
         data_width    = port_from.data_width
@@ -29,7 +32,8 @@ class LiteDRAMNativePortCDC(Module):
         # # #
 
         cmd_cdc = stream.ClockDomainCrossing(
-            layout  = [("we", 1), ("addr", address_width)],
+            layout  = cmd_description(address_width, port_from.burst_width, port_from.with_chop,
+                port_from.with_atomics),
             cd_from = port_from.clock_domain,
             cd_to   = port_to.clock_domain,
             depth   = cmd_depth,
@@ -39,7 +43,7 @@ class LiteDRAMNativePortCDC(Module):
 
         if mode in ["write", "both"]:
             wdata_cdc = stream.ClockDomainCrossing(
-                layout  = [("data", data_width), ("we", data_width//8)],
+                layout  = wdata_description(data_width, port_from.with_atomics),
                 cd_from = port_from.clock_domain,
                 cd_to   = port_to.clock_domain,
                 depth   = wdata_depth,
@@ -57,6 +61,298 @@ class LiteDRAMNativePortCDC(Module):
             self.submodules += rdata_cdc
             self.submodules += stream.Pipeline(port_to.rdata, rdata_cdc, port_from.rdata)
 
+# LiteDRAMNativePortWriteBuffer --------------------------------------------------------------------
+
+class LiteDRAMNativePortWriteBuffer(Module):
+    """LiteDRAM port posted write buffer
+
+    This module decouples the write data of the user from the scheduling of
+    the writes by the controller:
+    - Write data is accepted from the user as soon as there is space in the
+      buffer, before or after its command.
+    - Commands are queued in order and a write is only presented to the
+      controller once its data is resident in the buffer, so the data is
+      always available when the controller requests it.
+    - Bursts are only presented once all their data is resident, so the
+      depth must be at least the maximum burst length.
+    - Atomic commands are buffered as writes.
+    """
+    def __init__(self, port_from, port_to, depth=16):
+        assert port_from.clock_domain == port_to.clock_domain
+        assert port_from.address_width == port_to.address_width
+        assert port_from.data_width    == port_to.data_width
+        assert port_from.mode          == port_to.mode
+        assert port_from.burst_width   == port_to.burst_width
+        assert port_from.with_chop     == port_to.with_chop
+        assert port_from.with_atomics  == port_to.with_atomics
+        assert depth >= 2**port_from.burst_width
+
+        address_width = port_from.address_width
+        data_width    = port_from.data_width
+
+        # # #
+
+        cmd_buffer = stream.SyncFIFO(cmd_description(address_width, port_from.burst_width,
+            port_from.with_chop, port_from.with_atomics), depth)
+        wdata_buffer = stream.SyncFIFO(wdata_description(data_width, port_from.with_atomics), depth)
+        self.submodules += cmd_buffer, wdata_buffer
+        self.comb += [
+            port_from.cmd.connect(cmd_buffer.sink, omit={"first", "last"}),
+            port_from.wdata.connect(wdata_buffer.sink, omit={"first", "last"}),
+            wdata_buffer.source.connect(port_to.wdata, omit={"first", "last"}),
+            port_to.rdata.connect(port_from.rdata),
+            port_to.flush.eq(port_from.flush),
+            port_from.lock.eq(port_to.lock),
+        ]
+
+        # Number of buffered write data not yet claimed by a write command.
+        credits  = Signal(max=depth + 1)
+        released = Signal()
+        words    = 1
+        if port_from.burst_width:
+            words = cmd_buffer.source.burst + 1
+            self.comb += port_to.cmd.burst.eq(cmd_buffer.source.burst)
+        if port_from.with_chop:
+            self.comb += [
+                port_to.cmd.chop.eq(cmd_buffer.source.chop),
+                port_to.cmd.chop_upper.eq(cmd_buffer.source.chop_upper),
+            ]
+        if port_from.with_atomics:
+            self.comb += port_to.cmd.atomic.eq(cmd_buffer.source.atomic)
+        self.comb += [
+            released.eq(~cmd_buffer.source.we | (credits >= words)),
+            port_to.cmd.valid.eq(cmd_buffer.source.valid & released),
+            port_to.cmd.we.eq(cmd_buffer.source.we),
+            port_to.cmd.addr.eq(cmd_buffer.source.addr),
+            cmd_buffer.source.ready.eq(port_to.cmd.ready & released),
+        ]
+        self.sync += credits.eq(credits +
+            (wdata_buffer.sink.valid & wdata_buffer.sink.ready) -
+            Mux(port_to.cmd.valid & port_to.cmd.ready & port_to.cmd.we, words, 0))
+
+# LiteDRAMNativePortBurstCoalescer -----------------------------------------------------------------
+
+class LiteDRAMNativePortBurstCoalescer(Module):
+    """LiteDRAM port burst coalescer
+
+    This module merges single-word commands into burst commands of a port:
+    - Commands of the same direction to consecutive addresses are gathered
+      into a burst, up to the `2**burst_width` words boundary.
+    - A burst is presented on `source` as soon as the next command can't
+      extend it (no command, other direction/address, or `last` set), so
+      the commands are delayed by one cycle. Once presented, it is no longer
+      extended.
+    - Users are responsible for the data of the gathered words (e.g. write
+      data has to be resident before its command is accepted on `sink`),
+      `words` gives the number of words gathered and not yet accepted on
+      `source`.
+    """
+    def __init__(self, address_width, burst_width):
+        assert burst_width > 0
+        self.sink   = sink   = stream.Endpoint([("we", 1), ("addr", address_width)])
+        self.source = source = stream.Endpoint(cmd_description(address_width, burst_width))
+        self.words  = Signal(max=2**burst_width + 1)
+
+        # # #
+
+        pending   = Signal()
+        presented = Signal()
+        next_addr = Signal(address_width)
+        extend    = Signal()
+        self.comb += [
+            next_addr.eq(source.addr + source.burst + 1),
+            extend.eq(sink.valid & pending & ~presented & ~source.last &
+                (sink.we == source.we) &
+                (sink.addr == next_addr) &
+                (next_addr[:burst_width] != 0)),
+            source.valid.eq(pending & ~extend),
+            sink.ready.eq(~pending | extend | source.ready),
+            self.words.eq(Mux(pending, source.burst + 1, 0)),
+        ]
+        self.sync += [
+            If(sink.valid & sink.ready,
+                pending.eq(1),
+                source.last.eq(sink.last),
+                If(extend,
+                    source.burst.eq(source.burst + 1)
+                ).Else(
+                    source.we.eq(sink.we),
+                    source.addr.eq(sink.addr),
+                    source.burst.eq(0)
+                )
+            ).Elif(source.valid & source.ready,
+                pending.eq(0)
+            ),
+            presented.eq(source.valid & ~source.ready)
+        ]
+
+# LiteDRAMNativePortAtomic -------------------------------------------------------------------------
+
+class LiteDRAMNativePortAtomic(Module):
+    """LiteDRAM port atomic unit
+
+    This module executes the atomic commands of a port (`cmd.atomic`, see
+    `atomic_ops`) as read-modify-writes on the controller side of a crossbar
+    port:
+    - An atomic command is a write (`cmd.we` set) taking one write data (the
+      operand in `data`, the compare value of CAS in `compare`, the enabled
+      bytes in `we`) and returning one read data (the previous content of
+      the word).
+    - Operations are done independently on each `atomic_width` bits lane of
+      the word and the results are only written to the enabled bytes. CAS
+      only writes when all the enabled bytes match the compare value.
+    - The pending commands of the port are completed first, then the word is
+      read and written back while `hold` keeps the bank granted to the port
+      by the crossbar: no other port can access the bank in between and the
+      row stays open.
+    - Other commands are passed through.
+    """
+    def __init__(self, port_from, port_to, atomic_width=32):
+        assert port_from.clock_domain == port_to.clock_domain
+        assert port_from.address_width == port_to.address_width
+        assert port_from.data_width    == port_to.data_width
+        assert port_from.mode          == port_to.mode == "both"
+        assert port_from.burst_width   == port_to.burst_width
+        assert port_from.with_chop     == port_to.with_chop
+        assert port_from.with_atomics and not port_to.with_atomics
+        assert port_from.data_width % atomic_width == 0
+
+        data_width = port_from.data_width
+        nlanes     = data_width//atomic_width
+
+        # # #
+
+        addr    = Signal(port_from.address_width)
+        op      = Signal(3)
+        operand = Signal(data_width)
+        compare = Signal(data_width)
+        we      = Signal(data_width//8)
+        old     = Signal(data_width)
+        new     = Signal(data_width)
+        mask    = Signal(data_width)
+        match   = Signal()
+
+        wdata_done = Signal()
+        rdata_done = Signal()
+
+        # Pending words of the passed through commands.
+        pending  = Signal(16)
+        words    = 1
+        if port_from.burst_width:
+            words = port_to.cmd.burst + 1
+
+        # Operations -------------------------------------------------------------------------------
+        for i in range(nlanes):
+            lane     = slice(i*atomic_width, (i + 1)*atomic_width)
+            a, b     = old[lane], operand[lane]
+            a_signed = Signal((atomic_width, True))
+            b_signed = Signal((atomic_width, True))
+            self.comb += [
+                a_signed.eq(a),
+                b_signed.eq(b),
+                Case(op, {
+                    atomic_ops["add"]:  new[lane].eq(a + b),
+                    atomic_ops["swap"]: new[lane].eq(b),
+                    atomic_ops["cas"]:  new[lane].eq(b),
+                    atomic_ops["min"]:  new[lane].eq(Mux(a_signed < b_signed, a, b)),
+                    atomic_ops["max"]:  new[lane].eq(Mux(a_signed > b_signed, a, b)),
+                    atomic_ops["minu"]: new[lane].eq(Mux(a < b, a, b)),
+                    atomic_ops["maxu"]: new[lane].eq(Mux(a > b, a, b)),
+                })
+            ]
+        self.comb += [
+            mask.eq(Cat(*[Replicate(we[i], 8) for i in range(data_width//8)])),
+            match.eq(((old ^ compare) & mask) == 0),
+        ]
+
+        # FSM --------------------------------------------------------------------------------------
+        self.submodules.fsm = fsm = FSM(reset_state="IDLE")
+        fsm.act("IDLE",
+            NextValue(wdata_done, 0),
+            NextValue(rdata_done, 0),
+            port_from.wdata.connect(port_to.wdata, omit={"compare"}),
+            port_to.rdata.connect(port_from.rdata),
+            If(port_from.cmd.valid & (port_from.cmd.atomic != 0),
+                # Wait for the pending commands.
+                If(pending == 0,
+                    NextState("READ")
+                )
+            ).Else(
+                port_from.cmd.connect(port_to.cmd, omit={"atomic"})
+            )
+        )
+        fsm.act("READ",
+            port_to.hold.eq(1),
+            port_to.cmd.valid.eq(1),
+            port_to.cmd.we.eq(0),
+            port_to.cmd.addr.eq(port_from.cmd.addr),
+            If(port_to.cmd.ready,
+                port_from.cmd.ready.eq(1),
+                NextValue(addr, port_from.cmd.addr),
+                NextValue(op, port_from.cmd.atomic),
+                NextState("MODIFY")
+            )
+        )
+        fsm.act("MODIFY",
+            port_to.hold.eq(1),
+            port_to.cmd.addr.eq(addr),
+            # Operand.
+            port_from.wdata.ready.eq(~wdata_done),
+            If(port_from.wdata.valid & ~wdata_done,
+                NextValue(operand, port_from.wdata.data),
+                NextValue(compare, port_from.wdata.compare),
+                NextValue(we,      port_from.wdata.we),
+                NextValue(wdata_done, 1)
+            ),
+            # Previous content.
+            port_to.rdata.ready.eq(~rdata_done),
+            If(port_to.rdata.valid & ~rdata_done,
+                NextValue(old, port_to.rdata.data),
+                NextValue(rdata_done, 1)
+            ),
+            If(wdata_done & rdata_done,
+                If((op == atomic_ops["cas"]) & ~match,
+                    NextState("RESPONSE")
+                ).Else(
+                    NextState("WRITE")
+                )
+            )
+        )
+        fsm.act("WRITE",
+            port_to.hold.eq(1),
+            port_to.cmd.valid.eq(1),
+            port_to.cmd.we.eq(1),
+            port_to.cmd.addr.eq(addr),
+            If(port_to.cmd.ready,
+                NextState("WRITE-DATA")
+            )
+        )
+        fsm.act("WRITE-DATA",
+            port_to.wdata.valid.eq(1),
+            port_to.wdata.data.eq(new),
+            port_to.wdata.we.eq(we),
+            If(port_to.wdata.ready,
+                NextState("RESPONSE")
+            )
+        )
+        fsm.act("RESPONSE",
+            port_from.rdata.valid.eq(1),
+            port_from.rdata.data.eq(old),
+            If(port_from.rdata.ready,
+                NextState("IDLE")
+            )
+        )
+        self.comb += [
+            port_to.flush.eq(port_from.flush),
+            port_from.lock.eq(port_to.lock),
+        ]
+        self.sync += If(fsm.ongoing("IDLE"),
+            pending.eq(pending +
+                Mux(port_to.cmd.valid & port_to.cmd.ready, words, 0) -
+                (port_to.wdata.valid & port_to.wdata.ready) -
+                (port_to.rdata.valid & port_to.rdata.ready))
+        )
+
 # LiteDRAMNativePortDownConverter ------------------------------------------------------------------
 
 class LiteDRAMNativePortDownConverter(Module):
@@ -15,7 +15,7 @@ from litex.gen import *
 from litex.soc.interconnect import stream
 
 from litedram.common import LiteDRAMNativePort
-from litedram.frontend.adapter import LiteDRAMNativePortConverter
+from litedram.frontend.adapter import LiteDRAMNativePortConverter, LiteDRAMNativePortBurstCoalescer
 
 # LiteDRAMAvalonMM2Native --------------------------------------------------------------------------
 
@@ -56,6 +56,20 @@ class LiteDRAMAvalonMM2Native(LiteXModule):
 
         self.comb += address_offset.eq(base_address >> log2_int(port.data_width//8))
 
+        # Native Bursts (Optional).
+        # Burst reads are issued as native bursts and burst writes gathered into native bursts.
+        with_bursts = (port.burst_width > 0) and (burst_increment == 1)
+        cmd_words   = 1
+        if with_bursts:
+            cmd_words = Signal(port.burst_width + 1)
+            burst_max = port.get_burst_max(address)
+            self.comb += If(cmd_ready_count <= burst_max,
+                cmd_words.eq(cmd_ready_count)
+            ).Else(
+                cmd_words.eq(burst_max + 1)
+            )
+            self.coalescer = LiteDRAMNativePortBurstCoalescer(port.address_width, port.burst_width)
+
         # Layouts.
         cmd_layout   = [("address", len(address))]
         wdata_layout = [
@@ -136,6 +150,7 @@ class LiteDRAMAvalonMM2Native(LiteXModule):
         self.cmd_fifo   = cmd_fifo   = stream.SyncFIFO(cmd_layout,   max_burst_length)
         self.wdata_fifo = wdata_fifo = stream.SyncFIFO(wdata_layout, max_burst_length)
 
+        cmd = port.cmd if not with_bursts else self.coalescer.sink
         fsm.act("BURST_WRITE",
             # FIFO producer
             avalon.waitrequest.eq(~(cmd_fifo.sink.ready & wdata_fifo.sink.ready)),
@@ -160,10 +175,10 @@ class LiteDRAMAvalonMM2Native(LiteXModule):
             ),
 
             # FIFO consumer
-            port.cmd.addr.eq(cmd_fifo.source.payload.address),
-            port.cmd.we.eq(port.cmd.valid),
-            port.cmd.valid.eq(cmd_fifo.source.valid & (0 < wdata_fifo.level)),
-            cmd_fifo.source.ready.eq(port.cmd.ready),
+            cmd.addr.eq(cmd_fifo.source.payload.address),
+            cmd.we.eq(cmd.valid),
+            cmd.valid.eq(cmd_fifo.source.valid & (0 < wdata_fifo.level)),
+            cmd_fifo.source.ready.eq(cmd.ready),
 
             port.wdata.data.eq(wdata_fifo.source.payload.data),
             port.wdata.we.eq(wdata_fifo.source.payload.byteenable),
@@ -182,11 +197,11 @@ class LiteDRAMAvalonMM2Native(LiteXModule):
             avalon.readdatavalid.eq(port.rdata.valid),
 
             If(port.cmd.ready,
-                If(cmd_ready_count == 1,
+                If(cmd_ready_count == cmd_words,
                     NextValue(cmd_ready_seen, 1)
                 ),
-                NextValue(cmd_ready_count, cmd_ready_count - 1),
-                NextValue(address, address + burst_increment)
+                NextValue(cmd_ready_count, cmd_ready_count - cmd_words),
+                NextValue(address, address + cmd_words*burst_increment)
             ),
 
             If(port.rdata.valid,
@@ -196,3 +211,7 @@ class LiteDRAMAvalonMM2Native(LiteXModule):
                 NextValue(burst_count, burst_count - 1)
             )
         )
+
+        if with_bursts:
+            fsm.act("BURST_WRITE", self.coalescer.source.connect(port.cmd))
+            fsm.act("BURST_READ",  port.cmd.burst.eq(cmd_words - 1))
@@ -10,15 +10,22 @@ AXI frontend for LiteDRAM
 Converts AXI ports to Native ports.
 
 Features:
-- Write/Read arbitration.
+- Write/Read arbitration (round-robin or batching of same-direction bursts).
 - Write/Read data buffers (configurable depth).
 - Burst support (FIXED/INCR/WRAP).
+- Beats of a burst to the same DRAM word (narrow or FIXED bursts) merged into a single command.
 - ID support (configurable width).
+- Native bursts (consecutive beats gathered into burst commands when the port supports them).
 - Optional Read-Modify-Write support (When only full words can be written on the DRAM, ex with ECC).
+- Exclusive accesses (single beat, when the port supports atomics and the writes of the other
+  masters are snooped).
+- Out-of-order read responses across IDs over several Native ports (LiteDRAMAXI2NativeMulti).
 
 Limitations:
-- Response always okay.
-- No reordering.
+- Response always okay (except exclusive accesses).
+- Responses of a Native port returned in order.
+- Exclusive monitor for a single address (the last exclusive read), only cleared by the writes
+  of the snooped ports.
 """
 
 from migen import *
@@ -28,19 +35,64 @@ from migen.genlib.roundrobin import *
 from litex.soc.interconnect import stream
 from litex.soc.interconnect.axi import *
 
+from litedram.common import atomic_ops
+from litedram.frontend.adapter import LiteDRAMNativePortBurstCoalescer
+
 # LiteDRAMAXIPort ----------------------------------------------------------------------------------
 
 class LiteDRAMAXIPort(AXIInterface): pass
 
+# AXI Beat Word ------------------------------------------------------------------------------------
+
+class _AXIBeatWordLast(Module):
+    # Last beat of a burst in its DRAM word (the next beat, if any, being in another word).
+    def __init__(self, ax_burst, ax_beat, ashift):
+        self.word_last = Signal()
+
+        # # #
+
+        next_in_word = Signal()
+        offset       = ax_beat.addr[:ashift]
+        cases        = {}
+        for size in range(ashift + 1):
+            in_word = (offset + 2**size) < 2**ashift
+            cases[size] = Case(ax_burst.burst, {
+                BURST_FIXED: next_in_word.eq(1),
+                BURST_INCR:  next_in_word.eq(in_word),
+                # Wrapping window smaller than the word or crossing word boundaries.
+                BURST_WRAP:  next_in_word.eq(in_word | (ax_burst.len < 2**(ashift - size))),
+            })
+        self.comb += Case(ax_burst.size, cases)
+        self.comb += self.word_last.eq(ax_beat.last | ~next_in_word)
+
+def _cmd_write(port, addr):
+    # Write command to addr accepted on a Native port (in the current cycle).
+    r = port.cmd.valid & port.cmd.ready & port.cmd.we
+    if getattr(port, "burst_width", 0):
+        return r & (addr >= port.cmd.addr) & (addr <= port.cmd.addr + port.cmd.burst)
+    return r & (addr == port.cmd.addr)
+
 # LiteDRAMAXI2NativeW ------------------------------------------------------------------------------
 
 class LiteDRAMAXI2NativeW(Module):
-    def __init__(self, axi, port, buffer_depth, base_address, with_read_modify_write=False):
+    def __init__(self, axi, port, buffer_depth, base_address, with_read_modify_write=False,
+        with_exclusive=False):
         assert axi.address_width >= log2_int(base_address)
         assert axi.data_width    == port.data_width
+        assert not with_exclusive or (port.with_atomics and not with_read_modify_write)
         self.cmd_request = Signal()
         self.cmd_grant   = Signal()
 
+        # Exclusive monitor.
+        if with_exclusive:
+            self.excl_valid    = Signal()
+            self.excl_snoop    = Signal() # Monitored address written in the current cycle.
+            self.excl_id       = Signal(axi.id_width)
+            self.excl_addr     = Signal(port.address_width)
+            self.excl_data     = Signal(port.data_width)
+            self.excl_clear    = Signal()
+            self.excl_response = Signal()
+
         # # #
 
         can_write = Signal()
@@ -64,12 +116,14 @@ class LiteDRAMAXI2NativeW(Module):
         id_buffer   = stream.SyncFIFO([("id", axi.id_width)], buffer_depth)
         resp_buffer = stream.SyncFIFO([("id", axi.id_width), ("resp", 2)], buffer_depth)
         self.submodules += id_buffer, resp_buffer
+        excl_pending = Signal()
         self.comb += [
             id_buffer.sink.valid.eq(aw.valid & aw.first & aw.ready),
             id_buffer.sink.id.eq(aw.id),
             If(w_buffer.source.valid &
                w_buffer.source.last &
-               w_buffer.source.ready,
+               w_buffer.source.ready &
+               ~excl_pending,
                 resp_buffer.sink.valid.eq(1),
                 resp_buffer.sink.resp.eq(RESP_OKAY),
                 resp_buffer.sink.id.eq(id_buffer.source.id),
@@ -79,37 +133,59 @@ class LiteDRAMAXI2NativeW(Module):
             axi.b.id.eq(resp_buffer.source.id),             # FIXME: Avoid manual id connection.
         ]
 
+        # Bursts -----------------------------------------------------------------------------------
+        # Consecutive beats are gathered into burst commands when the port supports them.
+        cmd = port.cmd
+        with_bursts = bool(getattr(port, "burst_width", 0)) and not with_read_modify_write
+        if with_bursts:
+            self.submodules.coalescer = coalescer = LiteDRAMNativePortBurstCoalescer(
+                port.address_width, port.burst_width)
+            cmd = coalescer.sink
+            self.comb += [
+                self.cmd_request.eq(coalescer.source.valid),
+                If(self.cmd_grant, coalescer.source.connect(port.cmd)),
+            ]
+
         # Write Buffer reservation ------------------------------------------------------------------
         # - Incremented when data cmd is send
         # - Decremented when data is read
         w_buffer_queue   = Signal()
         w_buffer_dequeue = Signal()
         w_buffer_level   = Signal(max=buffer_depth + 1)
+        w_buffer_words   = Signal(max=2**getattr(port, "burst_width", 0) + 1)
         self.comb += [
+            w_buffer_words.eq(port.cmd.burst + 1 if with_bursts else 1),
             w_buffer_queue.eq(port.cmd.valid & port.cmd.ready & port.cmd.we),
             w_buffer_dequeue.eq(w_buffer.source.valid & w_buffer.source.ready)
         ]
         self.sync += [
             If(w_buffer_queue,
-                If(~w_buffer_dequeue, w_buffer_level.eq(w_buffer_level + 1))
+                w_buffer_level.eq(w_buffer_level + w_buffer_words - w_buffer_dequeue)
             ).Elif(w_buffer_dequeue,
                 w_buffer_level.eq(w_buffer_level - 1)
             )
         ]
-        self.comb += can_write.eq(w_buffer.level > w_buffer_level)
+        if with_bursts:
+            # Gathered beats also reserve their data.
+            self.comb += can_write.eq(w_buffer.level > (w_buffer_level + coalescer.words))
+        else:
+            self.comb += can_write.eq(w_buffer.level > w_buffer_level)
 
         # Command ----------------------------------------------------------------------------------
         # Accept and send command to the controller only if:
         # - Address & Data request are *both* valid.
         # - Data buffer is not empty.
+        aw_excl  = Signal()
+        aw_merge = Signal()
+        if not with_bursts:
+            self.comb += self.cmd_request.eq(aw.valid & can_write & ~aw_merge)
         self.comb += [
-            self.cmd_request.eq(aw.valid & can_write),
-            If(self.cmd_request & self.cmd_grant,
-                port.cmd.valid.eq(1),
-                port.cmd.last.eq(aw.last),
-                port.cmd.we.eq(1),
-                port.cmd.addr.eq((aw.addr - base_address) >> ashift),
-                If(port.cmd.ready,
+            If(aw.valid & can_write & ~aw_excl & ~aw_merge & (self.cmd_grant | with_bursts),
+                cmd.valid.eq(1),
+                cmd.last.eq(aw.last),
+                cmd.we.eq(1),
+                cmd.addr.eq((aw.addr - base_address) >> ashift),
+                If(cmd.ready,
                     aw.ready.eq(1),
                 )
             )
@@ -130,6 +206,138 @@ class LiteDRAMAXI2NativeW(Module):
             w_buffer.source.ready.eq(port.wdata.ready & w_buffer_send),
         ]
 
+        # Beats Merging ----------------------------------------------------------------------------
+        # Beats of a burst to the same DRAM word (narrow or FIXED bursts) are merged: the previous
+        # beats of the word only reserve their data, the command is sent with the last one and its
+        # data merged with theirs (last strobed bytes win).
+        with_merge = not with_read_modify_write
+        if with_merge:
+            self.submodules.aw_word = aw_word = _AXIBeatWordLast(aw_buffer.source, aw, ashift)
+            merge_queue = Signal()
+            merge_ready = Signal()
+            self.comb += [
+                aw_merge.eq(~aw_word.word_last),
+                merge_ready.eq(can_write),
+                If(aw.valid & aw_merge & merge_ready,
+                    aw.ready.eq(1),
+                    merge_queue.eq(1)
+                ),
+                If(merge_queue,
+                    w_buffer_queue.eq(1),
+                    w_buffer_words.eq(1)
+                ),
+            ]
+            if with_bursts:
+                # Gathered beats are sent first.
+                self.comb += If(coalescer.words != 0, merge_ready.eq(0))
+
+            # Reservations (merged beats or commands) in order of the data.
+            flags = stream.SyncFIFO([("merge", 1), ("words", len(w_buffer_words))], buffer_depth + 1)
+            self.submodules += flags
+            self.comb += [
+                flags.sink.valid.eq(w_buffer_queue),
+                flags.sink.merge.eq(merge_queue),
+                flags.sink.words.eq(w_buffer_words),
+            ]
+
+            # Merge data of the beats.
+            w_count = Signal(len(w_buffer_words))
+            w_data  = Signal(port.data_width)
+            w_strb  = Signal(port.data_width//8)
+            w_mask  = Signal(port.data_width)
+            self.comb += [
+                w_mask.eq(Cat(*[Replicate(w_buffer.source.strb[i], 8) for i in range(port.data_width//8)])),
+                w_buffer_send.eq(flags.source.valid),
+                port.wdata.data.eq((w_data & ~w_mask) | (w_buffer.source.data & w_mask)),
+                port.wdata.we.eq(w_strb | w_buffer.source.strb),
+                If(flags.source.merge,
+                    port.wdata.valid.eq(0),
+                    w_buffer.source.ready.eq(w_buffer_send)
+                ),
+                flags.source.ready.eq(w_buffer_dequeue & (w_count == (flags.source.words - 1))),
+            ]
+            self.sync += If(w_buffer_dequeue,
+                w_count.eq(Mux(flags.source.ready, 0, w_count + 1)),
+                If(flags.source.merge,
+                    w_data.eq(port.wdata.data),
+                    w_strb.eq(port.wdata.we)
+                ).Else(
+                    w_data.eq(0),
+                    w_strb.eq(0)
+                )
+            )
+
+        # Exclusive Write --------------------------------------------------------------------------
+        # A single beat exclusive write succeeds when the address is still monitored (not written
+        # since the exclusive read) when its command is accepted, the following writes being done
+        # after it. It is executed as a compare-and-swap with the data of the exclusive read (no
+        # byte written when not monitored). The previous content returned by the port (right after
+        # the command, the other ones being completed first) gives the response.
+        if with_exclusive:
+            excl_match   = Signal()
+            excl_compare = Signal(port.data_width)
+            excl_we      = Signal(port.data_width//8)
+            excl_mask    = Signal(port.data_width)
+            excl_cmd     = Signal()
+            self.comb += [
+                aw_excl.eq(aw_buffer.source.lock & aw.first & aw.last),
+                excl_cmd.eq(aw.valid & aw_excl & can_write),
+                If(excl_cmd,
+                    self.cmd_request.eq(1)
+                ),
+                If(excl_cmd & self.cmd_grant & ~excl_pending,
+                    port.cmd.valid.eq(1),
+                    port.cmd.last.eq(1),
+                    port.cmd.we.eq(1),
+                    port.cmd.addr.eq((aw.addr - base_address) >> ashift),
+                    port.cmd.atomic.eq(atomic_ops["cas"]),
+                    If(port.cmd.ready,
+                        aw.ready.eq(1)
+                    )
+                ),
+                If(excl_pending,
+                    port.wdata.compare.eq(excl_compare),
+                    If(~excl_match,
+                        port.wdata.we.eq(0)
+                    )
+                ),
+                excl_mask.eq(Cat(*[Replicate(excl_we[i], 8) for i in range(port.data_width//8)])),
+                # Response.
+                self.excl_response.eq(excl_pending & port.rdata.valid),
+                If(self.excl_response,
+                    port.rdata.ready.eq(1),
+                    resp_buffer.sink.valid.eq(1),
+                    resp_buffer.sink.resp.eq(RESP_OKAY),
+                    If(excl_match & (((port.rdata.data ^ excl_compare) & excl_mask) == 0),
+                        resp_buffer.sink.resp.eq(RESP_EXOKAY)
+                    ),
+                    resp_buffer.sink.id.eq(id_buffer.source.id),
+                    id_buffer.source.ready.eq(1),
+                    self.excl_clear.eq(1)
+                )
+            ]
+            if with_bursts:
+                # Gathered beats are sent first.
+                self.comb += [
+                    If(coalescer.words != 0, excl_cmd.eq(0)),
+                    If(excl_cmd, port.cmd.burst.eq(0)),
+                ]
+            self.sync += [
+                If(port.cmd.valid & port.cmd.ready & (port.cmd.atomic != 0),
+                    excl_pending.eq(1),
+                    excl_match.eq(self.excl_valid & ~self.excl_snoop &
+                        (self.excl_id   == aw.id) &
+                        (self.excl_addr == port.cmd.addr)),
+                    excl_compare.eq(self.excl_data)
+                ),
+                If(port.wdata.valid & port.wdata.ready & excl_pending,
+                    excl_we.eq(port.wdata.we)
+                ),
+                If(self.excl_response,
+                    excl_pending.eq(0)
+                )
+            ]
+
         # Read-Modify-Write ------------------------------------------------------------------------
         if with_read_modify_write:
             # RMW Request/Grant signals.
@@ -225,12 +433,22 @@ class LiteDRAMAXI2NativeW(Module):
 # LiteDRAMAXI2NativeR ------------------------------------------------------------------------------
 
 class LiteDRAMAXI2NativeR(Module):
-    def __init__(self, axi, port, buffer_depth, base_address, with_read_modify_write=False):
+    def __init__(self, axi, port, buffer_depth, base_address, with_read_modify_write=False,
+        with_exclusive=False):
         assert axi.address_width >= log2_int(base_address)
         assert axi.data_width    == port.data_width
+        assert not with_exclusive or (port.with_atomics and not with_read_modify_write)
         self.cmd_request = Signal()
         self.cmd_grant   = Signal()
 
+        # Exclusive monitor.
+        if with_exclusive:
+            self.excl_set      = Signal()
+            self.excl_id       = Signal(axi.id_width)
+            self.excl_addr     = Signal(port.address_width)
+            self.excl_data     = Signal(port.data_width)
+            self.excl_response = Signal()
+
         # # #
 
         can_read = Signal()
@@ -250,27 +468,49 @@ class LiteDRAMAXI2NativeR(Module):
         r_buffer = stream.SyncFIFO(r.description, depth=buffer_depth, buffered=True)
         self.submodules.r_buffer = r_buffer
 
+        # Bursts -----------------------------------------------------------------------------------
+        # Consecutive beats are gathered into burst commands when the port supports them.
+        cmd = port.cmd
+        with_bursts = bool(getattr(port, "burst_width", 0)) and not with_read_modify_write
+        if with_bursts:
+            self.submodules.coalescer = coalescer = LiteDRAMNativePortBurstCoalescer(
+                port.address_width, port.burst_width)
+            cmd = coalescer.sink
+            self.comb += [
+                self.cmd_request.eq(coalescer.source.valid),
+                If(self.cmd_grant, coalescer.source.connect(port.cmd)),
+            ]
+
         # Read Buffer reservation ------------------------------------------------------------------
         # - Incremented when data is planned to be queued
         # - Decremented when data is dequeued
         r_buffer_queue   = Signal()
         r_buffer_dequeue = Signal()
         r_buffer_level   = Signal(max=buffer_depth + 1)
+        r_buffer_words   = port.cmd.burst + 1 if with_bursts else 1
         self.comb += [
             r_buffer_queue.eq(port.cmd.valid & port.cmd.ready & ~port.cmd.we),
             r_buffer_dequeue.eq(r_buffer.source.valid & r_buffer.source.ready)
         ]
         self.sync += [
             If(r_buffer_queue,
-                If(~r_buffer_dequeue, r_buffer_level.eq(r_buffer_level + 1))
+                r_buffer_level.eq(r_buffer_level + r_buffer_words - r_buffer_dequeue)
             ).Elif(r_buffer_dequeue,
                 r_buffer_level.eq(r_buffer_level - 1)
             )
         ]
-        self.comb += can_read.eq(r_buffer_level != buffer_depth)
+        if with_bursts:
+            # Gathered beats also reserve their data.
+            self.comb += can_read.eq((r_buffer_level + coalescer.words) < buffer_depth)
+        else:
+            self.comb += can_read.eq(r_buffer_level != buffer_depth)
 
         # Read ID Buffer ---------------------------------------------------------------------------
-        id_buffer = stream.SyncFIFO([("id", axi.id_width)], buffer_depth)
+        # Beats merged with the previous one (same word) are returned with its data (repeat).
+        id_buffer_layout = [("id", axi.id_width), ("repeat", 1)]
+        if with_exclusive:
+            id_buffer_layout += [("excl", 1), ("addr", port.address_width)]
+        id_buffer = stream.SyncFIFO(id_buffer_layout, buffer_depth)
         self.submodules += id_buffer
         self.comb += [
             id_buffer.sink.valid.eq(ar.valid & ar.ready),
@@ -282,25 +522,62 @@ class LiteDRAMAXI2NativeR(Module):
         ]
 
         # Command ----------------------------------------------------------------------------------
+        # The following beats of a word are accepted without command (data repeated).
+        ar_merge = Signal()
+        ar_word  = Signal(port.address_width)
         self.comb += [
-            self.cmd_request.eq(ar.valid & can_read),
-            If(self.cmd_request & self.cmd_grant,
-                port.cmd.valid.eq(1),
-                port.cmd.last.eq(ar.last),
-                port.cmd.we.eq(0),
-                port.cmd.addr.eq((ar.addr - base_address) >> ashift),
-                If(port.cmd.ready,
+            ar_merge.eq(~ar.first & (((ar.addr - base_address) >> ashift) == ar_word)),
+            id_buffer.sink.repeat.eq(ar_merge),
+            If(ar.valid & ar_merge & id_buffer.sink.ready, ar.ready.eq(1)),
+            If(~id_buffer.sink.ready, can_read.eq(0)),
+        ]
+        self.sync += If(ar.valid & ar.ready, ar_word.eq((ar.addr - base_address) >> ashift))
+        if not with_bursts:
+            self.comb += self.cmd_request.eq(ar.valid & can_read & ~ar_merge)
+        self.comb += [
+            If(ar.valid & can_read & ~ar_merge & (self.cmd_grant | with_bursts),
+                cmd.valid.eq(1),
+                cmd.last.eq(ar.last),
+                cmd.we.eq(0),
+                cmd.addr.eq((ar.addr - base_address) >> ashift),
+                If(cmd.ready,
                     ar.ready.eq(1),
                 )
             )
         ]
 
         # Read data --------------------------------------------------------------------------------
+        r_data = Signal(axi.data_width)
         self.comb += [
             port.rdata.connect(r_buffer.sink, omit={"bank"}),
             r_buffer.source.connect(axi.r, omit={"id", "last"}),
+            If(id_buffer.source.repeat,
+                axi.r.valid.eq(id_buffer.source.valid),
+                axi.r.data.eq(r_data),
+                r_buffer.source.ready.eq(0)
+            ),
             axi.r.resp.eq(RESP_OKAY)
         ]
+        self.sync += If(axi.r.valid & axi.r.ready, r_data.eq(axi.r.data))
+
+        # Exclusive Read ---------------------------------------------------------------------------
+        # A single beat exclusive read sets the exclusive monitor with its data.
+        if with_exclusive:
+            self.comb += [
+                id_buffer.sink.excl.eq(ar_buffer.source.lock & ar.first & ar.last),
+                id_buffer.sink.addr.eq((ar.addr - base_address) >> ashift),
+                If(id_buffer.source.excl,
+                    axi.r.resp.eq(RESP_EXOKAY)
+                ),
+                self.excl_set.eq(axi.r.valid & axi.r.ready & id_buffer.source.excl),
+                self.excl_id.eq(id_buffer.source.id),
+                self.excl_addr.eq(id_buffer.source.addr),
+                self.excl_data.eq(axi.r.data),
+                # Response of the exclusive writes.
+                If(self.excl_response,
+                    r_buffer.sink.valid.eq(0)
+                )
+            ]
 
         # Read-Modify-Write ------------------------------------------------------------------------
         if with_read_modify_write:
@@ -325,27 +602,119 @@ class LiteDRAMAXI2NativeR(Module):
                 r_buffer.sink.valid.eq(0)
             )
 
+# LiteDRAMAXIBatchArbiter --------------------------------------------------------------------------
+
+class _LiteDRAMAXIBatchArbiter(Module):
+    # Write (0) / Read (1) arbiter granting up to `window` consecutive commands to a direction
+    # (2*`window` for the direction of the `write_hint`) while the other one is requesting.
+    # Only the commands accepted by the port (`accepted`) are counted, not the `ce` cycles.
+    def __init__(self, window, write_hint=None):
+        self.request  = Signal(2)
+        self.grant    = Signal()
+        self.ce       = Signal()
+        self.accepted = Signal()
+
+        # # #
+
+        count     = Signal(max=2*window + 1) # Commands accepted in the batch.
+        limit     = Signal(max=2*window + 1)
+        park      = Signal()
+        cur_req   = Signal()
+        other_req = Signal()
+        self.comb += [
+            cur_req.eq(Mux(self.grant, self.request[1], self.request[0])),
+            other_req.eq(Mux(self.grant, self.request[0], self.request[1])),
+            limit.eq(window),
+        ]
+        if write_hint is not None:
+            self.comb += [
+                park.eq(~write_hint),
+                If(self.grant == park, limit.eq(2*window)),
+            ]
+        self.sync += If(self.ce,
+            If(self.request == 0,
+                # Park on the favored direction.
+                self.grant.eq(park),
+                count.eq(0)
+            ).Elif(other_req & (~cur_req | (count + self.accepted >= limit)),
+                self.grant.eq(~self.grant),
+                count.eq(0)
+            ).Elif(self.accepted,
+                count.eq(count + (count != limit))
+            )
+        )
+
 # LiteDRAMAXI2Native -------------------------------------------------------------------------------
 
 class LiteDRAMAXI2Native(Module):
-    def __init__(self, axi, port, w_buffer_depth=16, r_buffer_depth=16, base_address=0x00000000, with_read_modify_write=False):
+    """AXI to Native port
+
+    Writes and reads share the Native port, arbitrated per command. By default, the arbitration
+    is round-robin. With `batch_window`, consecutive commands of the same direction are grouped:
+    the granted direction keeps the port for up to `batch_window` commands while it has some,
+    which avoids turning the DRAM bus around on each burst of a mixed stream. With `write_hint`
+    (ex. `Multiplexer.writing`, in the port clock domain), the direction served by the controller
+    is favored: the arbiter parks on it and its batches are twice as long.
+
+    Exclusive accesses are supported when the port has atomics and `snoop_ports` is given: the
+    exclusive monitor is cleared by the writes to the monitored address of this port and of the
+    `snoop_ports` (the crossbar ports of the other masters writing to the same memory, an empty
+    list when there are none), so an exclusive write fails when the location has been written
+    since the exclusive read, even with the same value. Without `snoop_ports`, exclusive accesses
+    are handled as normal ones (OKAY responses).
+    """
+    def __init__(self, axi, port, w_buffer_depth=16, r_buffer_depth=16, base_address=0x00000000,
+        with_read_modify_write=False, batch_window=0, write_hint=None, snoop_ports=None):
+        with_exclusive = (snoop_ports is not None and
+            getattr(port, "with_atomics", False) and not with_read_modify_write)
 
         # # #
 
         # Write path -------------------------------------------------------------------------------
-        self.submodules.write = LiteDRAMAXI2NativeW(axi, port, w_buffer_depth, base_address, with_read_modify_write)
+        self.submodules.write = LiteDRAMAXI2NativeW(axi, port, w_buffer_depth, base_address,
+            with_read_modify_write, with_exclusive)
 
         # Read path --------------------------------------------------------------------------------
-        self.submodules.read = LiteDRAMAXI2NativeR(axi, port, r_buffer_depth, base_address, with_read_modify_write)
+        self.submodules.read = LiteDRAMAXI2NativeR(axi, port, r_buffer_depth, base_address,
+            with_read_modify_write, with_exclusive)
 
         # Write / Read arbitration -----------------------------------------------------------------
-        arbiter = RoundRobin(2, SP_CE)
-        self.submodules += arbiter
+        if batch_window:
+            arbiter = _LiteDRAMAXIBatchArbiter(batch_window, write_hint)
+            self.comb += arbiter.accepted.eq(port.cmd.valid & port.cmd.ready)
+        else:
+            arbiter = RoundRobin(2, SP_CE)
+        self.submodules.arbiter = arbiter
         self.comb += arbiter.ce.eq(~port.cmd.valid | (port.cmd.ready & port.cmd.last))
         for i, master in enumerate([self.write, self.read]):
             self.comb += arbiter.request[i].eq(master.cmd_request)
             self.comb += master.cmd_grant.eq(arbiter.grant == i)
 
+        # Exclusive monitor ------------------------------------------------------------------------
+        if with_exclusive:
+            def written(addr):
+                # Writes to addr accepted in the current cycle (except our exclusive writes).
+                r = (port.cmd.atomic == 0) & _cmd_write(port, addr)
+                for snoop_port in snoop_ports:
+                    assert snoop_port.data_width == port.data_width
+                    r = r | _cmd_write(snoop_port, addr)
+                return r
+            self.comb += [
+                self.read.excl_response.eq(self.write.excl_response),
+                self.write.excl_snoop.eq(written(self.write.excl_addr)),
+            ]
+            self.sync += [
+                If(self.write.excl_clear | self.write.excl_snoop,
+                    self.write.excl_valid.eq(0)
+                ),
+                If(self.read.excl_set,
+                    self.write.excl_valid.eq(~written(self.read.excl_addr)),
+                    self.write.excl_id.eq(self.read.excl_id),
+                    self.write.excl_addr.eq(self.read.excl_addr),
+                    self.write.excl_data.eq(self.read.excl_data)
+                )
+            ]
+
         # Read-Modify-Write ------------------------------------------------------------------------
         if with_read_modify_write:
             self.comb += [
@@ -353,3 +722,95 @@ class LiteDRAMAXI2Native(Module):
                 self.read.rmw_request.eq(self.write.rmw_request),
                 self.write.rmw_rgrant.eq(self.read.rmw_rgrant),
             ]
+
+# LiteDRAMAXI2NativeMulti --------------------------------------------------------------------------
+
+class LiteDRAMAXI2NativeMulti(Module):
+    """AXI to several Native ports, with out-of-order read responses across IDs
+
+    Reads are spread over the `ports` by ID (`ar.id % len(ports)`), each port being a distinct
+    crossbar master with its own read command and data buffers, so up to `ar_buffer_depth`
+    bursts and `r_buffer_depth` beats can be outstanding per port. The read buffers act as a
+    reorder buffer: a read burst is returned once all its data is buffered (or its buffer is
+    full), in any order across the ports, so a slow ID (ex. waiting for a busy bank) no longer
+    blocks the others. The reads of an ID always use the same port and are returned in order,
+    as required by AXI. Bursts are not interleaved.
+
+    Writes use the first port (shared with the reads of the IDs mapped on it) as in
+    LiteDRAMAXI2Native, so a read is only ordered after a write of another ID by the write
+    response, as for any other crossbar masters. Exclusive accesses are only supported on the
+    IDs mapped on the first port (with `snoop_ports`, see LiteDRAMAXI2Native).
+    """
+    def __init__(self, axi, ports, w_buffer_depth=16, r_buffer_depth=16, ar_buffer_depth=4,
+        base_address=0x00000000, snoop_ports=None):
+        nports    = len(ports)
+        lane_bits = log2_int(nports)
+        assert axi.id_width >= lane_bits
+        for port in ports[1:]:
+            assert not getattr(port, "with_atomics", False)
+
+        # # #
+
+        lanes = [AXIInterface(
+            data_width    = axi.data_width,
+            address_width = axi.address_width,
+            id_width      = axi.id_width) for port in ports]
+
+        # Write path and reads of the first port -------------------------------------------------
+        self.submodules.native = LiteDRAMAXI2Native(lanes[0], ports[0],
+            w_buffer_depth = w_buffer_depth,
+            r_buffer_depth = r_buffer_depth,
+            base_address   = base_address,
+            snoop_ports    = snoop_ports)
+        self.comb += [
+            axi.aw.connect(lanes[0].aw),
+            axi.w.connect(lanes[0].w),
+            lanes[0].b.connect(axi.b),
+        ]
+
+        # Reads of the other ports -----------------------------------------------------------------
+        reads = [self.native.read]
+        for i in range(1, nports):
+            read = LiteDRAMAXI2NativeR(lanes[i], ports[i], r_buffer_depth, base_address)
+            self.comb += read.cmd_grant.eq(1)
+            self.submodules += read
+            reads.append(read)
+
+        # Read command dispatch (by ID) ------------------------------------------------------------
+        ar_lane = Signal(max=max(nports, 2))
+        if lane_bits:
+            self.comb += ar_lane.eq(axi.ar.id[:lane_bits])
+        r_busy  = Signal()
+        arbiter = RoundRobin(nports, SP_CE)
+        self.submodules += arbiter
+        for i, (lane, read) in enumerate(zip(lanes, reads)):
+            # Command buffer and length of the outstanding bursts.
+            ar_buffer  = stream.SyncFIFO(lane.ar.description, ar_buffer_depth)
+            len_buffer = stream.SyncFIFO([("len", len(axi.ar.len))], ar_buffer_depth + r_buffer_depth)
+            self.submodules += ar_buffer, len_buffer
+            self.comb += [
+                axi.ar.connect(ar_buffer.sink, omit={"valid", "ready"}),
+                ar_buffer.sink.valid.eq(axi.ar.valid & (ar_lane == i) & len_buffer.sink.ready),
+                len_buffer.sink.valid.eq(axi.ar.valid & (ar_lane == i) & ar_buffer.sink.ready),
+                # Beats of FIXED/narrow bursts can share buffered words, wait for the first one.
+                If((axi.ar.burst != BURST_FIXED) & (axi.ar.size == log2_int(axi.data_width//8)),
+                    len_buffer.sink.len.eq(axi.ar.len)
+                ),
+                If(ar_lane == i, axi.ar.ready.eq(ar_buffer.sink.ready & len_buffer.sink.ready)),
+                ar_buffer.source.connect(lane.ar),
+            ]
+
+            # Request the response channel once the burst is buffered.
+            r_level = read.r_buffer.level
+            self.comb += [
+                arbiter.request[i].eq(lane.r.valid &
+                    ((r_level > len_buffer.source.len) | (r_level >= r_buffer_depth))),
+                If((arbiter.grant == i) & (r_busy | arbiter.request[i]),
+                    lane.r.connect(axi.r),
+                    len_buffer.source.ready.eq(axi.r.valid & axi.r.ready & axi.r.last)
+                ),
+            ]
+
+        # Read response arbitration (per burst) ----------------------------------------------------
+        self.comb += arbiter.ce.eq((~axi.r.valid & ~r_busy) | (axi.r.valid & axi.r.ready & axi.r.last))
+        self.sync += If(axi.r.valid & axi.r.ready, r_busy.eq(~axi.r.last))
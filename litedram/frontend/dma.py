@@ -7,17 +7,19 @@
 # Copyright (c) 2016 Tim 'mithro' Ansell <mithro@mithis.com>
 # SPDX-License-Identifier: BSD-2-Clause
 
-"""Direct Memory Access (DMA) reader and writer modules."""
+"""Direct Memory Access (DMA) reader, writer and copy engine modules."""
 
 from math import log2
 
 from migen import *
 
 from litex.soc.interconnect.csr import *
+from litex.soc.interconnect.csr_eventmanager import *
 from litex.soc.interconnect import stream
 
 from litedram.common import LiteDRAMNativePort
 from litedram.frontend.axi import LiteDRAMAXIPort
+from litedram.frontend.adapter import LiteDRAMNativePortBurstCoalescer
 
 # LiteDRAMDMAReader --------------------------------------------------------------------------------
 
@@ -27,6 +29,9 @@ class LiteDRAMDMAReader(Module, AutoCSR):
     For every address written to the sink, one DRAM word will be produced on
     the source.
 
+    On Native ports with bursts, reads of consecutive addresses are issued as
+    burst commands.
+
     Parameters
     ----------
     port : port
@@ -62,6 +67,11 @@ class LiteDRAMDMAReader(Module, AutoCSR):
         is_axi    = isinstance(port, LiteDRAMAXIPort)
         if is_native:
             (cmd, rdata) = port.cmd, port.rdata
+            if port.burst_width:
+                self.submodules.coalescer = LiteDRAMNativePortBurstCoalescer(
+                    port.address_width, port.burst_width)
+                self.comb += self.coalescer.source.connect(cmd)
+                cmd = self.coalescer.sink
         elif is_axi:
             (cmd, rdata) = port.ar, port.r
         else:
@@ -70,7 +80,7 @@ class LiteDRAMDMAReader(Module, AutoCSR):
         # Reservation FIFO -------------------------------------------------------------------------
 
         res_fifo = stream.SyncFIFO([("dummy", 1)], fifo_depth)
-        self.submodules += res_fifo
+        self.submodules.res_fifo = res_fifo
 
         # Request issuance -------------------------------------------------------------------------
 
@@ -157,6 +167,9 @@ class LiteDRAMDMAReader(Module, AutoCSR):
 class LiteDRAMDMAWriter(Module, AutoCSR):
     """Write data to DRAM memory.
 
+    On Native ports with bursts, writes to consecutive addresses are issued as
+    burst commands.
+
     Parameters
     ----------
     port : port
@@ -187,6 +200,11 @@ class LiteDRAMDMAWriter(Module, AutoCSR):
         is_axi    = isinstance(port, LiteDRAMAXIPort)
         if is_native:
             (cmd, wdata) = port.cmd, port.wdata
+            if port.burst_width:
+                self.submodules.coalescer = LiteDRAMNativePortBurstCoalescer(
+                    port.address_width, port.burst_width)
+                self.comb += self.coalescer.source.connect(cmd)
+                cmd = self.coalescer.sink
         elif is_axi:
             (cmd, wdata) = port.aw, port.w
             self.comb += port.b.ready.eq(1) # Always ack write responses.
@@ -271,3 +289,186 @@ class LiteDRAMDMAWriter(Module, AutoCSR):
             )
         )
         fsm.act("DONE", self._done.status.eq(1))
+
+# LiteDRAMCopyEngine -------------------------------------------------------------------------------
+
+class LiteDRAMCopyEngine(Module, AutoCSR):
+    """Copy or fill DRAM memory regions.
+
+    In memcpy mode, `length` bytes are read from `src` through a LiteDRAMDMAReader and written to
+    `dst` through a LiteDRAMDMAWriter. In memset mode, the 32-bit `pattern` (replicated to the port
+    data width) is written to `dst` and the read port stays idle.
+
+    Copies are done in chunks of up to `chunk_length` words, aligned on `chunk_length` words
+    boundaries of the source: all reads of a chunk are issued before its writes, so reads and
+    writes do not ping-pong between the source and destination rows. When `src` and `dst` have
+    different offsets in a chunk, the writes of a chunk can still span two destination rows. The
+    read data of a whole chunk is buffered in the reader FIFO, which also sets how many read
+    requests can be outstanding at once.
+
+    `src`, `dst` and `length` are in bytes but must be multiples of the port word size: the low
+    bits are ignored (trailing bytes of `length` are not transferred).
+
+    The engine starts when `enable` is set and reports completion through the `done` status and
+    the `done` event (interrupt). Clearing `enable` aborts the transfer and re-arms the engine:
+    the next transfer starts once the outstanding reads of the aborted one have been received
+    and discarded (the already issued writes are completed).
+
+    Parameters
+    ----------
+    read_port : port
+        Port on the DRAM memory controller to read from (Native or AXI).
+
+    write_port : port
+        Port on the DRAM memory controller to write to (Native or AXI).
+
+    fifo_depth : int
+        Depth of the reader and writer FIFOs (and thus how many requests can be outstanding).
+
+    fifo_buffered : bool
+        Implement FIFOs in Block Ram.
+
+    chunk_length : int
+        Maximum number of words copied per read/write phase (power of 2), defaults to
+        `fifo_depth`. Setting it to the DRAM row size (in port words) keeps the reads of each
+        phase within a single row.
+    """
+    def __init__(self, read_port, write_port, fifo_depth=64, fifo_buffered=False, chunk_length=None):
+        assert read_port.data_width == write_port.data_width
+        if chunk_length is None:
+            chunk_length = fifo_depth
+        assert chunk_length <= fifo_depth
+        assert chunk_length & (chunk_length - 1) == 0
+        self.read_port  = read_port
+        self.write_port = write_port
+
+        self._src     = CSRStorage(32, description="Source base address (in bytes).")
+        self._dst     = CSRStorage(32, description="Destination base address (in bytes).")
+        self._length  = CSRStorage(32, description="Transfer length (in bytes, multiple of the word size).")
+        self._pattern = CSRStorage(32, description="Fill pattern for memset mode.")
+        self._mode    = CSRStorage(fields=[
+            CSRField("memset", size=1, description="Fill `dst` with `pattern` instead of copying."),
+        ])
+        self._enable  = CSRStorage()
+        self._done    = CSRStatus()
+        self._offset  = CSRStatus(32)
+
+        self.submodules.ev = EventManager()
+        self.ev.done = EventSourcePulse(description="Transfer done.")
+        self.ev.finalize()
+
+        # # #
+
+        self.submodules.reader = reader = LiteDRAMDMAReader(read_port,  fifo_depth, fifo_buffered)
+        self.submodules.writer = writer = LiteDRAMDMAWriter(write_port, fifo_depth, fifo_buffered)
+
+        address_width = max(read_port.address_width, write_port.address_width)
+        shift         = log2_int(write_port.data_width//8)
+        src           = Signal(address_width)
+        dst           = Signal(address_width)
+        length        = Signal(address_width)
+        memset        = Signal()
+        rd_offset     = Signal(address_width)
+        wr_offset     = Signal(address_width)
+        chunk_end     = Signal(address_width)
+        next_end      = Signal(address_width)
+        next_boundary = Signal(address_width)
+        self.comb += [
+            # Next chunk ends on the following chunk_length boundary of the source.
+            next_boundary.eq(((src + chunk_end) | (chunk_length - 1)) + 1 - src),
+            If(next_boundary < length,
+                next_end.eq(next_boundary)
+            ).Else(
+                next_end.eq(length)
+            ),
+            self._offset.status.eq(wr_offset),
+        ]
+
+        # Datapath.
+        self.comb += [
+            reader.sink.address.eq(src + rd_offset),
+            writer.sink.address.eq(dst + wr_offset),
+            writer.sink.last.eq(wr_offset == (chunk_end - 1)),
+            If(memset,
+                writer.sink.data.eq(Replicate(self._pattern.storage, write_port.data_width//32)),
+            ).Else(
+                writer.sink.data.eq(reader.source.data),
+            ),
+        ]
+
+        # FSM.
+        fsm = FSM(reset_state="IDLE")
+        fsm = ResetInserter()(fsm)
+        self.submodules.fsm = fsm
+        # Aborts wait for the presented requests to be accepted.
+        abort = Signal()
+        self.comb += fsm.reset.eq((~self._enable.storage | abort) &
+            ~(reader.sink.valid & ~reader.sink.ready) &
+            ~(writer.sink.valid & ~writer.sink.ready))
+        self.sync += If(fsm.reset,
+            abort.eq(0)
+        ).Elif(~self._enable.storage,
+            abort.eq(1)
+        )
+        fsm.act("IDLE",
+            # Discard the read data of an aborted transfer.
+            reader.enable.eq(0),
+            NextValue(rd_offset, 0),
+            NextValue(wr_offset, 0),
+            NextValue(chunk_end, 0),
+            # Parameters are sampled at the start of the transfer.
+            NextValue(src,    self._src.storage[shift:]),
+            NextValue(dst,    self._dst.storage[shift:]),
+            NextValue(length, self._length.storage[shift:]),
+            NextValue(memset, self._mode.fields.memset),
+            If(self._enable.storage & ~reader.res_fifo.source.valid,
+                NextState("START")
+            )
+        )
+        fsm.act("START",
+            If(length == 0,
+                NextState("FLUSH")
+            ).Elif(memset,
+                NextValue(chunk_end, length),
+                NextState("WRITE")
+            ).Else(
+                NextValue(chunk_end, next_end),
+                NextState("READ")
+            )
+        )
+        fsm.act("READ",
+            reader.sink.valid.eq(1),
+            reader.sink.last.eq(rd_offset == (chunk_end - 1)),
+            If(reader.sink.ready,
+                NextValue(rd_offset, rd_offset + 1),
+                If(reader.sink.last,
+                    NextState("WRITE")
+                )
+            )
+        )
+        fsm.act("WRITE",
+            If(memset,
+                writer.sink.valid.eq(1),
+            ).Else(
+                writer.sink.valid.eq(reader.source.valid),
+                reader.source.ready.eq(writer.sink.ready),
+            ),
+            If(writer.sink.valid & writer.sink.ready,
+                NextValue(wr_offset, wr_offset + 1),
+                If(writer.sink.last,
+                    If(chunk_end == length,
+                        NextState("FLUSH")
+                    ).Else(
+                        NextValue(chunk_end, next_end),
+                        NextState("READ")
+                    )
+                )
+            )
+        )
+        fsm.act("FLUSH",
+            If(writer.fifo.level == 0,
+                self.ev.done.trigger.eq(1),
+                NextState("DONE")
+            )
+        )
+        fsm.act("DONE", self._done.status.eq(1))
@@ -19,19 +19,170 @@ from litedram.common           import LiteDRAMNativePort
 from litedram.frontend.adapter import LiteDRAMNativePortConverter
 
 
+# LiteDRAMWishbonePrefetcher -----------------------------------------------------------------------
+
+class _LiteDRAMWishbonePrefetcher(LiteXModule):
+    # Sequential read prefetcher between the Wishbone frontend (port_from) and the Native port.
+    #
+    # A read to the address following the previous one enables the prefetch: up to `depth` words
+    # following the demanded ones are read ahead and later reads are served from the buffered data.
+    # Another read (miss) or a write to a prefetched word drops the words read ahead (discarded
+    # when returned, in order, by the port). Writes of other masters are not seen: `invalidate`
+    # has to be pulsed after them to drop the words read ahead.
+    def __init__(self, port_from, port_to, depth):
+        assert port_from.data_width == port_to.data_width
+        self.invalidate = Signal()
+        buffer_depth = depth + 1
+
+        # # #
+
+        rdata_fifo = stream.SyncFIFO([("data", port_to.data_width)], buffer_depth)
+        self.submodules += rdata_fifo
+
+        active    = Signal()                          # Sequential reads detected.
+        need      = Signal()                          # Demanded read not yet issued.
+        addr      = Signal.like(port_from.cmd.addr)   # Address of the next sequential read.
+        next_addr = Signal.like(port_from.cmd.addr)   # Address of the next read to issue.
+        offset    = Signal.like(port_from.cmd.addr)
+        ahead     = Signal(max=depth + 1)             # Words read ahead (not demanded yet).
+        level     = Signal(max=buffer_depth + 1)      # Words issued and not yet consumed.
+        serve     = Signal(max=buffer_depth + 1)      # Words demanded and not yet returned.
+        drop      = Signal(max=buffer_depth + 1)      # Words to discard.
+
+        # Commands ---------------------------------------------------------------------------------
+        # Reads are not forwarded: hits claim a word read ahead, misses restart the sequence.
+        # Demanded reads go first (the following commands wait for them to preserve ordering),
+        # then writes and reads ahead. A presented read ahead is kept until accepted.
+        read_accept   = Signal()
+        write_accept  = Signal()
+        hit           = Signal()
+        need_issue    = Signal()
+        ahead_valid   = Signal()
+        ahead_issue   = Signal()
+        ahead_pending = Signal()
+        issue         = Signal()
+        claim         = Signal()
+        flush         = Signal()
+        flush_apply   = Signal()
+        drop_ahead    = Signal()
+        self.comb += [
+            hit.eq(port_from.cmd.addr == addr),
+            offset.eq(port_from.cmd.addr - addr),
+            # Invalidations are applied once no read is being issued.
+            flush_apply.eq(flush & ~need & ~ahead_pending),
+            drop_ahead.eq((write_accept & (offset < ahead)) | flush_apply),
+            port_to.cmd.last.eq(1),
+            port_to.cmd.addr.eq(next_addr),
+            If(need,
+                port_to.cmd.valid.eq(level < buffer_depth),
+                need_issue.eq(port_to.cmd.valid & port_to.cmd.ready)
+            ).Elif(port_from.cmd.valid & port_from.cmd.we & ~ahead_pending,
+                port_from.cmd.connect(port_to.cmd),
+                write_accept.eq(port_to.cmd.valid & port_to.cmd.ready)
+            ).Else(
+                ahead_valid.eq(active & (ahead < depth) & (level < buffer_depth) & ~flush),
+                port_to.cmd.valid.eq(ahead_valid),
+                ahead_issue.eq(port_to.cmd.valid & port_to.cmd.ready),
+                If((~ahead_valid | ahead_issue) & ~flush,
+                    port_from.cmd.ready.eq(port_from.cmd.valid & ~port_from.cmd.we &
+                        (serve < buffer_depth))
+                ),
+                read_accept.eq(port_from.cmd.valid & port_from.cmd.ready)
+            ),
+            issue.eq(need_issue | ahead_issue),
+            # A hit claims a word read ahead (possibly issued in the same cycle).
+            claim.eq(read_accept & hit & ((ahead != 0) | ahead_issue)),
+        ]
+        self.sync += [
+            ahead_pending.eq(ahead_valid & ~ahead_issue),
+            If(issue, next_addr.eq(next_addr + 1)),
+            If(need_issue, need.eq(0)),
+            ahead.eq(ahead + ahead_issue - claim),
+            If(read_accept,
+                active.eq(hit),
+                addr.eq(port_from.cmd.addr + 1),
+                If(~hit,
+                    next_addr.eq(port_from.cmd.addr),
+                    need.eq(1),
+                    ahead.eq(0)
+                ).Elif(~claim,
+                    need.eq(1)
+                )
+            ),
+            If(drop_ahead,
+                next_addr.eq(addr),
+                ahead.eq(0)
+            ),
+            If(self.invalidate,
+                flush.eq(1)
+            ).Elif(flush_apply,
+                flush.eq(0)
+            )
+        ]
+
+        # Data -------------------------------------------------------------------------------------
+        pop       = Signal()
+        pop_drop  = Signal()
+        pop_serve = Signal()
+        self.comb += [
+            port_from.wdata.connect(port_to.wdata),
+            port_to.rdata.connect(rdata_fifo.sink, omit={"bank"}),
+            If(drop != 0,
+                rdata_fifo.source.ready.eq(1),
+                pop_drop.eq(rdata_fifo.source.valid)
+            ).Elif(serve != 0,
+                rdata_fifo.source.connect(port_from.rdata),
+                pop_serve.eq(port_from.rdata.valid & port_from.rdata.ready)
+            ),
+            pop.eq(pop_drop | pop_serve),
+            port_to.flush.eq(port_from.flush),
+            port_to.hold.eq(port_from.hold),
+            port_from.lock.eq(port_to.lock),
+        ]
+        self.sync += [
+            level.eq(level + issue - pop),
+            serve.eq(serve + read_accept - pop_serve),
+            drop.eq(drop - pop_drop +
+                Mux((read_accept & ~hit) | drop_ahead, ahead + ahead_issue, 0)),
+        ]
+
 # LiteDRAMWishbone2Native --------------------------------------------------------------------------
 
 class LiteDRAMWishbone2Native(LiteXModule):
-    def __init__(self, wishbone, port, base_address=0x00000000):
+    """Wishbone to Native port
+
+    With `pipelined`, the Wishbone B4 pipelined protocol is used: a request is accepted on each
+    cycle `stb` is set without `stall` (`wishbone.stall` when the interface has one, `self.stall`
+    otherwise) and acknowledged in order later, so up to `max_outstanding` reads can overlap
+    their DRAM latency.
+
+    With `prefetch_depth`, sequential reads are detected and up to `prefetch_depth` Native words
+    following them are read ahead, the next reads being served from the prefetched data. Writes
+    to prefetched words invalidate them, but only the writes of this frontend are seen: when other
+    masters (DMAs, ...) write to memory read by the Wishbone master, `prefetcher.invalidate` has to
+    be pulsed after their writes, otherwise the prefetcher is only coherent when it is the only
+    writer.
+    """
+    def __init__(self, wishbone, port, base_address=0x00000000, pipelined=False, max_outstanding=4,
+        prefetch_depth=0):
+        assert wishbone.addressing == "word"
+
+        if prefetch_depth:
+            prefetch_port = LiteDRAMNativePort(
+                mode          = port.mode,
+                address_width = port.address_width,
+                data_width    = port.data_width
+            )
+            self.prefetcher = _LiteDRAMWishbonePrefetcher(prefetch_port, port, prefetch_depth)
+            port = prefetch_port
+
         wishbone_data_width = len(wishbone.dat_w)
         port_data_width     = 2**int(log2(len(port.wdata.data))) # Round to lowest power 2
         ratio               = wishbone_data_width/port_data_width
 
-        assert wishbone.addressing == "word"
-
         # Keep narrow Wishbone bursts on the real native-port width so
         # incrementing bursts can share a wider DRAM command.
-        if wishbone_data_width < port_data_width:
+        if wishbone_data_width < port_data_width and not pipelined:
             self._init_burst_upconverter(
                 wishbone, port, base_address, wishbone_data_width, port_data_width)
             return
@@ -54,6 +205,10 @@ class LiteDRAMWishbone2Native(LiteXModule):
         aborted = Signal()
         offset  = base_address >> log2_int(port.data_width//8)
 
+        if pipelined:
+            self._init_pipelined(wishbone, port, offset, max_outstanding)
+            return
+
         self.fsm = fsm = FSM(reset_state="CMD")
         self.comb += [
             port.cmd.addr.eq(wishbone.adr - offset),
@@ -81,14 +236,115 @@ class LiteDRAMWishbone2Native(LiteXModule):
             ),
         )
         self.comb += port.rdata.ready.eq(1)
-        fsm.act("READ",
-            NextValue(aborted, ~wishbone.cyc | aborted),
-            If(port.rdata.valid,
-                wishbone.ack.eq(wishbone.cyc & ~aborted),
-                wishbone.dat_r.eq(port.rdata.data),
-                NextState("CMD")
+        if not port.burst_width:
+            fsm.act("READ",
+                NextValue(aborted, ~wishbone.cyc | aborted),
+                If(port.rdata.valid,
+                    wishbone.ack.eq(wishbone.cyc & ~aborted),
+                    wishbone.dat_r.eq(port.rdata.data),
+                    NextState("CMD")
+                )
             )
-        )
+        else:
+            # Incrementing read bursts prefetch up to the native burst boundary; words not
+            # requested by the master are discarded once it moves to another access.
+            rd_fifo  = stream.SyncFIFO([("data", port.data_width)], 2**port.burst_width)
+            rd_words = Signal(max=2**port.burst_width + 1)
+            rd_addr  = Signal.like(port.cmd.addr)
+            rd_hit   = Signal()
+            self.submodules += rd_fifo
+            self.comb += [
+                If(~wishbone.we & (wishbone.cti == CTI_BURST_INCREMENTING),
+                    port.cmd.burst.eq(port.get_burst_max(port.cmd.addr))
+                ),
+                port.rdata.connect(rd_fifo.sink, omit={"bank"}),
+                rd_hit.eq(wishbone.stb & ~wishbone.we & (port.cmd.addr == rd_addr)),
+            ]
+            fsm.act("CMD",
+                NextValue(rd_words, port.cmd.burst + 1),
+                NextValue(rd_addr,  port.cmd.addr),
+            )
+            fsm.act("READ",
+                NextValue(aborted, ~wishbone.cyc | aborted),
+                If(rd_fifo.source.valid,
+                    If(wishbone.cyc & ~aborted & rd_hit,
+                        wishbone.ack.eq(1),
+                        wishbone.dat_r.eq(rd_fifo.source.data),
+                        rd_fifo.source.ready.eq(1)
+                    ).Elif(~wishbone.cyc | aborted | (wishbone.stb & ~rd_hit),
+                        rd_fifo.source.ready.eq(1)
+                    ),
+                    If(rd_fifo.source.ready,
+                        NextValue(rd_words, rd_words - 1),
+                        NextValue(rd_addr,  rd_addr  + 1),
+                        If(rd_words == 1,
+                            NextState("CMD")
+                        )
+                    )
+                )
+            )
+
+    def _init_pipelined(self, wishbone, port, offset, max_outstanding):
+        self.stall = getattr(wishbone, "stall", Signal())
+
+        # Requests are acknowledged in order: the type of the outstanding ones is tracked, the
+        # read data and the completion of the writes (data accepted by the port) are waited for.
+        ack_fifo   = stream.SyncFIFO([("we", 1)], max_outstanding)
+        wdata_fifo = stream.SyncFIFO([("data", port.data_width), ("we", port.data_width//8)],
+            max_outstanding)
+        rdata_fifo = stream.SyncFIFO([("data", port.data_width)], max_outstanding)
+        self.submodules += ack_fifo, wdata_fifo, rdata_fifo
+        wr_done    = Signal(max=max_outstanding + 1)
+        aborted    = Signal()
+
+        # Request ----------------------------------------------------------------------------------
+        # New requests wait for the responses of an aborted cycle to be drained.
+        request = Signal()
+        self.comb += [
+            request.eq(wishbone.cyc & wishbone.stb & ~aborted & ack_fifo.sink.ready &
+                (~wishbone.we | wdata_fifo.sink.ready)),
+            port.cmd.valid.eq(request),
+            port.cmd.addr.eq(wishbone.adr - offset),
+            port.cmd.we.eq(wishbone.we),
+            port.cmd.last.eq(wishbone.cti != CTI_BURST_INCREMENTING),
+            port.flush.eq(~wishbone.cyc),
+            self.stall.eq(~(request & port.cmd.ready)),
+            ack_fifo.sink.valid.eq(port.cmd.valid & port.cmd.ready),
+            ack_fifo.sink.we.eq(wishbone.we),
+            wdata_fifo.sink.valid.eq(port.cmd.valid & port.cmd.ready & wishbone.we),
+            wdata_fifo.sink.data.eq(wishbone.dat_w),
+            wdata_fifo.sink.we.eq(wishbone.sel),
+        ]
+
+        # Data -------------------------------------------------------------------------------------
+        self.comb += [
+            wdata_fifo.source.connect(port.wdata),
+            port.rdata.connect(rdata_fifo.sink, omit={"bank"}),
+        ]
+        wr_accepted = Signal()
+        self.comb += wr_accepted.eq(port.wdata.valid & port.wdata.ready)
+
+        # Response ---------------------------------------------------------------------------------
+        self.comb += [
+            wishbone.dat_r.eq(rdata_fifo.source.data),
+            If(ack_fifo.source.valid,
+                If(ack_fifo.source.we,
+                    ack_fifo.source.ready.eq(wr_done != 0)
+                ).Else(
+                    ack_fifo.source.ready.eq(rdata_fifo.source.valid),
+                    rdata_fifo.source.ready.eq(rdata_fifo.source.valid)
+                )
+            ),
+            wishbone.ack.eq(ack_fifo.source.ready & wishbone.cyc & ~aborted),
+        ]
+        self.sync += [
+            wr_done.eq(wr_done + wr_accepted - (ack_fifo.source.ready & ack_fifo.source.we)),
+            If(~ack_fifo.source.valid,
+                aborted.eq(0)
+            ).Elif(~wishbone.cyc,
+                aborted.eq(1)
+            )
+        ]
 
     def _init_burst_upconverter(self, wishbone, port, base_address, wishbone_data_width, port_data_width):
         assert port_data_width % wishbone_data_width == 0
@@ -141,13 +141,14 @@ def get_ddr2_phy_init_sequence(phy_settings, timing_settings):
 
 def get_ddr3_phy_init_sequence(phy_settings, timing_settings):
     cl  = phy_settings.cl
-    bl  = 8
+    bl  = "BC4/BL8" if getattr(phy_settings, "burst_chop", False) else 8 # On-the-fly with burst chop (A12).
     cwl = phy_settings.cwl
 
     def format_mr0(bl, cl, wr, dll_reset):
         bl_to_mr0 = {
             4: 0b10,
-            8: 0b00
+            8: 0b00,
+            "BC4/BL8": 0b01,
         }
         cl_to_mr0 = {
              5: 0b0010,
@@ -230,7 +231,7 @@ def get_ddr3_phy_init_sequence(phy_settings, timing_settings):
         ("Load Mode Register 2, CWL={0:d}".format(cwl), mr2, 2, cmds["MODE_REGISTER"], 0),
         ("Load Mode Register 3", mr3, 3, cmds["MODE_REGISTER"], 0),
         ("Load Mode Register 1", mr1, 1, cmds["MODE_REGISTER"], 0),
-        ("Load Mode Register 0, CL={0:d}, BL={1:d}".format(cl, bl), mr0, 0, cmds["MODE_REGISTER"], 200),
+        ("Load Mode Register 0, CL={0:d}, BL={1}".format(cl, bl), mr0, 0, cmds["MODE_REGISTER"], 200),
         ("ZQ Calibration", 0x0400, 0, "DFII_COMMAND_WE|DFII_COMMAND_CS", 200),
     ]
 
@@ -291,13 +292,14 @@ def get_rpc_phy_init_sequence(phy_settings, timing_settings):
 
 def get_ddr4_phy_init_sequence(phy_settings, timing_settings):
     cl  = phy_settings.cl
-    bl  = 8
+    bl  = "BC4/BL8" if getattr(phy_settings, "burst_chop", False) else 8 # On-the-fly with burst chop (A12).
     cwl = phy_settings.cwl
 
     def format_mr0(bl, cl, wr, dll_reset):
         bl_to_mr0 = {
             4: 0b10,
-            8: 0b00
+            8: 0b00,
+            "BC4/BL8": 0b01,
         }
         cl_to_mr0 = {
              9: 0b00000,
@@ -496,7 +498,7 @@ def get_ddr4_phy_init_sequence(phy_settings, timing_settings):
         ("Load Mode Register 4", mr4, 4, cmds["MODE_REGISTER"], 0),
         ("Load Mode Register 2, CWL={0:d}".format(cwl), mr2, 2, cmds["MODE_REGISTER"], 0),
         ("Load Mode Register 1", mr1, 1, cmds["MODE_REGISTER"], 0),
-        ("Load Mode Register 0, CL={0:d}, BL={1:d}".format(cl, bl), mr0, 0, cmds["MODE_REGISTER"], 200),
+        ("Load Mode Register 0, CL={0:d}, BL={1}".format(cl, bl), mr0, 0, cmds["MODE_REGISTER"], 200),
         ("ZQ Calibration", 0x0400, 0, "DFII_COMMAND_WE|DFII_COMMAND_CS", 200),
     ]
 
@@ -955,6 +957,9 @@ def get_sdram_phy_c_header(phy_settings, timing_settings, geom_settings):
     if phy_settings.is_clam_shell:
         assert phy_settings.memtype == "DDR4"
         r.define("SDRAM_PHY_CLAM_SHELL")
+    if getattr(phy_settings, "burst_chop", False):
+        # MR0 in on-the-fly BL8/BC4 mode: A12 is forced by the DFIInjector on software READ/WRITE (BL8).
+        r.define("SDRAM_PHY_BURST_CHOP")
 
     # Define memory size.
     supported_memory = 2**(geom_settings.bankbits +
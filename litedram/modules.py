@@ -24,17 +24,20 @@ from litedram.common import Settings, GeomSettings, TimingSettings
 
 # Timings ------------------------------------------------------------------------------------------
 
-_technology_timings = ["tREFI", "tWTR", "tCCD", "tRRD", "tZQCS"]
+_technology_timings = ["tREFI", "tWTR", "tCCD", "tRRD", "tZQCS", "tWTR_S", "tCCD_S", "tRRD_S"]
 
+# With bank groups (DDR4), tWTR/tCCD/tRRD are the same bank group timings (tWTR_L/tCCD_L/tRRD_L)
+# and tWTR_S/tCCD_S/tRRD_S the timings between different bank groups.
 class _TechnologyTimings(Settings):
-    def __init__(self, tREFI, tWTR, tCCD, tRRD, tZQCS=None):
+    def __init__(self, tREFI, tWTR, tCCD, tRRD, tZQCS=None, tWTR_S=None, tCCD_S=None, tRRD_S=None):
         self.set_attributes(locals())
 
 
-_speedgrade_timings = ["tRP", "tRCD", "tWR", "tRFC", "tFAW", "tRAS"]
+_speedgrade_timings = ["tRP", "tRCD", "tWR", "tRFC", "tFAW", "tRAS", "tRFCpb"]
 
+# On LPDDR4/LPDDR5, tRFC is the all-bank refresh cycle time (tRFCab) and tRFCpb the per-bank one.
 class _SpeedgradeTimings(Settings):
-    def __init__(self, tRP, tRCD, tWR, tRFC, tFAW, tRAS):
+    def __init__(self, tRP, tRCD, tWR, tRFC, tFAW, tRAS, tRFCpb=None):
         self.set_attributes(locals())
 
 # SPD ----------------------------------------------------------------------------------------------
@@ -254,6 +257,9 @@ class DDR4SPDData(DDR3SPDData):
             tCCD  = (4, tccd_l_min),
             tRRD  = (4, trrd_l_min),
             tZQCS = (128, 80),
+            tWTR_S = (2, twtr_s_min),
+            tCCD_S = (4, None),
+            tRRD_S = (4, trrd_s_min),
         )
         speedgrade_timings = _SpeedgradeTimings(
             tRP  = trp_min,
@@ -317,9 +323,10 @@ class SDRAMModule:
         self.rate          = rate
         self.speedgrade    = speedgrade
         self.geom_settings = GeomSettings(
-            bankbits = log2_int(self.nbanks),
-            rowbits  = log2_int(self.nrows),
-            colbits  = log2_int(self.ncols),
+            bankbits      = log2_int(self.nbanks),
+            rowbits       = log2_int(self.nrows),
+            colbits       = log2_int(self.ncols),
+            bankgroupbits = log2_int(getattr(self, "ngroups", 1)),
         )
         assert not (self.memtype != "DDR4" and fine_refresh_mode != None)
         assert fine_refresh_mode in [None, "1x", "2x", "4x"]
@@ -337,7 +344,11 @@ class SDRAMModule:
             tRRD  = None if self.get("tRRD") is None else self.ck_ns_to_cycles(self.get("tRRD")),
             tRC   = None if self.get("tRAS") is None else self.ck_ns_to_cycles(self.get("tRP") + self.get("tRAS")),
             tRAS  = None if self.get("tRAS") is None else self.ck_ns_to_cycles(self.get("tRAS")),
-            tZQCS = None if self.get("tZQCS") is None else self.ck_ns_to_cycles(self.get("tZQCS"))
+            tZQCS = None if self.get("tZQCS") is None else self.ck_ns_to_cycles(self.get("tZQCS")),
+            tWTR_S = None if self.get("tWTR_S") is None else self.ck_ns_to_cycles(self.get("tWTR_S")),
+            tCCD_S = None if self.get("tCCD_S") is None else self.ck_ns_to_cycles(self.get("tCCD_S")),
+            tRRD_S = None if self.get("tRRD_S") is None else self.ck_ns_to_cycles(self.get("tRRD_S")),
+            tRFCpb = None if self.get("tRFCpb") is None else self.ck_ns_to_cycles(self.get("tRFCpb")),
         )
         self.timing_settings.fine_refresh_mode = fine_refresh_mode
 
@@ -418,6 +429,7 @@ class SDRAMModule:
             nbanks = spd.nbanks
             nrows = spd.nrows
             ncols = spd.ncols
+            ngroups = getattr(spd, "ngroups", 1)
             technology_timings = spd.technology_timings
             speedgrade_timings = spd.speedgrade_timings
             # Save data for runtime verification
@@ -1105,7 +1117,7 @@ class EDY4016A(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 260), "2x": (None, 160),   "4x": (None, 110)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(28, 30), tRAS=32),
     }
@@ -1121,7 +1133,7 @@ class MT40A1G8(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 6.4), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 6.4), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
         "2666": _SpeedgradeTimings(tRP=13.50, tRCD=13.50, tWR=15, tRFC=trfc, tFAW=(20, 21), tRAS=32),
@@ -1138,7 +1150,7 @@ class MT40A2G8(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 6.4), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 6.4), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
         "2666": _SpeedgradeTimings(tRP=13.50, tRCD=13.50, tWR=15, tRFC=trfc, tFAW=(20, 21), tRAS=32),
@@ -1158,7 +1170,7 @@ class MT40A256M16(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192, "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 260), "2x": (None, 160), "4x": (None, 110)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(28, 35), tRAS=32),
     }
@@ -1174,7 +1186,7 @@ class MT40A512M8(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
         "2666": _SpeedgradeTimings(tRP=13.50, tRCD=13.50, tWR=15, tRFC=trfc, tFAW=(20, 21), tRAS=32),
@@ -1191,7 +1203,7 @@ class MT40A512M16(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=13.32, tRCD=13.32, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
     }
@@ -1209,7 +1221,7 @@ class KVR21SE15S84(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.7))
     speedgrade_timings = {
         "2133": _SpeedgradeTimings(tRP=13.5, tRCD=13.5, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=33),
     }
@@ -1225,7 +1237,7 @@ class MTA4ATF51264HZ(DDR4Module):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None))
     speedgrade_timings = {
         "2133": _SpeedgradeTimings(tRP=13.5, tRCD=13.5, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=33),
     }
@@ -1243,7 +1255,7 @@ class MTA18ASF2G72PZ(DDR4RegisteredModule):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, None), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 3.3))
     speedgrade_timings = {
         "2400": _SpeedgradeTimings(tRP=14.16, tRCD=14.16, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
         "2666": _SpeedgradeTimings(tRP=14.25, tRCD=14.25, tWR=15, tRFC=trfc, tFAW=(20, 25), tRAS=32),
@@ -1266,7 +1278,7 @@ class HMA82GR7DJR4N(DDR4RegisteredModule):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, 5), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, 5), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 2.5))
     speedgrade_timings = {
         "3200": _SpeedgradeTimings(tRP=13.75, tRCD=13.75, tWR=15, tRFC=trfc, tFAW=(16, 10), tRAS=32),
     }
@@ -1286,7 +1298,7 @@ class M393A2K40DB3(DDR4RegisteredModule):
     # timings
     trefi = {"1x": 64e6/8192,   "2x": (64e6/8192)/2, "4x": (64e6/8192)/4}
     trfc  = {"1x": (None, 350), "2x": (None, 260),   "4x": (None, 160)}
-    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, 5), tRRD=(4, 4.9), tZQCS=(128, 80))
+    technology_timings = _TechnologyTimings(tREFI=trefi, tWTR=(4, 7.5), tCCD=(4, 5), tRRD=(4, 4.9), tZQCS=(128, 80), tWTR_S=(2, 2.5), tCCD_S=(4, None), tRRD_S=(4, 2.5))
     speedgrade_timings = {
         "3200": _SpeedgradeTimings(tRP=13.75, tRCD=13.75, tWR=15, tRFC=trfc, tFAW=(16, 10), tRAS=32),
     }
@@ -1313,6 +1325,6 @@ class MT53E256M16D1(SDRAMModule):
     # the controller during this time, after ZQCAL LATCH we have to wait tZQLAT=max(8ck, 30ns)
     technology_timings = _TechnologyTimings(tREFI=32e6/8192, tWTR=(8, 10), tCCD=tccd["masked-write"], tRRD=(4, 10), tZQCS=None)
     speedgrade_timings = {
-        "1866": _SpeedgradeTimings(tRP=(3, 21), tRCD=(4, 18), tWR=(4, 18), tRFC=180, tFAW=40, tRAS=(3, 42)),  # TODO: tRAS_max
+        "1866": _SpeedgradeTimings(tRP=(3, 21), tRCD=(4, 18), tWR=(4, 18), tRFC=180, tFAW=40, tRAS=(3, 42), tRFCpb=90),  # TODO: tRAS_max
     }
     speedgrade_timings["default"] = speedgrade_timings["1866"]
@@ -108,6 +108,11 @@ class CommandsSim(Module, AutoCSR):
         # Active banks
         self.active_banks = Array([Signal() for _ in range(8)])
         self.active_rows = Array([Signal(17) for _ in range(8)])
+        # Refresh cycles left per bank (tRFCab/tRFCpb of an 8Gb density device)
+        self.trfcab = math.ceil(180e-9 * clk_freq)
+        self.trfcpb = math.ceil(90e-9 * clk_freq)
+        self.refresh_timers = Array([Signal(max=self.trfcab + 1) for _ in range(8)])
+        self.sync += [If(timer != 0, timer.eq(timer - 1)) for timer in self.refresh_timers]
         # Connection to DataSim
         self.data_en = TappedDelayLine(ntaps=20)
         self.data = data_cdc
@@ -314,12 +319,34 @@ class CommandsSim(Module, AutoCSR):
         )
 
     def refresh_handler(self):
+        bank = Signal(3)
         return self.cmd_one_step("REFRESH",
             cond = self.cs_high[:5] == 0b01000,
             comb = [
-                If(reduce(or_, self.active_banks),
-                    self.log.error("Not all banks precharged during REFRESH")
-                )
+                bank.eq(self.cs_low[:3]),
+                If(self.cs_high[5],
+                    If(reduce(or_, self.active_banks),
+                        self.log.error("Not all banks precharged during REFRESH")
+                    ),
+                    If(reduce(or_, [timer != 0 for timer in self.refresh_timers]),
+                        self.log.warn("tRFC violated: REFRESH during an ongoing refresh")
+                    ),
+                ).Else(
+                    self.log.info("REFRESH: bank = %d", bank),
+                    If(self.active_banks[bank],
+                        self.log.error("Bank not precharged during per-bank REFRESH: bank=%d", bank)
+                    ),
+                    If(self.refresh_timers[bank] != 0,
+                        self.log.warn("tRFCpb violated: REFRESH during an ongoing refresh: bank=%d", bank)
+                    ),
+                ),
+            ],
+            sync = [
+                If(self.cs_high[5],
+                    *[timer.eq(self.trfcab) for timer in self.refresh_timers]
+                ).Else(
+                    self.refresh_timers[bank].eq(self.trfcpb)
+                ),
             ]
         )
 
@@ -344,6 +371,9 @@ class CommandsSim(Module, AutoCSR):
                 If(self.active_banks[bank],
                     self.log.error("ACT on already active bank: bank=%d row=%d", bank, row)
                 ),
+                If(self.refresh_timers[bank] != 0,
+                    self.log.warn("tRFC violated: ACT on refreshing bank: bank=%d row=%d", bank, row)
+                ),
             ]
         )
 
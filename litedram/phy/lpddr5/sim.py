@@ -247,6 +247,13 @@ class CommandsSim(Module, AutoCSR):
         self.active_banks = Array([Signal(name=f"bank{i}_active") for i in range(self.nbanks)])
         self.active_rows = Array([Signal(18, name=f"bank{i}_active_row") for i in range(self.nbanks)])
 
+        # Refresh cycles left per bank (tRFCab/tRFCpb of an 8Gb density device)
+        self.check_timings = 1 if check_timings else 0
+        self.trfcab = math.ceil(210e-9 * ck_freq)
+        self.trfcpb = math.ceil(120e-9 * ck_freq)
+        self.refresh_timers = Array([Signal(max=self.trfcab + 1, name=f"bank{i}_refresh_timer") for i in range(self.nbanks)])
+        self.sync += [If(timer != 0, timer.eq(timer - 1)) for timer in self.refresh_timers]
+
         # MPC operand
         self.mpc_op  = Signal(8)
 
@@ -477,6 +484,9 @@ class CommandsSim(Module, AutoCSR):
                 If(self.active_banks[bank],
                     self.log.error("ACT on already active bank: bank=%d row=%d", bank, row)
                 ),
+                If((self.refresh_timers[bank] != 0) & self.check_timings,
+                    self.log.warn("tRFC violated: ACT on refreshing bank: bank=%d row=%d", bank, row)
+                ),
             ],
             wait_time = 8,  # tAAD
         )
@@ -509,16 +519,41 @@ class CommandsSim(Module, AutoCSR):
         )
 
     def refresh_handler(self):
-        # TODO: refresh tracking
-        bank = Signal(max=self.nbanks)
+        # In B16 mode a per-bank refresh is done on the (bank, bank+8) pair
+        bank = Signal(3)
         all_banks = Signal()
+        pair = [Signal(max=self.nbanks), Signal(max=self.nbanks)]
         return self.cmd_one_step("REFRESH",
             cond = self.ca_p[:7] == 0b0111000,
             body = [
                 all_banks.eq(self.ca_n[6]),
-                If(reduce(or_, self.active_banks),
-                    self.log.error("Not all banks precharged during REFRESH")
-                )
+                bank.eq(self.ca_n[:3]),
+                pair[0].eq(bank),
+                pair[1].eq(bank + 8),
+                If(all_banks,
+                    If(reduce(or_, self.active_banks),
+                        self.log.error("Not all banks precharged during REFRESH")
+                    ),
+                    If(reduce(or_, [timer != 0 for timer in self.refresh_timers]) & self.check_timings,
+                        self.log.warn("tRFCab violated: REFRESH during an ongoing refresh")
+                    ),
+                ).Else(
+                    self.log.debug("REFRESH: banks = %d, %d", pair[0], pair[1]),
+                    If(self.active_banks[pair[0]] | self.active_banks[pair[1]],
+                        self.log.error("Banks not precharged during per-bank REFRESH: banks=%d, %d", pair[0], pair[1])
+                    ),
+                    If(((self.refresh_timers[pair[0]] != 0) | (self.refresh_timers[pair[1]] != 0)) & self.check_timings,
+                        self.log.warn("tRFCpb violated: REFRESH during an ongoing refresh: banks=%d, %d", pair[0], pair[1])
+                    ),
+                ),
+                Sync(
+                    If(all_banks,
+                        *[timer.eq(self.trfcab) for timer in self.refresh_timers]
+                    ).Else(
+                        self.refresh_timers[pair[0]].eq(self.trfcpb),
+                        self.refresh_timers[pair[1]].eq(self.trfcpb),
+                    )
+                ),
             ]
         )
 
@@ -5,9 +5,7 @@
 # Copyright (c) 2020-2021 Antmicro <www.antmicro.com>
 # SPDX-License-Identifier: BSD-2-Clause
 
-# SDRAM simulation PHY at DFI level tested with SDR/DDR/DDR2/LPDDR/DDR3
-# TODO:
-# - add multirank support.
+# SDRAM simulation PHY at DFI level tested with SDR/DDR/DDR2/LPDDR/DDR3 (single or multi-rank)
 
 from migen import *
 
@@ -91,6 +89,7 @@ class DFIPhaseModel(Module):
     def __init__(self, dfi, n):
         phase = getattr(dfi, "p"+str(n))
 
+        self.cs_n         = phase.cs_n
         self.bank         = phase.bank
         self.address      = phase.address
 
@@ -107,12 +106,15 @@ class DFIPhaseModel(Module):
 
         # # #
 
+        # Command to any of the ranks (the targeted ones are decoded by the banks).
+        cs = Signal()
+        self.comb += cs.eq(phase.cs_n != (2**len(phase.cs_n) - 1))
         self.comb += [
-            If(~phase.cs_n & ~phase.ras_n & phase.cas_n,
+            If(cs & ~phase.ras_n & phase.cas_n,
                 self.activate.eq(phase.we_n),
                 self.precharge.eq(~phase.we_n)
             ),
-            If(~phase.cs_n & phase.ras_n & ~phase.cas_n,
+            If(cs & phase.ras_n & ~phase.cas_n,
                 self.write.eq(~phase.we_n),
                 self.read.eq(phase.we_n)
             )
@@ -224,7 +226,8 @@ class DFITimingsChecker(Module):
 
         self.timings = new_timings
 
-    def __init__(self, dfi, nbanks, nphases, timings, refresh_mode, memtype, verbose=False):
+    def __init__(self, dfi, nbanks, nphases, timings, refresh_mode, memtype, verbose=False,
+        bankgroupbits=0, nranks=1, burst_chop=False):
         self.logging_enabled = Signal(reset=1)
 
         self.prepare_timings(timings, refresh_mode, memtype)
@@ -236,91 +239,131 @@ class DFITimingsChecker(Module):
 
         phases = [getattr(dfi, "p" + str(n)) for n in range(nphases)]
 
-        last_cmd_ps = [[Signal.like(cnt) for _ in range(len(self.cmds))] for _ in range(nbanks)]
-        last_cmd    = [Signal(4) for i in range(nbanks)]
+        # Banks are monitored per rank (bank n of rank r is bank r*nbanks + n), tRRD/tFAW too.
+        last_cmd_ps = [[Signal.like(cnt) for _ in range(len(self.cmds))] for _ in range(nranks*nbanks)]
+        last_cmd    = [Signal(4) for i in range(nranks*nbanks)]
 
-        act_ps   = Array([Signal().like(cnt) for i in range(4)])
-        act_curr = Signal(max=4)
+        act_ps   = [Array([Signal().like(cnt) for i in range(4)]) for _ in range(nranks)]
+        act_curr = [Signal(max=4) for _ in range(nranks)]
 
-        ref_issued = Signal(nphases)
+        # With bank groups, tRRD_S applies between ACTs to different bank groups.
+        bankbits  = log2_int(nbanks)
+        act_group = [Signal(max(bankgroupbits, 1)) for _ in range(nranks)]
+
+        ref_issued = [Signal(nphases) for _ in range(nranks)]
+
+        rd_ps = Signal().like(cnt)
+
+        # tRTRS (data bus turnaround between ranks)
+        cas_ps   = Signal().like(cnt)
+        cas_rank = Signal(max=max(nranks, 2))
 
         for np, phase in enumerate(phases):
             ps = Signal().like(cnt)
             self.comb += ps.eq((cnt + np)*self.timings["tCK"])
-            state = Signal(4)
-            self.comb += state.eq(Cat(phase.we_n, phase.cas_n, phase.ras_n, phase.cs_n))
-            all_banks = Signal()
-
-            self.comb += all_banks.eq(
-                (self.cmds["REF"].enc == state) |
-                ((self.cmds["PRE"].enc == state) & phase.address[10])
-            )
+            for r in range(nranks):
+                state = Signal(4)
+                self.comb += state.eq(Cat(phase.we_n, phase.cas_n, phase.ras_n, phase.cs_n[r]))
+                all_banks = Signal()
+
+                self.comb += all_banks.eq(
+                    (self.cmds["REF"].enc == state) |
+                    ((self.cmds["PRE"].enc == state) & phase.address[10])
+                )
 
-            # tREFI
-            self.comb += ref_issued[np].eq(self.cmds["REF"].enc == state)
+                # tREFI
+                self.comb += ref_issued[r][np].eq(self.cmds["REF"].enc == state)
 
-            # Print debug information
-            if verbose:
-                for _, cmd in self.cmds.items():
+                # tRTW (data bus turnaround, checked across all banks)
+                if "tRTW" in self.timings:
+                    # With burst chop, a BC4 READ (A12 cleared) releases the data bus BL/4 earlier.
+                    rd_chop = 0
+                    if burst_chop:
+                        rd_chop = Mux(phase.address[12], 0, burst_lengths[memtype]//4*self.timings["tCK"])
                     self.sync += [
-                        If((state == cmd.enc) & self.logging_enabled,
-                            If(all_banks,
-                                Display("[%016dps] P%0d " + cmd.name, ps, np)
-                            ).Else(
-                                Display("[%016dps] P%0d B%0d " + cmd.name, ps, np, phase.bank)
-                            )
-                        )
+                        If(self.logging_enabled & (state == self.cmds["WR"].enc) &
+                           (ps < (rd_ps + self.timings["tRTW"])),
+                            Display("[%016dps] RD->WR tRTW violation", ps)
+                        ),
+                        If(state == self.cmds["RD"].enc, rd_ps.eq(ps - rd_chop))
                     ]
 
-            # Bank command monitoring
-            for i in range(nbanks):
-                for _, curr in self.cmds.items():
-                    cmd_recv = Signal()
-                    self.comb += cmd_recv.eq(((phase.bank == i) | all_banks) & (state == curr.enc))
-
-                    # Checking rules from self.rules
-                    for _, prev in self.cmds.items():
-                        for rule in self.rules:
-                            if rule.prev == prev.name and rule.curr == curr.name:
-                                self.sync += [
-                                    If(self.logging_enabled & cmd_recv & (last_cmd[i] == prev.enc) &
-                                       (ps < (last_cmd_ps[i][prev.idx] + rule.delay)),
-                                        Display("[%016dps] {} violation on bank %0d".format(rule.name), ps, i)
-                                    )
-                                ]
-
-                    # Save command timestamp in an array
-                    self.sync += If(cmd_recv, last_cmd_ps[i][curr.idx].eq(ps), last_cmd[i].eq(state))
-
-                    # tRRD & tFAW
-                    if curr.name == "ACT":
-                        act_next = Signal().like(act_curr)
-                        self.comb += act_next.eq(act_curr+1)
-
-                        # act_curr points to newest ACT timestamp
-                        self.sync += [
-                            If(self.logging_enabled & cmd_recv & (ps < (act_ps[act_curr] + self.timings["tRRD"])),
-                                Display("[%016dps] tRRD violation on bank %0d", ps, i)
-                            )
-                        ]
+                # tRTRS (reads/writes to different ranks)
+                if nranks > 1 and "tRTRS" in self.timings:
+                    cas = Signal()
+                    self.comb += cas.eq((state == self.cmds["RD"].enc) | (state == self.cmds["WR"].enc))
+                    self.sync += [
+                        If(self.logging_enabled & cas & (cas_rank != r) &
+                           (ps < (cas_ps + self.timings["tCCD"] + self.timings["tRTRS"])),
+                            Display("[%016dps] tRTRS violation on rank {}".format(r), ps)
+                        ),
+                        If(cas, cas_ps.eq(ps), cas_rank.eq(r))
+                    ]
 
-                        # act_next points to the oldest ACT timestamp
+                # Print debug information
+                if verbose:
+                    rank = "" if nranks == 1 else "R{} ".format(r)
+                    for _, cmd in self.cmds.items():
                         self.sync += [
-                            If(self.logging_enabled & cmd_recv & (ps < (act_ps[act_next] + self.timings["tFAW"])),
-                                Display("[%016dps] tFAW violation on bank %0d", ps, i)
+                            If((state == cmd.enc) & self.logging_enabled,
+                                If(all_banks,
+                                    Display("[%016dps] P%0d " + rank + cmd.name, ps, np)
+                                ).Else(
+                                    Display("[%016dps] P%0d " + rank + "B%0d " + cmd.name, ps, np, phase.bank)
+                                )
                             )
                         ]
 
-                        # Save ACT timestamp in a circular buffer
-                        self.sync += If(cmd_recv, act_ps[act_next].eq(ps), act_curr.eq(act_next))
-
-        # tREFI
-        ref_ps      = Signal().like(cnt)
-        ref_ps_mod  = Signal().like(cnt)
-        ref_ps_diff = Signal(min=-2**63, max=2**63)
-        curr_diff   = Signal().like(ref_ps_diff)
-
-        self.comb += curr_diff.eq(ps - (ref_ps + self.timings["tREFI"]))
+                # Bank command monitoring
+                for n in range(nbanks):
+                    i = r*nbanks + n
+                    for _, curr in self.cmds.items():
+                        cmd_recv = Signal()
+                        self.comb += cmd_recv.eq(((phase.bank == n) | all_banks) & (state == curr.enc))
+
+                        # Checking rules from self.rules
+                        for _, prev in self.cmds.items():
+                            for rule in self.rules:
+                                if rule.prev == prev.name and rule.curr == curr.name:
+                                    self.sync += [
+                                        If(self.logging_enabled & cmd_recv & (last_cmd[i] == prev.enc) &
+                                           (ps < (last_cmd_ps[i][prev.idx] + rule.delay)),
+                                            Display("[%016dps] {} violation on bank %0d".format(rule.name), ps, i)
+                                        )
+                                    ]
+
+                        # Save command timestamp in an array
+                        self.sync += If(cmd_recv, last_cmd_ps[i][curr.idx].eq(ps), last_cmd[i].eq(state))
+
+                        # tRRD & tFAW
+                        if curr.name == "ACT":
+                            act_next = Signal().like(act_curr[r])
+                            self.comb += act_next.eq(act_curr[r]+1)
+
+                            # act_curr points to newest ACT timestamp
+                            trrd = self.timings["tRRD"]
+                            if bankgroupbits and self.timings.get("tRRD_S", 0):
+                                group = n >> (bankbits - bankgroupbits)
+                                trrd  = Mux(act_group[r] == group, trrd, self.timings["tRRD_S"])
+                                self.sync += If(cmd_recv, act_group[r].eq(group))
+                            self.sync += [
+                                If(self.logging_enabled & cmd_recv & (ps < (act_ps[r][act_curr[r]] + trrd)),
+                                    Display("[%016dps] tRRD violation on bank %0d", ps, i)
+                                )
+                            ]
+
+                            # act_next points to the oldest ACT timestamp
+                            self.sync += [
+                                If(self.logging_enabled & cmd_recv & (ps < (act_ps[r][act_next] + self.timings["tFAW"])),
+                                    Display("[%016dps] tFAW violation on bank %0d", ps, i)
+                                )
+                            ]
+
+                            # Save ACT timestamp in a circular buffer
+                            self.sync += If(cmd_recv, act_ps[r][act_next].eq(ps), act_curr[r].eq(act_next))
+
+        # tREFI (per rank)
+        ref_ps_mod = Signal().like(cnt)
 
         # Work in 64ms periods
         self.sync += [
@@ -331,47 +374,58 @@ class DFITimingsChecker(Module):
             )
         ]
 
-        # Update timestamp and difference
-        self.sync += If(ref_issued != 0, ref_ps.eq(ps), ref_ps_diff.eq(ref_ps_diff - curr_diff))
+        for r in range(nranks):
+            ref_ps      = Signal().like(cnt)
+            ref_ps_diff = Signal(min=-2**63, max=2**63)
+            curr_diff   = Signal().like(ref_ps_diff)
 
-        self.sync += [
-            If((self.logging_enabled & ref_ps_mod == 0) & (ref_ps_diff > 0),
-                Display("[%016dps] tREFI violation (64ms period): %0d", ps, ref_ps_diff)
-            )
-        ]
+            self.comb += curr_diff.eq(ps - (ref_ps + self.timings["tREFI"]))
 
-        # Report any refresh periods longer than tREFI
-        if verbose:
-            ref_done = Signal()
-            self.sync += [
-                If(ref_issued != 0,
-                    ref_done.eq(1),
-                    If(self.logging_enabled & ~ref_done,
-                        Display("[%016dps] Late refresh", ps)
-                    )
-                )
-            ]
+            # Update timestamp and difference
+            self.sync += If(ref_issued[r] != 0, ref_ps.eq(ps), ref_ps_diff.eq(ref_ps_diff - curr_diff))
 
+            # Up to 8 refreshes can be pulled in (issued in advance) on >=DDR
+            ref_limit = {"1x": 9, "2x": 17, "4x": 36}
+            pull_in_limit = 0
+            if memtype != "SDR":
+                pull_in_limit = ref_limit["1x" if refresh_mode is None else refresh_mode] * self.timings["tREFI"]
             self.sync += [
-                If(self.logging_enabled & (curr_diff > 0) & ref_done & (ref_issued == 0),
-                    Display("[%016dps] tREFI violation", ps),
-                    ref_done.eq(0)
+                If(self.logging_enabled & (ref_ps_mod == 0) & (ref_ps_diff > pull_in_limit),
+                    Display("[%016dps] tREFI violation (64ms period): %0d", ps, ref_ps_diff)
                 )
             ]
 
-        # There is a maximum delay between refreshes on >=DDR
-        ref_limit = {"1x": 9, "2x": 17, "4x": 36}
-        if memtype != "SDR":
-            refresh_mode = "1x" if refresh_mode is None else refresh_mode
-            ref_done = Signal()
-            self.sync += If(ref_issued != 0, ref_done.eq(1))
-            self.sync += [
-                If(self.logging_enabled & (ref_issued == 0) & ref_done &
-                   (ref_ps > (ps + ref_limit[refresh_mode] * self.timings['tREFI'])),
-                    Display("[%016dps] tREFI violation (too many postponed refreshes)", ps),
-                    ref_done.eq(0)
-                )
-            ]
+            # Report any refresh periods longer than tREFI
+            if verbose:
+                ref_done = Signal()
+                self.sync += [
+                    If(ref_issued[r] != 0,
+                        ref_done.eq(1),
+                        If(self.logging_enabled & ~ref_done,
+                            Display("[%016dps] Late refresh", ps)
+                        )
+                    )
+                ]
+
+                self.sync += [
+                    If(self.logging_enabled & (curr_diff > 0) & ref_done & (ref_issued[r] == 0),
+                        Display("[%016dps] tREFI violation", ps),
+                        ref_done.eq(0)
+                    )
+                ]
+
+            # There is a maximum delay between refreshes on >=DDR
+            if memtype != "SDR":
+                refresh_mode = "1x" if refresh_mode is None else refresh_mode
+                ref_done = Signal()
+                self.sync += If(ref_issued[r] != 0, ref_done.eq(1))
+                self.sync += [
+                    If(self.logging_enabled & (ref_issued[r] == 0) & ref_done &
+                       (ref_ps > (ps + ref_limit[refresh_mode] * self.timings['tREFI'])),
+                        Display("[%016dps] tREFI violation (too many postponed refreshes)", ps),
+                        ref_done.eq(0)
+                    )
+                ]
 
 # SDRAM PHY Settings -------------------------------------------------------------------------------
 
@@ -384,7 +438,7 @@ sdram_module_nphases = {
     "DDR4":  4,
 }
 
-def get_sdram_phy_settings(memtype, data_width, clk_freq):
+def get_sdram_phy_settings(memtype, data_width, clk_freq, nranks=1):
     nphases = sdram_module_nphases[memtype]
 
     if memtype == "SDR":
@@ -439,6 +493,7 @@ def get_sdram_phy_settings(memtype, data_width, clk_freq):
         memtype      = memtype,
         databits     = data_width,
         dfi_databits = data_width if memtype == "SDR" else 2*data_width,
+        nranks       = nranks,
         **sdram_phy_settings,
     )
 
@@ -480,14 +535,15 @@ class SDRAMPHYModel(Module):
                 )[0:model_data_ratio]
             init = new_init
 
-        if address_mapping == "ROW_BANK_COL":
+        if address_mapping in ["ROW_BANK_COL", "ROW_BANK_COL_XOR"]:
+            xor = address_mapping == "ROW_BANK_COL_XOR"
             for row in range(nrows):
                 for bank in range(nbanks):
                     start = (row*nbanks*model_column_size + bank*model_column_size)
                     end   = min(start + model_column_size, len(init))
                     if start > len(init):
                         break
-                    bank_init[bank].extend(init[start:end])
+                    bank_init[bank ^ (row % nbanks) if xor else bank].extend(init[start:end])
         elif address_mapping == "BANK_ROW_COL":
             for bank in range(nbanks):
                 start = bank*model_bank_size
@@ -495,6 +551,11 @@ class SDRAMPHYModel(Module):
                 if start > len(init):
                     break
                 bank_init[bank] = init[start:end]
+        elif address_mapping == "ROW_COL_BANK":
+            for bank in range(nbanks):
+                bank_init[bank] = init[bank::nbanks]
+        else:
+            raise ValueError("Unsupported address mapping: {}".format(address_mapping))
 
         return bank_init
 
@@ -502,7 +563,8 @@ class SDRAMPHYModel(Module):
         we_granularity         = 8,
         init                   = [],
         address_mapping        = "ROW_BANK_COL",
-        verbosity              = SDRAM_VERBOSE_OFF):
+        verbosity              = SDRAM_VERBOSE_OFF,
+        nranks                 = 1):
 
         # PHY Settings -----------------------------------------------------------------------------
         if settings is None:
@@ -510,7 +572,8 @@ class SDRAMPHYModel(Module):
             settings = get_sdram_phy_settings(
                 memtype    = module.memtype,
                 data_width = data_width,
-                clk_freq   = clk_freq
+                clk_freq   = clk_freq,
+                nranks     = nranks
             )
 
         # Parameters -------------------------------------------------------------------------------
@@ -532,6 +595,11 @@ class SDRAMPHYModel(Module):
         self.settings = settings
         self.module   = module
 
+        # With burst chop, BC4 accesses (A12 cleared) only transfer the first half of the DFI
+        # data, from/to the half of the memory word selected by A2.
+        burst_chop = getattr(settings, "burst_chop", False)
+        assert not burst_chop or we_granularity
+
         # DFI Interface ----------------------------------------------------------------------------
         self.dfi = Interface(
             addressbits = addressbits,
@@ -544,6 +612,7 @@ class SDRAMPHYModel(Module):
         # # #
 
         nphases    = self.settings.nphases
+        nranks     = self.settings.nranks
         nbanks     = 2**bankbits
         nrows      = 2**rowbits
         ncols      = 2**colbits
@@ -563,23 +632,36 @@ class SDRAMPHYModel(Module):
                 key = self.module.timing_settings.fine_refresh_mode if name in REF else None
                 timings[name] = self.module.get(name, key)
 
+            if settings.memtype in ["DDR2", "DDR3", "DDR4"]:
+                # READ to WRITE turnaround on the data bus: RL + BL/2 - WL + 2.
+                trtw = settings.cl + burst_lengths[settings.memtype]//2 + 2 - settings.cwl
+                timings["tRTW"] = (trtw, None)
+
+            if nranks > 1:
+                # At least one idle clock on the data bus between bursts to different ranks.
+                timings["tRTRS"] = (1, None)
+
             timing_checker = DFITimingsChecker(
-                dfi          = self.dfi,
-                nbanks       = nbanks,
-                nphases      = nphases,
-                timings      = timings,
-                refresh_mode = self.module.timing_settings.fine_refresh_mode,
-                memtype      = settings.memtype,
-                verbose      = verbosity > SDRAM_VERBOSE_DBG)
+                dfi           = self.dfi,
+                nbanks        = nbanks,
+                nphases       = nphases,
+                timings       = timings,
+                refresh_mode  = self.module.timing_settings.fine_refresh_mode,
+                memtype       = settings.memtype,
+                verbose       = verbosity > SDRAM_VERBOSE_DBG,
+                bankgroupbits = getattr(module.geom_settings, "bankgroupbits", 0),
+                nranks        = nranks,
+                burst_chop    = burst_chop)
             self.submodules += timing_checker
 
         # Bank init data ---------------------------------------------------------------------------
-        bank_init  = [None for i in range(nbanks)]
+        # Banks of the ranks are seen as nranks*nbanks banks (rank bits above the bank bits).
+        bank_init  = [None for i in range(nranks*nbanks)]
 
         if init:
             bank_init = self.__prepare_bank_init_data(
                 init            = init,
-                nbanks          = nbanks,
+                nbanks          = nranks*nbanks,
                 nrows           = nrows,
                 ncols           = ncols,
                 data_width      = data_width,
@@ -594,18 +676,19 @@ class SDRAMPHYModel(Module):
             burst_length   = burst_length,
             nphases        = nphases,
             we_granularity = we_granularity,
-            init           = bank_init[i]) for i in range(nbanks)]
+            init           = bank_init[i]) for i in range(nranks*nbanks)]
         self.submodules += banks
 
         # Connect DFI phases to Banks (CMDs, Write datapath) ---------------------------------------
-        for nb, bank in enumerate(banks):
+        for i, bank in enumerate(banks):
+            rank, nb = divmod(i, nbanks)
             # Bank activate
             activates = Signal(len(phases))
             cases     = {}
             for np, phase in enumerate(phases):
                 self.comb += activates[np].eq(phase.activate)
                 cases[2**np] = [
-                    bank.activate.eq(phase.bank == nb),
+                    bank.activate.eq((phase.bank == nb) & ~phase.cs_n[rank]),
                     bank.activate_row.eq(phase.address)
                 ]
             self.comb += Case(activates, cases)
@@ -616,50 +699,69 @@ class SDRAMPHYModel(Module):
             for np, phase in enumerate(phases):
                 self.comb += precharges[np].eq(phase.precharge)
                 cases[2**np] = [
-                    bank.precharge.eq((phase.bank == nb) | phase.address[10])
+                    bank.precharge.eq(((phase.bank == nb) | phase.address[10]) & ~phase.cs_n[rank])
                 ]
             self.comb += Case(precharges, cases)
 
             # Bank writes
             bank_write = Signal()
             bank_write_col = Signal(max=ncols)
+            bank_write_chop = Signal(2) # BC4, upper half.
             writes = Signal(len(phases))
             cases  = {}
             for np, phase in enumerate(phases):
                 self.comb += writes[np].eq(phase.write)
                 cases[2**np] = [
-                    bank_write.eq(phase.bank == nb),
+                    bank_write.eq((phase.bank == nb) & ~phase.cs_n[rank]),
                     bank_write_col.eq(phase.address)
                 ]
+                if burst_chop:
+                    cases[2**np] += [bank_write_chop.eq(Cat(~phase.address[12], phase.address[2]))]
             self.comb += Case(writes, cases)
-            self.comb += [
-                bank.write_data.eq(Cat(*[phase.wrdata for phase in phases])),
-                bank.write_mask.eq(Cat(*[phase.wrdata_mask for phase in phases]))
-            ]
 
             # Simulate write latency
             for i in range(self.settings.write_latency):
-                new_bank_write     = Signal()
-                new_bank_write_col = Signal(max=ncols)
+                new_bank_write      = Signal()
+                new_bank_write_col  = Signal(max=ncols)
+                new_bank_write_chop = Signal(2)
                 self.sync += [
                     new_bank_write.eq(bank_write),
-                    new_bank_write_col.eq(bank_write_col)
+                    new_bank_write_col.eq(bank_write_col),
+                    new_bank_write_chop.eq(bank_write_chop)
                 ]
                 bank_write = new_bank_write
                 bank_write_col = new_bank_write_col
+                bank_write_chop = new_bank_write_chop
 
             self.comb += [
                 bank.write.eq(bank_write),
                 bank.write_col.eq(bank_write_col)
             ]
 
+            # Write data (first half of the data written to the selected half on BC4).
+            write_data = Cat(*[phase.wrdata for phase in phases])
+            write_mask = Cat(*[phase.wrdata_mask for phase in phases])
+            half       = data_width//2
+            self.comb += [
+                bank.write_data.eq(write_data),
+                bank.write_mask.eq(write_mask),
+                If(bank_write_chop[0],
+                    bank.write_data.eq(Cat(write_data[:half], write_data[:half])),
+                    If(bank_write_chop[1],
+                        bank.write_mask.eq(Cat(Replicate(1, half//8), write_mask[:half//8]))
+                    ).Else(
+                        bank.write_mask.eq(Cat(write_mask[:half//8], Replicate(1, half//8)))
+                    )
+                )
+            ]
+
             # Bank reads
             reads = Signal(len(phases))
             cases = {}
             for np, phase in enumerate(phases):
                 self.comb += reads[np].eq(phase.read)
                 cases[2**np] = [
-                    bank.read.eq(phase.bank == nb),
+                    bank.read.eq((phase.bank == nb) & ~phase.cs_n[rank]),
                     bank.read_col.eq(phase.address)
             ]
             self.comb += Case(reads, cases)
@@ -671,6 +773,20 @@ class SDRAMPHYModel(Module):
             banks_read.eq(reduce(or_, [bank.read for bank in banks])),
             banks_read_data.eq(reduce(or_, [bank.read_data for bank in banks]))
         ]
+        if burst_chop:
+            # BC4 READs of the upper half return it on the first half of the DFI data.
+            half           = data_width//2
+            read_upper     = Signal()
+            banks_read_raw = banks_read_data
+            banks_read_data = Signal(data_width)
+            self.comb += [
+                read_upper.eq(reduce(or_, [phase.read & ~phase.address[12] & phase.address[2]
+                    for phase in phases])),
+                banks_read_data.eq(banks_read_raw),
+                If(read_upper,
+                    banks_read_data.eq(Cat(banks_read_raw[half:], banks_read_raw[half:]))
+                )
+            ]
 
         # Simulate read latency --------------------------------------------------------------------
         for i in range(self.settings.read_latency):
@@ -71,8 +71,11 @@ class NativePortDriver:
                 yield
                 while (yield self.port.wdata.ready) == 0:
                     yield
-                yield self.port.wdata.valid.eq(0)
                 self.wdata.pop(0)
+                # present the next data right away (back-to-back writes)
+                if self.wdata:
+                    continue
+                yield self.port.wdata.valid.eq(0)
             yield
 
     @passive
@@ -233,6 +236,13 @@ class DRAMMemory:
             self._warn(address)
         return self.mem[address%self.depth]
 
+    @staticmethod
+    def _burst(dram_port):
+        # Number of words moved by the command (ports with native bursts).
+        if hasattr(dram_port.cmd, "burst"):
+            return (yield dram_port.cmd.burst) + 1
+        return 1
+
     @passive
     def read_handler(self, dram_port, rdata_valid_random=0):
         address = 0
@@ -242,16 +252,17 @@ class DRAMMemory:
         while True:
             yield dram_port.rdata.valid.eq(0)
             if pending:
-                while prng.randrange(100) < rdata_valid_random:
+                for i in range(pending):
+                    while prng.randrange(100) < rdata_valid_random:
+                        yield
+                    yield dram_port.rdata.valid.eq(1)
+                    yield dram_port.rdata.data.eq(self._read(address + i))
                     yield
-                yield dram_port.rdata.valid.eq(1)
-                yield dram_port.rdata.data.eq(self._read(address))
-                yield
-                yield dram_port.rdata.valid.eq(0)
-                yield dram_port.rdata.data.eq(0)
+                    yield dram_port.rdata.valid.eq(0)
+                    yield dram_port.rdata.data.eq(0)
                 pending = 0
             elif (yield dram_port.cmd.valid):
-                pending = not (yield dram_port.cmd.we)
+                pending = 0 if (yield dram_port.cmd.we) else (yield from self._burst(dram_port))
                 address = (yield dram_port.cmd.addr)
                 if pending:
                     yield dram_port.cmd.ready.eq(1)
@@ -268,19 +279,20 @@ class DRAMMemory:
         while True:
             yield dram_port.wdata.ready.eq(0)
             if pending:
-                while (yield dram_port.wdata.valid) == 0:
+                for i in range(pending):
+                    while (yield dram_port.wdata.valid) == 0:
+                        yield
+                    while prng.randrange(100) < wdata_ready_random:
+                        yield
+                    yield dram_port.wdata.ready.eq(1)
                     yield
-                while prng.randrange(100) < wdata_ready_random:
+                    self._write(address + i, (yield dram_port.wdata.data), (yield dram_port.wdata.we))
+                    yield dram_port.wdata.ready.eq(0)
                     yield
-                yield dram_port.wdata.ready.eq(1)
-                yield
-                self._write(address, (yield dram_port.wdata.data), (yield dram_port.wdata.we))
-                yield dram_port.wdata.ready.eq(0)
-                yield
                 pending = 0
                 yield
             elif (yield dram_port.cmd.valid):
-                pending = (yield dram_port.cmd.we)
+                pending = (yield from self._burst(dram_port)) if (yield dram_port.cmd.we) else 0
                 address = (yield dram_port.cmd.addr)
                 if pending:
                     yield dram_port.cmd.ready.eq(1)
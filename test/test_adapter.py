@@ -12,7 +12,9 @@ from migen import *
 from litex.soc.interconnect.stream import *
 
 from litedram.common import LiteDRAMNativePort, LiteDRAMNativeWritePort, LiteDRAMNativeReadPort
+from litedram.common import atomic_ops
 from litedram.frontend.adapter import LiteDRAMNativePortConverter, LiteDRAMNativePortCDC
+from litedram.frontend.adapter import LiteDRAMNativePortAtomic
 
 from test.common import *
 
@@ -406,3 +408,58 @@ class TestAdapter(MemoryTestDataMixin, unittest.TestCase):
             "native": (7, 3),
         }
         self.cdc_readback_test(dut, data["pattern"], data["expected"], clocks=clocks)
+
+    def test_atomic(self):
+        # Verify the operations of the atomic unit (on 2 lanes of 32-bit) and that other commands
+        # are passed through and completed before the atomic ones.
+        port_from = LiteDRAMNativePort("both", address_width=4, data_width=64, with_atomics=True)
+        port_to   = LiteDRAMNativePort("both", address_width=4, data_width=64)
+        dut       = LiteDRAMNativePortAtomic(port_from, port_to)
+        memory    = DRAMMemory(64, 16, init=[0, 0, 0xffffffff_00000005])
+        driver    = NativePortDriver(port_from)
+        results   = []
+
+        def atomic(address, op, data, compare=0, we=0xff):
+            yield port_from.cmd.atomic.eq(atomic_ops[op])
+            yield port_from.wdata.compare.eq(compare)
+            yield from driver.write(address, data, we=we)
+            yield port_from.cmd.atomic.eq(0)
+            driver.rdata_expected += 1
+            while len(driver.rdata) != driver.rdata_expected:
+                yield
+            results.append(driver.rdata[-1])
+
+        def main_generator():
+            yield from driver.write(4, 0x1234, wait_data=False)
+            yield from atomic(4,  "add", 0x00000001_00000001)
+            yield from atomic(2,  "add", 0x00000001_00000003)
+            yield from atomic(2, "swap", 0x11111111_22222222, we=0x0f)
+            yield from atomic(2,  "cas", 0x33333333_44444444, compare=0x00000000_22222222)
+            yield from atomic(2,  "cas", 0x55555555_55555555, compare=0x00000000_22222222)
+            yield from atomic(3,  "min", 0xfffffffe_00000007)
+            yield from atomic(3, "maxu", 0x00000001_00000001)
+            yield from atomic(3,  "max", 0x00000001_00000000)
+            yield from atomic(3, "minu", 0xffffffff_00000000)
+            results.append((yield from driver.read(2)))
+
+        generators = [
+            main_generator(),
+            *driver.generators(),
+            memory.write_handler(port_to),
+            memory.read_handler(port_to),
+            timeout_generator(2000),
+        ]
+        run_simulation(dut, generators)
+        self.assertEqual([hex(r) for r in results], [hex(r) for r in [
+            0x00000000_00001234, # add.
+            0xffffffff_00000005, # add (wraps).
+            0x00000000_00000008, # swap (lower lane).
+            0x00000000_22222222, # cas.
+            0x33333333_44444444, # cas (fails).
+            0x00000000_00000000, # min.
+            0xfffffffe_00000000, # maxu.
+            0xfffffffe_00000001, # max.
+            0x00000001_00000001, # minu.
+            0x33333333_44444444, # read.
+        ]])
+        self.assertEqual(memory.mem[3:5], [0x00000001_00000000, 0x00000001_00001235])
@@ -254,3 +254,39 @@ class TestAvalon(MemoryTestDataMixin, unittest.TestCase):
 
         run_simulation(dut, generators, vcd_name="avalon_" + self._testMethodName + ".vcd")
         self.assertEqual(dut.mem.mem, [0x89abcdef01234567, 0xc0ffee00deadbeef, 0xfedcba9876543210, 0, 0, 0])
+
+    def test_avalon_burst_native_bursts(self):
+        data = [0x01234567, 0x89abcdef, 0xdeadbeef, 0xc0ffee00, 0x76543210, 0xfedcba98]
+        cmds = []
+
+        def main_generator(dut):
+            yield from dut.avalon.bus_write(0x2, data)
+            yield
+            self.assertEqual((yield from dut.avalon.bus_read(0x0002, burstcount=6)), data[0])
+            for value in data[1:]:
+                self.assertEqual((yield dut.avalon.readdatavalid), 1)
+                self.assertEqual((yield from dut.avalon.continue_read_burst()), value)
+            yield
+            yield
+
+        @passive
+        def cmd_monitor(port):
+            while True:
+                if (yield port.cmd.valid) and (yield port.cmd.ready):
+                    cmds.append(((yield port.cmd.we), (yield port.cmd.addr), (yield port.cmd.burst)))
+                yield
+
+        avl  = avalon.AvalonMMInterface(adr_width=30, data_width=32)
+        port = LiteDRAMNativePort("both", address_width=30, data_width=32, burst_width=2)
+        dut = DUT(port, avl, base_address=0x0, mem_expected=[0]*8)
+        generators = [
+            main_generator(dut),
+            dut.mem.write_handler(dut.port),
+            dut.mem.read_handler(dut.port),
+            cmd_monitor(dut.port),
+        ]
+
+        run_simulation(dut, generators, vcd_name="avalon_" + self._testMethodName + ".vcd")
+        self.assertEqual(dut.mem.mem, [0, 0] + data)
+        # Bursts are split on the 4 words boundary.
+        self.assertEqual(cmds, [(1, 2, 1), (1, 4, 3), (0, 2, 1), (0, 4, 3)])
@@ -11,6 +11,8 @@ from migen import *
 
 from litedram.common import *
 from litedram.frontend.axi import *
+from litedram.frontend.axi import _LiteDRAMAXIBatchArbiter
+from litedram.frontend.adapter import LiteDRAMNativePortAtomic
 
 from test.common import *
 
@@ -69,6 +71,14 @@ def strb_to_mask(strb, data_width):
 # Test AXI -----------------------------------------------------------------------------------------
 
 class TestAXI(unittest.TestCase):
+    @passive
+    def cmd_counter(self, port):
+        self.cmds = 0
+        while True:
+            if (yield port.cmd.valid) and (yield port.cmd.ready):
+                self.cmds += 1
+            yield
+
     def _test_axi2native(self,
         naccesses=16, simultaneous_writes_reads=False,
         # Random: 0: min (no random), 100: max.
@@ -84,7 +94,10 @@ class TestAXI(unittest.TestCase):
         # Flow ready randomness
         w_ready_random  = 0,
         b_ready_random  = 0,
-        r_ready_random  = 0
+        r_ready_random  = 0,
+        # Native port
+        burst_width            = 0,
+        with_read_modify_write = True,
         ):
 
         def writes_cmd_generator(axi_port, writes):
@@ -193,8 +206,8 @@ class TestAXI(unittest.TestCase):
 
         # DUT
         axi_port  = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
-        dram_port = LiteDRAMNativePort("both", 32, 32)
-        dut       = LiteDRAMAXI2Native(axi_port, dram_port, with_read_modify_write=True)
+        dram_port = LiteDRAMNativePort("both", 32, 32, burst_width=burst_width)
+        dut       = LiteDRAMAXI2Native(axi_port, dram_port, with_read_modify_write=with_read_modify_write)
         mem       = DRAMMemory(32, 1024)
 
         # Generate writes/reads
@@ -224,7 +237,8 @@ class TestAXI(unittest.TestCase):
             reads_cmd_generator(axi_port, reads),
             reads_response_data_generator(axi_port, reads),
             mem.read_handler(dram_port, rdata_valid_random=r_valid_random),
-            mem.write_handler(dram_port, wdata_ready_random=w_ready_random)
+            mem.write_handler(dram_port, wdata_ready_random=w_ready_random),
+            self.cmd_counter(dram_port),
         ]
         run_simulation(dut, generators, vcd_name="sim.vcd")
         #mem.show_content()
@@ -313,6 +327,444 @@ class TestAXI(unittest.TestCase):
         run_simulation(dut, [axi_write_generator(), native_ready_monitor()])
         self.assertEqual(self.unreserved_wdata_errors, 0)
 
+    def test_axi2native_bursts(self):
+        # Consecutive beats are gathered into native burst commands.
+        self._test_axi2native(burst_width=2, with_read_modify_write=False)
+        self.assertLess(self.cmds, 2*sum(i + 1 for i in range(16)))
+        self._test_axi2native(
+            simultaneous_writes_reads = True,
+            len_rand_enable  = True,
+            data_rand_enable = True,
+            w_ready_random   = 50,
+            r_valid_random   = 50,
+            r_ready_random   = 50,
+            burst_width            = 2,
+            with_read_modify_write = False)
+
+    def test_axi2native_exclusive(self):
+        # Exclusive accesses are tracked by snooping writes and mapped on compare-and-swaps.
+        def axi_write(axi_port, addr, data, id, lock=0):
+            yield axi_port.aw.valid.eq(1)
+            yield axi_port.aw.addr.eq(addr<<2)
+            yield axi_port.aw.burst.eq(BURST_INCR)
+            yield axi_port.aw.len.eq(0)
+            yield axi_port.aw.size.eq(log2_int(32//8))
+            yield axi_port.aw.id.eq(id)
+            yield axi_port.aw.lock.eq(lock)
+            yield axi_port.w.valid.eq(1)
+            yield axi_port.w.data.eq(data)
+            yield axi_port.w.strb.eq(0xf)
+            yield axi_port.w.last.eq(1)
+            yield axi_port.b.ready.eq(1)
+            aw_done = w_done = False
+            while not (aw_done and w_done):
+                yield
+                aw_done |= bool((yield axi_port.aw.ready))
+                w_done  |= bool((yield axi_port.w.ready))
+                if aw_done:
+                    yield axi_port.aw.valid.eq(0)
+                if w_done:
+                    yield axi_port.w.valid.eq(0)
+            while not (yield axi_port.b.valid):
+                yield
+            self.assertEqual((yield axi_port.b.id), id)
+            resp = (yield axi_port.b.resp)
+            yield
+            yield axi_port.b.ready.eq(0)
+            return resp
+
+        def axi_read(axi_port, addr, id, lock=0):
+            yield axi_port.ar.valid.eq(1)
+            yield axi_port.ar.addr.eq(addr<<2)
+            yield axi_port.ar.burst.eq(BURST_INCR)
+            yield axi_port.ar.len.eq(0)
+            yield axi_port.ar.size.eq(log2_int(32//8))
+            yield axi_port.ar.id.eq(id)
+            yield axi_port.ar.lock.eq(lock)
+            yield
+            while not (yield axi_port.ar.ready):
+                yield
+            yield axi_port.ar.valid.eq(0)
+            yield axi_port.r.ready.eq(1)
+            while not (yield axi_port.r.valid):
+                yield
+            data, resp = (yield axi_port.r.data), (yield axi_port.r.resp)
+            yield
+            yield axi_port.r.ready.eq(0)
+            return data, resp
+
+        def snoop_write(snoop_port, addr):
+            # Write of another master accepted by the crossbar.
+            yield snoop_port.cmd.valid.eq(1)
+            yield snoop_port.cmd.ready.eq(1)
+            yield snoop_port.cmd.we.eq(1)
+            yield snoop_port.cmd.addr.eq(addr)
+            yield
+            yield snoop_port.cmd.valid.eq(0)
+            yield snoop_port.cmd.ready.eq(0)
+
+        def main_generator(axi_port, snoop_port):
+            responses = []
+            # Exclusive sequence succeeds once.
+            responses.append((yield from axi_read(axi_port, 0x10, id=1, lock=1)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x11111111, id=1, lock=1)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x22222222, id=1, lock=1)))
+            # Location modified between the exclusive read and write.
+            responses.append((yield from axi_read(axi_port, 0x10, id=2, lock=1)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x33333333, id=3)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x44444444, id=2, lock=1)))
+            # Exclusive write to another address.
+            responses.append((yield from axi_read(axi_port, 0x20, id=4, lock=1)))
+            responses.append((yield from axi_write(axi_port, 0x21, 0x55555555, id=4, lock=1)))
+            responses.append((yield from axi_read(axi_port, 0x10, id=5)))
+            # Location written with the same value (ABA), by this port or another master.
+            responses.append((yield from axi_read(axi_port, 0x10, id=6, lock=1)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x33333333, id=7)))
+            responses.append((yield from axi_write(axi_port, 0x10, 0x66666666, id=6, lock=1)))
+            responses.append((yield from axi_read(axi_port, 0x10, id=6, lock=1)))
+            yield from snoop_write(snoop_port, 0x10)
+            responses.append((yield from axi_write(axi_port, 0x10, 0x66666666, id=6, lock=1)))
+            # Write of another master to another address.
+            responses.append((yield from axi_read(axi_port, 0x10, id=6, lock=1)))
+            yield from snoop_write(snoop_port, 0x11)
+            responses.append((yield from axi_write(axi_port, 0x10, 0x77777777, id=6, lock=1)))
+            self.assertEqual(responses, [
+                (0x12345678, RESP_EXOKAY),
+                RESP_EXOKAY,
+                RESP_OKAY,
+                (0x11111111, RESP_EXOKAY),
+                RESP_OKAY,
+                RESP_OKAY,
+                (0, RESP_EXOKAY),
+                RESP_OKAY,
+                (0x33333333, RESP_OKAY),
+                (0x33333333, RESP_EXOKAY),
+                RESP_OKAY,
+                RESP_OKAY,
+                (0x33333333, RESP_EXOKAY),
+                RESP_OKAY,
+                (0x33333333, RESP_EXOKAY),
+                RESP_EXOKAY,
+            ])
+
+        for burst_width in [0, 2]:
+            with self.subTest(burst_width=burst_width):
+                axi_port  = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
+                user_port = LiteDRAMNativePort("both", 32, 32, burst_width=burst_width, with_atomics=True)
+                dram_port  = LiteDRAMNativePort("both", 32, 32, burst_width=burst_width)
+                snoop_port = LiteDRAMNativePort("both", 32, 32)
+                dut        = LiteDRAMAXI2Native(axi_port, user_port, snoop_ports=[snoop_port])
+                dut.submodules.atomic = LiteDRAMNativePortAtomic(user_port, dram_port)
+                mem        = DRAMMemory(32, 1024, init=[0]*0x10 + [0x12345678])
+                generators = [
+                    main_generator(axi_port, snoop_port),
+                    mem.read_handler(dram_port),
+                    mem.write_handler(dram_port),
+                    timeout_generator(4000),
+                ]
+                run_simulation(dut, generators)
+                self.assertEqual([mem.mem[0x10], mem.mem[0x21]], [0x77777777, 0])
+
+        # Without snooping, exclusive accesses are normal ones.
+        def main_generator_no_snoop(axi_port):
+            self.assertEqual((yield from axi_read(axi_port, 0x10, id=1, lock=1)),
+                (0x12345678, RESP_OKAY))
+            self.assertEqual((yield from axi_write(axi_port, 0x10, 0x11111111, id=1, lock=1)),
+                RESP_OKAY)
+            self.assertEqual((yield from axi_read(axi_port, 0x10, id=1)), (0x11111111, RESP_OKAY))
+
+        axi_port  = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
+        user_port = LiteDRAMNativePort("both", 32, 32, with_atomics=True)
+        dram_port = LiteDRAMNativePort("both", 32, 32)
+        dut       = LiteDRAMAXI2Native(axi_port, user_port)
+        dut.submodules.atomic = LiteDRAMNativePortAtomic(user_port, dram_port)
+        mem       = DRAMMemory(32, 1024, init=[0]*0x10 + [0x12345678])
+        run_simulation(dut, [
+            main_generator_no_snoop(axi_port),
+            mem.read_handler(dram_port),
+            mem.write_handler(dram_port),
+            timeout_generator(2000),
+        ])
+
+    def test_axi2native_narrow_fixed_wrap(self):
+        # Beats of narrow and FIXED bursts to the same word are merged in a single command.
+        def axi_write(axi_port, addr, burst, size, beats):
+            yield axi_port.aw.valid.eq(1)
+            yield axi_port.aw.addr.eq(addr)
+            yield axi_port.aw.burst.eq(burst)
+            yield axi_port.aw.len.eq(len(beats) - 1)
+            yield axi_port.aw.size.eq(size)
+            yield
+            while not (yield axi_port.aw.ready):
+                yield
+            yield axi_port.aw.valid.eq(0)
+            for i, (data, strb) in enumerate(beats):
+                yield axi_port.w.valid.eq(1)
+                yield axi_port.w.data.eq(data)
+                yield axi_port.w.strb.eq(strb)
+                yield axi_port.w.last.eq(i == len(beats) - 1)
+                yield
+                while not (yield axi_port.w.ready):
+                    yield
+            yield axi_port.w.valid.eq(0)
+            yield axi_port.b.ready.eq(1)
+            while not (yield axi_port.b.valid):
+                yield
+            yield
+            yield axi_port.b.ready.eq(0)
+
+        def axi_read(axi_port, addr, burst, size, length):
+            yield axi_port.ar.valid.eq(1)
+            yield axi_port.ar.addr.eq(addr)
+            yield axi_port.ar.burst.eq(burst)
+            yield axi_port.ar.len.eq(length - 1)
+            yield axi_port.ar.size.eq(size)
+            yield
+            while not (yield axi_port.ar.ready):
+                yield
+            yield axi_port.ar.valid.eq(0)
+            yield axi_port.r.ready.eq(1)
+            data = []
+            while len(data) < length:
+                if (yield axi_port.r.valid):
+                    data.append((yield axi_port.r.data))
+                    self.assertEqual((yield axi_port.r.last), len(data) == length)
+                yield
+            yield axi_port.r.ready.eq(0)
+            return data
+
+        def main_generator(axi_port, dram_port, cmds):
+            # Commands: narrow INCR: 2, FIXED: 1, narrow WRAP: 1, WRAP4: 4 (2 with native bursts).
+            ncmds = 2 + 1 + 1 + (2 if dram_port.burst_width else 4)
+            # Narrow INCR (bytes) over 2 words.
+            yield from axi_write(axi_port, 0x40, BURST_INCR, 0,
+                [((0x10 + i) << 8*(i%4), 1 << (i%4)) for i in range(8)])
+            # FIXED (FIFO-style), the last write of each byte wins.
+            yield from axi_write(axi_port, 0x80, BURST_FIXED, 2,
+                [(0x11111111*(i + 1), 0xf if i < 3 else 0x1) for i in range(4)])
+            # Narrow WRAP (half-words) in a word.
+            yield from axi_write(axi_port, 0xc2, BURST_WRAP, 1, [(0xbeef0000, 0xc), (0x0000dead, 0x3)])
+            # WRAP4 (critical word first).
+            yield from axi_write(axi_port, 0x108, BURST_WRAP, 2, [(0x100 + i, 0xf) for i in range(4)])
+            self.assertEqual(len(cmds), ncmds)
+            self.assertEqual(mem.mem[0x10:0x12], [0x13121110, 0x17161514])
+            self.assertEqual(mem.mem[0x20], 0x33333344)
+            self.assertEqual(mem.mem[0x30], 0xbeefdead)
+            self.assertEqual(mem.mem[0x40:0x44], [0x102, 0x103, 0x100, 0x101])
+            del cmds[:]
+            # Read back.
+            data = yield from axi_read(axi_port, 0x40, BURST_INCR, 0, 8)
+            self.assertEqual([(d >> 8*(i%4)) & 0xff for i, d in enumerate(data)], [0x10 + i for i in range(8)])
+            data = yield from axi_read(axi_port, 0x80, BURST_FIXED, 2, 4)
+            self.assertEqual(data, [0x33333344]*4)
+            data = yield from axi_read(axi_port, 0xc2, BURST_WRAP, 1, 2)
+            self.assertEqual([data[0] >> 16, data[1] & 0xffff], [0xbeef, 0xdead])
+            data = yield from axi_read(axi_port, 0x108, BURST_WRAP, 2, 4)
+            self.assertEqual(data, [0x100 + i for i in range(4)])
+            self.assertEqual(len(cmds), ncmds)
+
+        for burst_width in [0, 2]:
+            with self.subTest(burst_width=burst_width):
+                axi_port  = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
+                dram_port = LiteDRAMNativePort("both", 32, 32, burst_width=burst_width)
+                dut       = LiteDRAMAXI2Native(axi_port, dram_port)
+                mem       = DRAMMemory(32, 1024)
+                cmds      = []
+
+                @passive
+                def cmd_monitor():
+                    while True:
+                        if (yield dram_port.cmd.valid) and (yield dram_port.cmd.ready):
+                            cmds.append((yield dram_port.cmd.addr))
+                        yield
+
+                generators = [
+                    main_generator(axi_port, dram_port, cmds),
+                    mem.read_handler(dram_port),
+                    mem.write_handler(dram_port),
+                    cmd_monitor(),
+                    timeout_generator(2000),
+                ]
+                run_simulation(dut, generators)
+
+    def test_axi2native_batching(self):
+        # Same-direction commands of a mixed stream are grouped, favoring the hinted direction.
+        n = 32
+
+        def writes_generator(axi_port):
+            yield axi_port.b.ready.eq(1)
+            for i in range(n):
+                yield axi_port.aw.valid.eq(1)
+                yield axi_port.aw.addr.eq((0x100 + i)<<2)
+                yield axi_port.aw.burst.eq(BURST_INCR)
+                yield axi_port.aw.size.eq(log2_int(32//8))
+                yield axi_port.w.valid.eq(1)
+                yield axi_port.w.data.eq(i)
+                yield axi_port.w.strb.eq(0xf)
+                yield axi_port.w.last.eq(1)
+                aw_done = w_done = False
+                while not (aw_done and w_done):
+                    yield
+                    aw_done |= bool((yield axi_port.aw.ready))
+                    w_done  |= bool((yield axi_port.w.ready))
+                    if aw_done:
+                        yield axi_port.aw.valid.eq(0)
+                    if w_done:
+                        yield axi_port.w.valid.eq(0)
+            for _ in range(64):
+                yield
+
+        def reads_generator(axi_port, data):
+            yield axi_port.r.ready.eq(1)
+            for i in range(n):
+                yield axi_port.ar.valid.eq(1)
+                yield axi_port.ar.addr.eq((0x200 + i)<<2)
+                yield axi_port.ar.burst.eq(BURST_INCR)
+                yield axi_port.ar.size.eq(log2_int(32//8))
+                yield
+                while not (yield axi_port.ar.ready):
+                    yield
+                yield axi_port.ar.valid.eq(0)
+                while not (yield axi_port.r.valid):
+                    yield
+                data.append((yield axi_port.r.data))
+
+        @passive
+        def cmd_monitor(port, cmds):
+            while True:
+                if (yield port.cmd.valid) and (yield port.cmd.ready):
+                    cmds.append((yield port.cmd.we))
+                yield
+
+        def run(**kwargs):
+            axi_port  = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
+            dram_port = LiteDRAMNativePort("both", 32, 32)
+            dut       = LiteDRAMAXI2Native(axi_port, dram_port, **kwargs)
+            mem       = DRAMMemory(32, 1024, init=[0]*0x200 + [0x1000 + i for i in range(n)])
+            data      = []
+            cmds      = []
+            generators = [
+                writes_generator(axi_port),
+                reads_generator(axi_port, data),
+                mem.read_handler(dram_port),
+                mem.write_handler(dram_port),
+                cmd_monitor(dram_port, cmds),
+                timeout_generator(5000),
+            ]
+            run_simulation(dut, generators)
+            self.assertEqual(mem.mem[0x100:0x100 + n], list(range(n)))
+            self.assertEqual(data, [0x1000 + i for i in range(n)])
+            return cmds
+
+        def switches(cmds):
+            return sum(a != b for a, b in zip(cmds, cmds[1:]))
+
+        round_robin = run()
+        batched     = run(batch_window=8)
+        self.assertLess(switches(batched), switches(round_robin)//2)
+        for hint in [0, 1]:
+            with self.subTest(write_hint=hint):
+                cmds = run(batch_window=8, write_hint=Constant(hint))
+                self.assertEqual(cmds[0], hint)
+
+    def test_axi2native_batch_arbiter(self):
+        # Batches are counted in accepted commands, not in cycles where the arbiter is enabled.
+        def generator(dut, grants):
+            yield dut.request.eq(0b11)
+            yield dut.ce.eq(1)
+            for accepted in [0]*16 + [1]*8 + [0]*16 + [1]*4:
+                yield dut.accepted.eq(accepted)
+                yield
+                grants.append((yield dut.grant))
+
+        dut    = _LiteDRAMAXIBatchArbiter(window=4)
+        grants = []
+        run_simulation(dut, generator(dut, grants))
+        # Idle cycles do not consume the batch, each batch lasts 4 accepted commands.
+        self.assertEqual(grants[:16], [0]*16)
+        self.assertEqual(grants[16:24], [0, 0, 0, 0, 1, 1, 1, 1])
+        self.assertEqual(grants[24:40], [0]*16)
+
+    def test_axi2native_multi(self):
+        # Reads of IDs mapped on different ports are returned out of order, reads of an ID in order.
+        reads = [ # (id, addr, len)
+            (1, 0x100, 3), (0, 0x200, 3), (3, 0x110, 1), (2, 0x210, 1), (1, 0x120, 0), (0, 0x220, 0),
+            (1, 0x300, 0), (0, 0x300, 0),
+        ]
+
+        def main_generator(axi_port, beats):
+            # Write (first port) then read back from both ports.
+            yield axi_port.aw.valid.eq(1)
+            yield axi_port.aw.addr.eq(0x300<<2)
+            yield axi_port.aw.burst.eq(BURST_INCR)
+            yield axi_port.aw.size.eq(log2_int(32//8))
+            yield axi_port.w.valid.eq(1)
+            yield axi_port.w.data.eq(0xcafe)
+            yield axi_port.w.strb.eq(0xf)
+            yield axi_port.w.last.eq(1)
+            yield axi_port.b.ready.eq(1)
+            while not (yield axi_port.b.valid):
+                yield
+                if (yield axi_port.aw.ready):
+                    yield axi_port.aw.valid.eq(0)
+                if (yield axi_port.w.ready):
+                    yield axi_port.w.valid.eq(0)
+            yield
+            for id, addr, length in reads:
+                yield axi_port.ar.valid.eq(1)
+                yield axi_port.ar.addr.eq(addr<<2)
+                yield axi_port.ar.burst.eq(BURST_INCR)
+                yield axi_port.ar.len.eq(length)
+                yield axi_port.ar.size.eq(log2_int(32//8))
+                yield axi_port.ar.id.eq(id)
+                yield
+                while not (yield axi_port.ar.ready):
+                    yield
+            yield axi_port.ar.valid.eq(0)
+            while len(beats) < sum(length + 1 for id, addr, length in reads):
+                yield
+
+        @passive
+        def r_monitor(axi_port, beats):
+            yield axi_port.r.ready.eq(1)
+            while True:
+                if (yield axi_port.r.valid):
+                    beats.append(((yield axi_port.r.id), (yield axi_port.r.data), (yield axi_port.r.last)))
+                yield
+
+        for burst_width in [0, 2]:
+            with self.subTest(burst_width=burst_width):
+                axi_port   = LiteDRAMAXIPort(data_width=32, address_width=32, id_width=8)
+                dram_ports = [LiteDRAMNativePort("both", 32, 32, burst_width=burst_width) for _ in range(2)]
+                dut        = LiteDRAMAXI2NativeMulti(axi_port, dram_ports)
+                mem        = DRAMMemory(32, 1024, init=list(range(1024)))
+                beats      = []
+                generators = [
+                    main_generator(axi_port, beats),
+                    r_monitor(axi_port, beats),
+                    mem.write_handler(dram_ports[0]),
+                    mem.read_handler(dram_ports[0]),
+                    mem.read_handler(dram_ports[1], rdata_valid_random=90),
+                    timeout_generator(5000),
+                ]
+                run_simulation(dut, generators)
+                # Reads of each ID in order.
+                for _id in range(4):
+                    expected = []
+                    for id, addr, length in reads:
+                        if id == _id:
+                            expected += [0xcafe if addr == 0x300 else addr + i for i in range(length + 1)]
+                    self.assertEqual([data for id, data, last in beats if id == _id], expected)
+                # Bursts not interleaved.
+                bursts = []
+                for id, data, last in beats:
+                    if not bursts or bursts[-1][1]:
+                        bursts.append([id, False])
+                    self.assertEqual(bursts[-1][0], id)
+                    bursts[-1][1] = last
+                # Slow port reads overtaken by the reads of the first port.
+                self.assertEqual([id for id, _ in bursts][:3], [0, 2, 0])
+
     # Now let's stress things a bit... :)
     def test_axi2native_random_all(self):
         self._test_axi2native(
@@ -113,11 +113,19 @@ class TestBankMachine(unittest.TestCase):
     def bankmachine_commands_test(self, dut, requests, generators=None):
         # Perform a test by simulating requests producer and return registered commands
         commands = []
+        served   = []
 
         def producer(dut):
             for req in requests:
                 yield dut.bankmachine.req.addr.eq(req["addr"])
                 yield dut.bankmachine.req.we.eq(req["we"])
+                if "tag" in req:
+                    yield dut.bankmachine.req.tag.eq(req["tag"])
+                if "burst" in req:
+                    yield dut.bankmachine.req.burst.eq(req["burst"])
+                if "chop" in req:
+                    yield dut.bankmachine.req.chop.eq(req["chop"])
+                    yield dut.bankmachine.req.chop_upper.eq(req.get("chop_upper", 0))
                 yield dut.bankmachine.req.valid.eq(1)
                 yield
                 while not (yield dut.bankmachine.req.ready):
@@ -132,9 +140,12 @@ class TestBankMachine(unittest.TestCase):
                     signal = dut.bankmachine.req.wdata_ready
                 else:
                     signal = dut.bankmachine.req.rdata_valid
-                while not (yield signal):
+                for i in range(req.get("burst", 0) + 1):
+                    while not (yield signal):
+                        yield
+                    if "tag" in req and i == 0:
+                        served.append((yield dut.bankmachine.req.data_tag))
                     yield
-                yield
 
         @passive
         def cmd_consumer(dut):
@@ -156,6 +167,7 @@ class TestBankMachine(unittest.TestCase):
         if generators is not None:
             all_generators += [g(dut) for g in generators]
         run_simulation(dut, all_generators)
+        self.served_tags = served
         return commands
 
     def test_opens_correct_row(self):
@@ -260,6 +272,149 @@ class TestBankMachine(unittest.TestCase):
         ]
         self.assertEqual(commands, expected)
 
+    def test_reordering_row_hits_first(self):
+        # Verify that row hits from other masters are served before older row misses.
+        settings = dict(cmd_buffer_reordering=True, cmd_buffer_max_age=16, cmd_buffer_tag_width=2)
+        dut      = BankMachineDUT(1, controller_settings=settings, timing_settings=dict(tRC=8))
+        requests = [
+            dict(addr=dut.req_address(row=0xba, col=0x01), we=0, tag=0),
+            dict(addr=dut.req_address(row=0xda, col=0x02), we=0, tag=1),
+            dict(addr=dut.req_address(row=0xba, col=0x03), we=0, tag=2),
+            dict(addr=dut.req_address(row=0xba, col=0x04), we=0, tag=1),
+        ]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests)
+        commands = [(cmd["type"], cmd["a"]) for cmd in commands]
+        expected = [
+            ("activate",  0xba),
+            ("read",      0x01 << dut.address_align),
+            # Row hit of master 2 bypasses row miss of master 1.
+            ("read",     (0x03 << dut.address_align) | (1 << 10)),
+            ("activate",  0xda),
+            # Row hit of master 1 must wait for its older row miss.
+            ("read",     (0x02 << dut.address_align) | (1 << 10)),
+            ("activate",  0xba),
+            ("read",      0x04 << dut.address_align),
+        ]
+        self.assertEqual(commands, expected)
+        self.assertEqual(self.served_tags, [0, 2, 1, 1])
+
+    def test_reordering_max_age(self):
+        # Verify that the oldest request is forced once it has been bypassed max_age times.
+        for max_age, n_bypass in [(0, 0), (2, 2), (16, 6)]:
+            with self.subTest(max_age=max_age):
+                settings = dict(cmd_buffer_reordering=True, cmd_buffer_max_age=max_age,
+                    cmd_buffer_tag_width=3)
+                dut      = BankMachineDUT(1, controller_settings=settings, timing_settings=dict(tRC=8))
+                requests  = [dict(addr=dut.req_address(row=0xba, col=0), we=0, tag=0)]
+                requests += [dict(addr=dut.req_address(row=0xda, col=0), we=0, tag=1)]
+                requests += [dict(addr=dut.req_address(row=0xba, col=i), we=0, tag=2+i%6)
+                    for i in range(1, 7)]
+                self.bankmachine_commands_test(dut=dut, requests=requests)
+                self.assertEqual(self.served_tags.index(1), 1 + n_bypass)
+
+    def page_policy_generator(self, timeout=0, learning=0):
+        def generator(dut):
+            yield dut.bankmachine.page_timeout.eq(timeout)
+            yield dut.bankmachine.page_learning.eq(learning)
+            yield
+        return generator
+
+    def test_cmd_age(self):
+        # Verify that the age of the request being served counts up while it waits and is reset
+        # once it is served.
+        ages = []
+
+        @passive
+        def age_monitor(dut):
+            while True:
+                ages.append((yield dut.bankmachine.age))
+                yield
+
+        dut      = BankMachineDUT(1, controller_settings=dict(cmd_age_threshold=16))
+        requests = [dict(addr=dut.req_address(row=0xba, col=0xad), we=1, delay=8)]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests,
+            generators=[age_monitor])
+        self.assertEqual([cmd["type"] for cmd in commands], ["activate", "write"])
+        waiting = [age for age in ages if age != 0]
+        self.assertNotEqual(waiting, [])
+        self.assertEqual(waiting, list(range(1, len(waiting) + 1)))
+        self.assertEqual(ages[-1], 0)
+
+    def test_perf_events(self):
+        # Verify that requests are classified as row miss/hit/conflict when reaching the head of
+        # the command buffer and that activates/precharges are reported.
+        events = {name: 0 for name in ["row_hit", "row_miss", "row_conflict", "activate", "precharge"]}
+
+        @passive
+        def perf_monitor(dut):
+            while True:
+                for name in events:
+                    events[name] += (yield getattr(dut.bankmachine.perf, name))
+                yield
+
+        dut      = BankMachineDUT(1, controller_settings=dict(with_perfmon=True))
+        requests = [
+            dict(addr=dut.req_address(row=0xba, col=0xad), we=1, delay=8),
+            dict(addr=dut.req_address(row=0xba, col=0xbe), we=0, delay=8),
+            dict(addr=dut.req_address(row=0xbb, col=0xad), we=0, delay=8),
+        ]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests,
+            generators=[perf_monitor])
+        self.assertEqual([cmd["type"] for cmd in commands],
+            ["activate", "write", "read", "precharge", "activate", "read"])
+        self.assertEqual(events, dict(row_hit=1, row_miss=1, row_conflict=1, activate=2, precharge=1))
+
+    def test_page_policy_idle_timeout(self):
+        # Verify that the opened row is precharged after being idle for page_timeout cycles.
+        for timeout in [0, 4]:
+            with self.subTest(timeout=timeout):
+                dut      = BankMachineDUT(1, controller_settings=dict(page_timeout=timeout))
+                requests = [
+                    dict(addr=dut.req_address(row=0xba, col=0xad), we=1, delay=32),
+                    dict(addr=dut.req_address(row=0xba, col=0xbe), we=1),
+                ]
+                commands = self.bankmachine_commands_test(dut=dut, requests=requests,
+                    generators=[self.page_policy_generator(timeout=timeout)])
+                commands = [cmd["type"] for cmd in commands]
+                if timeout:
+                    expected = ["activate", "write", "precharge", "activate", "write"]
+                else:
+                    expected = ["activate", "write", "write"]
+                self.assertEqual(commands, expected)
+
+    def test_page_policy_learning(self):
+        # Verify that a bank missing the opened row switches to closed-page (auto-precharge).
+        dut      = BankMachineDUT(1, controller_settings=dict(with_page_learning=True))
+        requests = [dict(addr=dut.req_address(row=0x10 + i, col=0xad), we=1, delay=16)
+            for i in range(8)]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests,
+            generators=[self.page_policy_generator(learning=1)])
+        writes = [cmd for cmd in commands if cmd["type"] == "write"]
+        # Open-page first: rows are kept opened and precharged when another row is requested.
+        self.assertEqual(writes[0]["a"] & (1 << 10), 0)
+        self.assertEqual([cmd["type"] for cmd in commands[:4]],
+            ["activate", "write", "precharge", "activate"])
+        # Closed-page once enough misses have been seen.
+        self.assertEqual(writes[-1]["a"] & (1 << 10), 1 << 10)
+        self.assertNotIn("precharge", [cmd["type"] for cmd in commands[-4:]])
+
+    def test_write_batching_nwrites(self):
+        # Verify that queued writes are counted until their data is requested.
+        counts = []
+
+        @passive
+        def nwrites_monitor(dut):
+            while True:
+                counts.append((yield dut.bankmachine.nwrites))
+                yield
+
+        dut      = BankMachineDUT(1, controller_settings=dict(write_high_watermark=4))
+        requests = [dict(addr=dut.req_address(row=0xba, col=i), we=i%2) for i in range(8)]
+        requests += [dict(addr=dut.req_address(row=0xba, col=8), we=0, delay=4)]
+        self.bankmachine_commands_test(dut=dut, requests=requests, generators=[nwrites_monitor])
+        self.assertGreater(max(counts), 1)
+        self.assertEqual(counts[-1], 0)
+
     def test_burst_no_request_lost(self):
         # Verify that no request is lost in fast bursts of requests regardless of cmd_buffer_depth.
         for cmd_buffer_depth in [8, 1, 0]:
@@ -274,6 +429,50 @@ class TestBankMachine(unittest.TestCase):
                 commands = [(cmd["type"], cmd["a"]) for cmd in commands]
                 self.assertEqual(commands, expected)
 
+    def test_native_bursts(self):
+        # Verify that bursts are expanded into consecutive column accesses of the row and that
+        # auto-precharge is only done on the last one.
+        dut = BankMachineDUT(1, controller_settings=dict(cmd_burst_length=4))
+        requests = [
+            dict(addr=dut.req_address(row=0xba, col=0x04), we=1, burst=3),
+            dict(addr=dut.req_address(row=0xba, col=0x09), we=0, burst=2),
+            dict(addr=dut.req_address(row=0xda, col=0x00), we=0),
+        ]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests)
+        commands = [(cmd["type"], cmd["a"]) for cmd in commands]
+        expected = [
+            ("activate", 0xba),
+            ("write",    0x04 << dut.address_align),
+            ("write",    0x05 << dut.address_align),
+            ("write",    0x06 << dut.address_align),
+            ("write",    0x07 << dut.address_align),
+            ("read",     0x09 << dut.address_align),
+            ("read",     0x0a << dut.address_align),
+            ("read",     (1 << 10) | (0x0b << dut.address_align)), # Auto-precharge.
+            ("activate", 0xda),
+            ("read",     0x00 << dut.address_align),
+        ]
+        self.assertEqual(commands, expected)
+
+    def test_burst_chop(self):
+        # Verify that column accesses are issued with A12 set (BL8) and that chopped ones have A12
+        # cleared (BC4) with A2 selecting the half of the word.
+        dut = BankMachineDUT(1, phy_settings=dict(memtype="DDR3", nphases=4, burst_chop=True))
+        requests = [
+            dict(addr=dut.req_address(row=0xba, col=0x08), we=1),
+            dict(addr=dut.req_address(row=0xba, col=0x10), we=1, chop=1, chop_upper=0),
+            dict(addr=dut.req_address(row=0xba, col=0x18), we=0, chop=1, chop_upper=1),
+        ]
+        commands = self.bankmachine_commands_test(dut=dut, requests=requests)
+        commands = [(cmd["type"], cmd["a"]) for cmd in commands]
+        expected = [
+            ("activate", 0xba),
+            ("write", (1 << 12) | (0x08 << dut.address_align)),
+            ("write",             (0x10 << dut.address_align)),
+            ("read",  (1 << 2)  | (0x18 << dut.address_align)),
+        ]
+        self.assertEqual(commands, expected)
+
     def test_lock_until_requests_finished(self):
         # Verify that lock is being held until all requests in FIFO are processed.
         @passive
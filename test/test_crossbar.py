@@ -13,7 +13,7 @@ from collections import namedtuple, defaultdict
 from migen import *
 
 from litedram.common import *
-from litedram.core.crossbar import LiteDRAMCrossbar
+from litedram.core.crossbar import LiteDRAMCrossbar, LiteDRAMReorderBuffer, LiteDRAMPortLatency
 
 from test.common import timeout_generator, NativePortDriver
 
@@ -103,6 +103,8 @@ class ControllerStub:
             # Latch the command to the internal buffer
             cmd_addr = (yield bank.addr)
             cmd_we = (yield bank.we)
+            cmd_tag = (yield bank.tag) if self.interface.tag_width else None
+            cmd_burst = (yield bank.burst) if self.interface.burst_width else 0
             # Lock the buffer as soon as command is valid on the interface.
             # We do this 1 cycle after we see the command, but BankMachine
             # also has latency, because cmd_buffer_lookahead.source must
@@ -119,26 +121,30 @@ class ControllerStub:
             while self._multiplexer_lock is not None:
                 yield
             self._multiplexer_lock = n
+            if cmd_tag is not None:
+                yield bank.data_tag.eq(cmd_tag)
             yield
             # After READ/WRITE has been issued, this is signalized by using
             # rdata_valid/wdata_ready. The actual data will appear with latency.
-            if cmd_we:  # WRITE
-                yield bank.wdata_ready.eq(1)
-                yield
-                yield bank.wdata_ready.eq(0)
-                # Send a request to the data_handler, it will check what
-                # has been sent from the crossbar port.
-                wdata = self.W(bank=n, addr=cmd_addr,
-                               data=None, we=None)  # to be filled in callback
-                self._waiting.append(self.WaitingData(data=wdata, delay=self.write_latency))
-            else:  # READ
-                yield bank.rdata_valid.eq(1)
-                yield
-                yield bank.rdata_valid.eq(0)
-                # Send a request with "data from memory" to the data_handler
-                rdata = self.R(bank=n, addr=cmd_addr, data=next(self._read_data))
-                # Decrease latecy, as data_handler sets data with 1 cycle delay
-                self._waiting.append(self.WaitingData(data=rdata, delay=self.read_latency - 1))
+            # Bursts are signalized once per word, on consecutive cycles.
+            for i in range(cmd_burst + 1):
+                if cmd_we:  # WRITE
+                    yield bank.wdata_ready.eq(1)
+                    yield
+                    yield bank.wdata_ready.eq(0)
+                    # Send a request to the data_handler, it will check what
+                    # has been sent from the crossbar port.
+                    wdata = self.W(bank=n, addr=cmd_addr + i,
+                                   data=None, we=None)  # to be filled in callback
+                    self._waiting.append(self.WaitingData(data=wdata, delay=self.write_latency))
+                else:  # READ
+                    yield bank.rdata_valid.eq(1)
+                    yield
+                    yield bank.rdata_valid.eq(0)
+                    # Send a request with "data from memory" to the data_handler
+                    rdata = self.R(bank=n, addr=cmd_addr + i, data=next(self._read_data))
+                    # Decrease latecy, as data_handler sets data with 1 cycle delay
+                    self._waiting.append(self.WaitingData(data=rdata, delay=self.read_latency - 1))
             # At this point cmd_buffer.source.ready has been activated and the
             # command in internal buffer has been discarded. The lock will be
             self._multiplexer_lock = None
@@ -192,15 +198,24 @@ class CrossbarDUT(Module):
 
     def addr_port(self, bank, row, col):
         # construct an address the way port master would do it
-        assert self.settings.address_mapping == "ROW_BANK_COL"
         aa = self.address_align
         cb = self.settings.geom.colbits
         rb = self.settings.geom.rowbits
         bb = self.settings.geom.bankbits
         col  = (col  & (2**cb - 1)) >> aa
-        bank = (bank & (2**bb - 1)) << (cb - aa)
-        row  = (row  & (2**rb - 1)) << (cb + bb - aa)
-        return row | bank | col
+        row  = (row  & (2**rb - 1))
+        bank = (bank & (2**bb - 1))
+        mapping = self.settings.address_mapping
+        if mapping == "ROW_BANK_COL":
+            return (row << (cb + bb - aa)) | (bank << (cb - aa)) | col
+        elif mapping == "ROW_BANK_COL_XOR":
+            bank ^= row & (2**bb - 1)
+            return (row << (cb + bb - aa)) | (bank << (cb - aa)) | col
+        elif mapping == "BANK_ROW_COL":
+            return (bank << (rb + cb - aa)) | (row << (cb - aa)) | col
+        elif mapping == "ROW_COL_BANK":
+            return (row << (cb + bb - aa)) | (col << bb) | bank
+        raise NotImplementedError(mapping)
 
     def addr_iface(self, row, col):
         # construct address the way bankmachine should receive it
@@ -215,6 +230,7 @@ class CrossbarDUT(Module):
 class TestCrossbar(unittest.TestCase):
     W = ControllerStub.W
     R = ControllerStub.R
+    address_mappings = ["ROW_BANK_COL", "ROW_BANK_COL_XOR", "BANK_ROW_COL", "ROW_COL_BANK"]
 
     def test_init(self):
         dut = CrossbarDUT()
@@ -234,21 +250,23 @@ class TestCrossbar(unittest.TestCase):
         return controller.data
 
     def test_available_address_mappings(self):
-        # Check that the only supported address mapping is ROW_BANK_COL (if we start supporting new
-        # mappings, then update these tests to also test these other mappings).
+        # Check the supported address mappings and that unknown ones are rejected.
         def finalize_crossbar(mapping):
             dut = CrossbarDUT(controller_settings=dict(address_mapping=mapping))
             dut.crossbar.get_port()
             dut.crossbar.finalize()
 
-        for mapping in ["ROW_BANK_COL", "BANK_ROW_COL"]:
-            if mapping in ["ROW_BANK_COL"]:
-                finalize_crossbar(mapping)
-            else:
-                with self.assertRaises(KeyError):
-                    finalize_crossbar(mapping)
+        for mapping in self.address_mappings:
+            finalize_crossbar(mapping)
+        with self.assertRaises(KeyError):
+            finalize_crossbar("COL_ROW_BANK")
 
     def test_address_mappings(self):
+        for mapping in self.address_mappings:
+            with self.subTest(mapping=mapping):
+                self.address_mapping_test(mapping)
+
+    def address_mapping_test(self, mapping):
         # Verify that address is translated correctly.
         reads = []
 
@@ -264,7 +282,7 @@ class TestCrossbar(unittest.TestCase):
                     raise TypeError(t["rw"])
 
         geom_settings = dict(colbits=10, rowbits=13, bankbits=2)
-        dut  = CrossbarDUT(geom_settings=geom_settings)
+        dut  = CrossbarDUT(geom_settings=geom_settings, controller_settings=dict(address_mapping=mapping))
         port = dut.crossbar.get_port()
         driver = NativePortDriver(port)
         transfers = [
@@ -291,6 +309,24 @@ class TestCrossbar(unittest.TestCase):
         data = self.crossbar_test(dut, [producer(dut, driver)] + driver.generators())
         self.assertEqual(data, expected)
 
+    def test_address_mapping_xor_stride(self):
+        # Verify that a power-of-two stride hitting a single bank with ROW_BANK_COL is spread over
+        # all the banks with ROW_BANK_COL_XOR.
+        def producer(dut, driver, stride):
+            for i in range(4):
+                yield from driver.write(i*stride, data=0x10 + i)
+
+        geom_settings = dict(colbits=10, rowbits=13, bankbits=2)
+        for mapping, banks in [("ROW_BANK_COL", [0, 0, 0, 0]), ("ROW_BANK_COL_XOR", [0, 1, 2, 3])]:
+            with self.subTest(mapping=mapping):
+                dut    = CrossbarDUT(geom_settings=geom_settings, controller_settings=dict(address_mapping=mapping))
+                port   = dut.crossbar.get_port()
+                driver = NativePortDriver(port)
+                stride = 2**(geom_settings["colbits"] + geom_settings["bankbits"] - dut.address_align)
+                data   = self.crossbar_test(dut, [producer(dut, driver, stride)] + driver.generators())
+                self.assertEqual([d.bank for d in data], banks)
+                self.assertEqual([d.addr for d in data], [dut.addr_iface(row=i, col=0) for i in range(4)])
+
     def test_arbitration(self):
         # Create multiple masters that write to the same bank at the same time and verify that all
         # the requests have been sent correctly.
@@ -391,7 +427,7 @@ class TestCrossbar(unittest.TestCase):
         ]
         self.assertEqual(data, expected)
 
-    def crossbar_stress_test(self, dut, ports, n_banks, n_ops, clocks=None):
+    def crossbar_stress_test(self, dut, ports, n_banks, n_ops, clocks=None, drain=0):
         # Runs simulation with multiple masters writing and reading to multiple banks
         controller = ControllerStub(dut.interface,
                                     write_latency=dut.settings.phy.write_latency,
@@ -423,6 +459,9 @@ class TestCrossbar(unittest.TestCase):
                     produced[num].append(self.R(bank, addr_iface, data=None))
 
             yield from driver.wait_all()
+            # Wait for data accepted by the port but not yet consumed by the controller.
+            for _ in range(drain):
+                yield
 
         generators = defaultdict(list)
         for i, port in enumerate(ports):
@@ -464,6 +503,433 @@ class TestCrossbar(unittest.TestCase):
         for master in produced.keys():
             self.assertEqual(consumed[master], produced[master], msg="master = %d" % master)
 
+    def test_stress_reordering(self):
+        # Test communication with tagged requests (masters sharing bank queues).
+        settings = dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=3)
+        for n_banks in [1, 4]:
+            with self.subTest(n_banks=n_banks):
+                dut = CrossbarDUT(controller_settings=settings)
+                ports = [dut.crossbar.get_port() for _ in range(4)]
+                produced, consumed, consumed_all = self.crossbar_stress_test(dut, ports,
+                    n_banks=n_banks, n_ops=8)
+                for master in produced.keys():
+                    self.assertEqual(consumed[master], produced[master], msg="master = %d" % master)
+
+    def test_stress_read_reorder(self):
+        # Test communication with masters having reads pending in several banks.
+        for settings in [dict(read_reorder_depth=4),
+                         dict(read_reorder_depth=4, cmd_buffer_reordering=True, cmd_buffer_tag_width=3)]:
+            with self.subTest(settings=settings):
+                dut = CrossbarDUT(controller_settings=settings)
+                ports = [dut.crossbar.get_port() for _ in range(4)]
+                produced, consumed, consumed_all = self.crossbar_stress_test(dut, ports,
+                    n_banks=4, n_ops=8)
+                for master in produced.keys():
+                    self.assertEqual(consumed[master], produced[master], msg="master = %d" % master)
+
+    def test_stress_wdata_buffer(self):
+        # Test communication with posted write buffers.
+        dut = CrossbarDUT(controller_settings=dict(wdata_buffer_depth=4))
+        ports = [dut.crossbar.get_port() for _ in range(4)]
+        produced, consumed, consumed_all = self.crossbar_stress_test(dut, ports, n_banks=4, n_ops=8,
+            drain=64)
+        for master in produced.keys():
+            self.assertEqual(consumed[master], produced[master], msg="master = %d" % master)
+
+    def test_wdata_buffer(self):
+        # Verify that write data can be pushed ahead of its command and that a write is only
+        # presented to the banks once its data has been pushed.
+        issued = []
+
+        def producer(dut, port):
+            # Data of the first write pushed before its command.
+            for data in [0x11, 0x22]:
+                yield port.wdata.valid.eq(1)
+                yield port.wdata.data.eq(data)
+                yield port.wdata.we.eq(0xff)
+                yield
+                while not (yield port.wdata.ready):
+                    yield
+            yield port.wdata.valid.eq(0)
+            for col in [0, 8, 16]:
+                yield port.cmd.valid.eq(1)
+                yield port.cmd.we.eq(1)
+                yield port.cmd.addr.eq(dut.addr_port(bank=1, row=1, col=col))
+                yield
+                while not (yield port.cmd.ready):
+                    yield
+            yield port.cmd.valid.eq(0)
+            # Data of the last write pushed late.
+            for _ in range(32):
+                yield
+            self.assertEqual(len(issued), 2)
+            yield port.wdata.valid.eq(1)
+            yield port.wdata.data.eq(0x33)
+            yield
+            while not (yield port.wdata.ready):
+                yield
+            yield port.wdata.valid.eq(0)
+            for _ in range(32):
+                yield
+
+        @passive
+        def monitor(dut):
+            bank = dut.interface.bank1
+            while True:
+                if (yield bank.valid) and (yield bank.ready):
+                    issued.append((yield bank.addr))
+                yield
+
+        dut  = CrossbarDUT(controller_settings=dict(wdata_buffer_depth=4))
+        port = dut.crossbar.get_port()
+        data = self.crossbar_test(dut, [producer(dut, port), monitor(dut)])
+        self.assertEqual(len(issued), 3)
+        self.assertEqual([d.data for d in data], [0x11, 0x22, 0x33])
+
+    def test_read_reorder(self):
+        # Verify that reads pending in several banks, completing out of order, are returned in
+        # order to the master.
+        prng  = random.Random(42)
+        reads = [(prng.randrange(4), 4*i) for i in range(16)]
+
+        def producer(dut, driver):
+            for bank, col in reads:
+                yield from driver.read(dut.addr_port(bank=bank, row=1, col=col), wait_data=False)
+            yield from driver.wait_all()
+
+        for settings in [dict(read_reorder_depth=4),
+                         dict(read_reorder_depth=4, cmd_buffer_reordering=True, cmd_buffer_tag_width=3)]:
+            with self.subTest(settings=settings):
+                dut    = CrossbarDUT(controller_settings=settings)
+                port   = dut.crossbar.get_port()
+                driver = NativePortDriver(port)
+                data   = self.crossbar_test(dut, [producer(dut, driver)] + driver.generators(),
+                    timeout=2000, cmd_delay=lambda: prng.randrange(1, 20))
+                # Reads have completed out of order...
+                order = [(d.bank, d.addr) for d in data]
+                expected_order = [(bank, dut.addr_iface(row=1, col=col)) for bank, col in reads]
+                self.assertNotEqual(order, expected_order)
+                self.assertEqual(sorted(order), sorted(expected_order))
+                # ...but have been returned in order.
+                rdata = {(d.bank, d.addr): d.data for d in data}
+                self.assertEqual(driver.rdata, [rdata[o] for o in expected_order])
+
+    def test_reorder_buffer(self):
+        # Verify that the reorder buffer delivers data in allocation order and is full at depth.
+        def generator(dut, delivered):
+            yield dut.source.ready.eq(1)
+            for bank in [0, 1, 0, 2]:
+                yield dut.alloc.eq(1)
+                yield dut.alloc_bank.eq(bank)
+                yield
+            yield dut.alloc.eq(0)
+            yield
+            self.assertEqual((yield dut.full), 1)
+            for bank, data in [(2, 0x23), (0, 0x20), (1, 0x21), (0, 0x22)]:
+                yield dut.fill.eq(1)
+                yield dut.fill_bank.eq(bank)
+                yield dut.fill_data.eq(data)
+                yield
+            yield dut.fill.eq(0)
+            for _ in range(8):
+                yield
+            self.assertEqual((yield dut.full), 0)
+
+        @passive
+        def monitor(dut, delivered):
+            while True:
+                if (yield dut.source.valid) and (yield dut.source.ready):
+                    delivered.append((yield dut.source.data))
+                yield
+
+        delivered = []
+        dut = LiteDRAMReorderBuffer(depth=4, data_width=8, nbanks=4)
+        run_simulation(dut, [generator(dut, delivered), monitor(dut, delivered)])
+        self.assertEqual(delivered, [0x20, 0x21, 0x22, 0x23])
+
+    def test_reordering_too_many_ports(self):
+        # Verify that the number of ports is limited by the tag width.
+        dut = CrossbarDUT(controller_settings=dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=1))
+        for _ in range(3):
+            dut.crossbar.get_port()
+        with self.assertRaises(ValueError):
+            dut.crossbar.finalize()
+
+    def test_native_bursts(self):
+        # Verify that burst commands are routed to the banks and that their words are transferred
+        # from/to the right masters.
+        def master_a(dut, driver):
+            adr = functools.partial(dut.addr_port, bank=0, row=1)
+            yield driver.port.cmd.burst.eq(3)
+            yield from driver.write(adr(col=16), data=0x10, data_with_cmd=True, wait_data=False)
+            driver.wdata += [(0x11 + i, 0xff) for i in range(3)]
+            yield driver.port.cmd.burst.eq(1)
+            yield from driver.read(adr(col=8), wait_data=False)
+            driver.rdata_expected += 1
+            yield driver.port.cmd.burst.eq(0)
+            yield from driver.wait_all()
+
+        def master_b(dut, driver):
+            adr = functools.partial(dut.addr_port, bank=1, row=2)
+            yield driver.port.cmd.burst.eq(2)
+            yield from driver.read(adr(col=4), wait_data=False)
+            driver.rdata_expected += 2
+            yield from driver.wait_all()
+
+        for controller_settings in [{},
+            dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=1),
+            dict(wdata_buffer_depth=4)]:
+            with self.subTest(**controller_settings):
+                dut     = CrossbarDUT(controller_settings=dict(cmd_burst_length=4, **controller_settings))
+                ports   = [dut.crossbar.get_port() for _ in range(2)]
+                drivers = [NativePortDriver(port) for port in ports]
+                masters = [master_a(dut, drivers[0]), master_b(dut, drivers[1])]
+                data    = self.crossbar_test(dut, masters + drivers[0].generators() + drivers[1].generators())
+                writes  = [d for d in data if isinstance(d, self.W)]
+                reads   = {(d.bank, d.addr): d.data for d in data if isinstance(d, self.R)}
+                self.assertEqual(writes, [
+                    self.W(bank=0, addr=dut.addr_iface(row=1, col=16) + i, data=0x10 + i, we=0xff)
+                    for i in range(4)])
+                self.assertEqual(sorted(reads), sorted(
+                    [(0, dut.addr_iface(row=1, col=8) + i) for i in range(2)] +
+                    [(1, dut.addr_iface(row=2, col=4) + i) for i in range(3)]))
+                self.assertEqual(drivers[0].rdata, [reads[(0, dut.addr_iface(row=1, col=8) + i)]
+                    for i in range(2)])
+                self.assertEqual(drivers[1].rdata, [reads[(1, dut.addr_iface(row=2, col=4) + i)]
+                    for i in range(3)])
+
+    def test_native_bursts_unsupported(self):
+        # Verify that bursts are rejected when they can't stay in a row or with a reorder buffer.
+        for controller_settings in [
+            dict(address_mapping="ROW_COL_BANK"),
+            dict(read_reorder_depth=4),
+            dict(cmd_burst_length=1024)]:
+            with self.subTest(**controller_settings):
+                dut = CrossbarDUT(controller_settings=dict(dict(cmd_burst_length=4), **controller_settings))
+                dut.crossbar.get_port()
+                with self.assertRaises(ValueError):
+                    dut.crossbar.finalize()
+
+    def test_atomics(self):
+        # Verify that the read-modify-write of an atomic command is not interleaved with the
+        # accesses of another master to the same bank.
+        def master_atomic(dut, driver):
+            yield from driver.write(dut.addr_port(bank=0, row=1, col=0), data=0x20, wait_data=False)
+            for col in [8, 16]:
+                yield driver.port.cmd.atomic.eq(atomic_ops["add"])
+                yield from driver.write(dut.addr_port(bank=0, row=1, col=col), data=0x1)
+                yield driver.port.cmd.atomic.eq(0)
+                driver.rdata_expected += 1
+            yield from driver.wait_all()
+
+        def master(dut, driver):
+            for col in range(8):
+                yield from driver.write(dut.addr_port(bank=0, row=2, col=8*col), data=col,
+                    wait_data=False)
+            yield from driver.wait_all()
+
+        for controller_settings in [{},
+            dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=1),
+            dict(wdata_buffer_depth=4)]:
+            with self.subTest(**controller_settings):
+                dut     = CrossbarDUT(controller_settings=controller_settings)
+                ports   = [dut.crossbar.get_port(with_atomics=True), dut.crossbar.get_port()]
+                drivers = [NativePortDriver(port) for port in ports]
+                masters = [master_atomic(dut, drivers[0]), master(dut, drivers[1])]
+                data    = self.crossbar_test(dut, masters + drivers[0].generators() + drivers[1].generators(),
+                    timeout=1000)
+                for col in [8, 16]:
+                    addr = dut.addr_iface(row=1, col=col)
+                    read = [i for i, d in enumerate(data) if isinstance(d, self.R) and d.addr == addr]
+                    self.assertEqual(len(read), 1)
+                    # Modified word written right after its read, previous content returned.
+                    self.assertEqual(data[read[0] + 1],
+                        self.W(bank=0, addr=addr, data=data[read[0]].data + 1, we=0xff))
+                    self.assertIn(data[read[0]].data, drivers[0].rdata)
+                self.assertEqual(len(data), 1 + 2*2 + 8)
+
+    def qos_test(self, qos, n=6, controller_settings=None):
+        # Two masters stream writes to the same bank, return the order in which they are served.
+        def producer(dut, driver, i):
+            for k in range(n):
+                addr = dut.addr_port(bank=3, row=i, col=8*k)
+                yield from driver.write(addr, data=0x10*(i + 1) + k, wait_data=(k == n - 1))
+
+        dut        = CrossbarDUT(controller_settings=controller_settings)
+        ports      = [dut.crossbar.get_port(**kwargs) for kwargs in qos]
+        drivers    = [NativePortDriver(port) for port in ports]
+        generators = [producer(dut, driver, i) for i, driver in enumerate(drivers)]
+        for driver in drivers:
+            generators.extend(driver.generators())
+        data = self.crossbar_test(dut, generators, timeout=2000)
+        return [d.data >> 4 for d in data]
+
+    def test_qos_priority(self):
+        # Verify that a master of higher priority class is served first.
+        for settings in [None, dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=3)]:
+            with self.subTest(settings=settings):
+                order = self.qos_test([{}, dict(priority=1)], controller_settings=settings)
+                self.assertEqual(order[:6], [2]*6)
+
+    def test_qos_weight(self):
+        # Verify that masters get a share of the bank proportional to their weight.
+        for settings in [None, dict(cmd_buffer_reordering=True, cmd_buffer_tag_width=3)]:
+            with self.subTest(settings=settings):
+                order = self.qos_test([dict(weight=2), dict(weight=1)], controller_settings=settings)
+                self.assertEqual(order[:9], [1, 1, 2]*3)
+                order = self.qos_test([dict(weight=1), dict(weight=3)], controller_settings=settings)
+                self.assertEqual(order[:8], [1, 2, 2, 2]*2)
+
+    def test_qos_rate(self):
+        # Verify that the token bucket caps the command rate of a master after its burst.
+        def producer(dut, driver):
+            for k in range(6):
+                yield from driver.write(dut.addr_port(bank=k, row=0, col=0), data=k, wait_data=False)
+
+        @passive
+        def monitor(port, accepted):
+            cycle = 0
+            while True:
+                if (yield port.cmd.valid) and (yield port.cmd.ready):
+                    accepted.append(cycle)
+                cycle += 1
+                yield
+
+        for rate, burst in [(0, 8), (8, 1), (8, 3)]:
+            with self.subTest(rate=rate, burst=burst):
+                accepted = []
+                dut    = CrossbarDUT()
+                port   = dut.crossbar.get_port(rate=rate, burst=burst)
+                driver = NativePortDriver(port)
+                self.crossbar_test(dut, [producer(dut, driver), monitor(port, accepted)] + driver.generators(),
+                    timeout=1000)
+                deltas = [b - a for a, b in zip(accepted, accepted[1:])]
+                if rate == 0:
+                    self.assertTrue(all(d < 256//8 for d in deltas))
+                else:
+                    self.assertTrue(all(d < 256//rate for d in deltas[:burst - 1]))
+                    self.assertTrue(all(d >= 256//rate for d in deltas[burst:]))
+
+    def test_qos_csrs(self):
+        # Verify that QoS CSRs are only created for ports using QoS, with their default values.
+        dut = CrossbarDUT()
+        dut.crossbar.get_port()
+        dut.crossbar.get_port(priority=3, weight=4, rate=16)
+        self.assertEqual([csr.name for csr in dut.crossbar.get_csrs()],
+            ["port1_qos_priority", "port1_qos_weight", "port1_qos_rate"])
+        qos = dut.crossbar.port1_qos
+        self.assertEqual([qos.priority.storage.reset.value, qos.weight.storage.reset.value,
+            qos.rate.storage.reset.value], [3, 4, 16])
+
+    def test_latency_monitor(self):
+        # Verify that command-accept and read round-trip latencies are measured on the port.
+        latencies = dict(cmd=[], read=[])
+        results   = dict(cmd={}, read={})
+
+        def producer(dut, driver, monitor):
+            for k in range(6):
+                yield from driver.read(dut.addr_port(bank=k % 2, row=k, col=0), wait_data=False)
+            yield from driver.wait_all()
+            for _ in range(8):
+                yield
+            for name in ["cmd", "read"]:
+                results[name]["histogram"] = []
+            for bucket in range(16):
+                yield from monitor.bucket.write(bucket)
+                yield from monitor.update.write(1)
+                yield
+                for name in ["cmd", "read"]:
+                    results[name]["histogram"].append(
+                        (yield from getattr(monitor, name + "_histogram").read()))
+            for name in ["cmd", "read"]:
+                for stat in ["count", "min", "max", "sum"]:
+                    results[name][stat] = (yield from getattr(monitor, name + "_" + stat).read())
+
+        @passive
+        def port_monitor(port):
+            cycle = 0
+            valid_since = None
+            pending     = []
+            while True:
+                if (yield port.cmd.valid):
+                    if valid_since is None:
+                        valid_since = cycle
+                    if (yield port.cmd.ready):
+                        latencies["cmd"].append(cycle - valid_since)
+                        pending.append(cycle)
+                        valid_since = None
+                if (yield port.rdata.valid) and (yield port.rdata.ready):
+                    latencies["read"].append(cycle - pending.pop(0))
+                cycle += 1
+                yield
+
+        dut     = CrossbarDUT()
+        port    = dut.crossbar.get_port(with_latency_monitor=True)
+        driver  = NativePortDriver(port)
+        monitor = dut.crossbar.port0_latency
+        self.crossbar_test(dut, [producer(dut, driver, monitor), port_monitor(port)] + driver.generators(),
+            timeout=1000)
+        for name in ["cmd", "read"]:
+            with self.subTest(name=name):
+                self.assertEqual(len(latencies[name]), 6)
+                self.assertEqual(results[name]["count"], 6)
+                self.assertEqual(results[name]["min"],   min(latencies[name]))
+                self.assertEqual(results[name]["max"],   max(latencies[name]))
+                self.assertEqual(results[name]["sum"],   sum(latencies[name]))
+                histogram = [0]*16
+                for latency in latencies[name]:
+                    histogram[min(bits_for(latency) if latency else 0, 15)] += 1
+                self.assertEqual(results[name]["histogram"], histogram)
+        self.assertGreater(max(latencies["cmd"]), 0)
+
+    def test_latency_monitor_full(self):
+        # Verify that reads are blocked while the timestamps are full and that timestamps are
+        # released on rdata.valid alone (the crossbar does not wait for rdata.ready).
+        latencies = []
+        results   = {}
+        blocked   = []
+
+        class DUT(Module):
+            def __init__(self):
+                self.port = LiteDRAMNativePort("both", address_width=8, data_width=8)
+                self.submodules.monitor = LiteDRAMPortLatency(self.port, depth=2)
+                self.comb += self.port.cmd.ready.eq(self.monitor.allowed)
+
+        def generator(dut):
+            port    = dut.port
+            pending = []
+            issued  = 0
+            cycle   = 0
+            yield port.cmd.we.eq(0)
+            while issued < 6 or pending:
+                yield port.cmd.valid.eq(issued < 6)
+                yield port.rdata.valid.eq(len(pending) > 0 and cycle - pending[0] >= 5)
+                yield
+                if (yield port.rdata.valid):
+                    latencies.append(cycle - pending.pop(0))
+                if (yield port.cmd.valid):
+                    if (yield port.cmd.ready):
+                        pending.append(cycle)
+                        issued += 1
+                    else:
+                        blocked.append(cycle)
+                cycle += 1
+            yield port.cmd.valid.eq(0)
+            yield port.rdata.valid.eq(0)
+            yield from dut.monitor.update.write(1)
+            yield
+            for stat in ["count", "min", "max", "sum"]:
+                results[stat] = (yield from getattr(dut.monitor, "read_" + stat).read())
+
+        dut = DUT()
+        run_simulation(dut, [generator(dut), timeout_generator(500)])
+        self.assertGreater(len(blocked), 0)
+        self.assertEqual(len(latencies), 6)
+        self.assertEqual(results["count"], 6)
+        self.assertEqual(results["min"],   min(latencies))
+        self.assertEqual(results["max"],   max(latencies))
+        self.assertEqual(results["sum"],   sum(latencies))
+
     def test_stress_single_master(self):
         # Test communication in complex scenarios.
         dut = CrossbarDUT()
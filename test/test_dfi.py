@@ -13,6 +13,7 @@ from migen import *
 from litex.build.sim import gtkwave as gtkw
 
 from litedram.phy.dfi import Interface as DFIInterface, DFIRateConverter
+from litedram.dfii import DFIInjector
 from litedram.phy.utils import Serializer, Deserializer
 
 from test.phy_common import DFISequencer, dfi_reset_values, run_simulation as _run_simulation
@@ -487,3 +488,37 @@ class TestPHYRateConverter(unittest.TestCase):
                     nphases=2,
                     converter_kwargs=dict(read_delay=read_delay),
                 ), dfi_sys, dfi_expected, dfi_input=dfi_input)
+
+
+class TestDFIInjector(unittest.TestCase):
+    def test_burst_chop_software_bl8(self):
+        # With burst chop, software READ/WRITE commands get A12 set (BL8 in on-the-fly mode), other
+        # commands (ex. MRS) are left untouched.
+        cmds = {
+            "READ":  0b0101, # cas|cs
+            "WRITE": 0b0111, # cas|we|cs
+            "MRS":   0b1111, # ras|cas|we|cs
+            "ACT":   0b1001, # ras|cs
+        }
+
+        def generator(dut, results):
+            pi = dut.pi0
+            yield from dut._control.write(0) # Software control.
+            for name, cmd in cmds.items():
+                yield from pi._address.write(0x0421)
+                yield from pi._command.write(cmd)
+                yield
+                results[name] = (yield dut.master.phases[0].address)
+
+        for burst_chop in [False, True]:
+            with self.subTest(burst_chop=burst_chop):
+                dut = DFIInjector(addressbits=14, bankbits=3, nranks=1, databits=16, burst_chop=burst_chop)
+                results = {}
+                _run_simulation(dut, generator(dut, results), clocks={"sys": (4, 1)})
+                a12 = (1 << 12) if burst_chop else 0
+                self.assertEqual(results, {
+                    "READ":  0x0421 | a12,
+                    "WRITE": 0x0421 | a12,
+                    "MRS":   0x0421,
+                    "ACT":   0x0421,
+                })
@@ -5,6 +5,7 @@
 # SPDX-License-Identifier: BSD-2-Clause
 
 import unittest
+import itertools
 
 from migen import *
 
@@ -25,9 +26,9 @@ class DMAWriterDriver:
         for adr, data in pattern:
             yield self.dma.sink.address.eq(adr)
             yield self.dma.sink.data.eq(data)
+            yield
             while not (yield self.dma.sink.ready):
                 yield
-            yield
         yield self.dma.sink.valid.eq(0)
 
     @staticmethod
@@ -48,10 +49,9 @@ class DMAReaderDriver:
         yield self.dma.sink.valid.eq(1)
         for adr in address_list:
             yield self.dma.sink.address.eq(adr)
+            yield
             while not (yield self.dma.sink.ready):
                 yield
-            while (yield self.dma.sink.ready):
-                yield
         yield self.dma.sink.valid.eq(0)
         while len(self.data) < n_last + len(address_list):
             yield
@@ -69,20 +69,31 @@ class TestDMA(MemoryTestDataMixin, unittest.TestCase):
 
     # LiteDRAMDMAWriter ----------------------------------------------------------------------------
 
-    def dma_writer_test(self, pattern, mem_expected, data_width, **kwargs):
+    @staticmethod
+    @passive
+    def cmd_counter(port, cmds):
+        while True:
+            if (yield port.cmd.valid) and (yield port.cmd.ready):
+                cmds.append((yield port.cmd.addr))
+            yield
+
+    def dma_writer_test(self, pattern, mem_expected, data_width, burst_width=0, **kwargs):
         class DUT(Module):
             def __init__(self):
-                self.port = LiteDRAMNativeWritePort(address_width=32, data_width=data_width)
+                self.port = LiteDRAMNativeWritePort(address_width=32, data_width=data_width,
+                    burst_width=burst_width)
                 self.submodules.dma = LiteDRAMDMAWriter(self.port, **kwargs)
 
         dut = DUT()
         driver = DMAWriterDriver(dut.dma)
         mem = DRAMMemory(data_width, len(mem_expected))
+        self.cmds = []
 
         generators = [
             driver.write(pattern),
             driver.wait_complete(dut.port, len(pattern)),
             mem.write_handler(dut.port),
+            self.cmd_counter(dut.port, self.cmds),
         ]
         run_simulation(dut, generators)
         self.assertEqual(mem.mem, mem_expected)
@@ -124,22 +135,35 @@ class TestDMA(MemoryTestDataMixin, unittest.TestCase):
         data = self.pattern_test_data["32bit_duplicates"]
         self.dma_writer_test(data["pattern"], data["expected"], data_width=32)
 
+    def test_dma_writer_bursts(self):
+        # Verify DMAWriter with sequential 32-bit datas coalesced into native bursts.
+        data = self.pattern_test_data["32bit_long_sequential"]
+        for pattern in [data["pattern"], self.pattern_test_data["32bit"]["pattern"]]:
+            expected = [0]*len(data["expected"])
+            for adr, value in pattern:
+                expected[adr] = value
+            self.dma_writer_test(pattern, expected, data_width=32, burst_width=2)
+        self.assertLess(len(self.cmds), len(data["pattern"]))
+
     # LiteDRAMDMAReader ----------------------------------------------------------------------------
 
-    def dma_reader_test(self, pattern, mem_expected, data_width, **kwargs):
+    def dma_reader_test(self, pattern, mem_expected, data_width, burst_width=0, **kwargs):
         class DUT(Module):
             def __init__(self):
-                self.port = LiteDRAMNativeReadPort(address_width=32, data_width=data_width)
+                self.port = LiteDRAMNativeReadPort(address_width=32, data_width=data_width,
+                    burst_width=burst_width)
                 self.submodules.dma = LiteDRAMDMAReader(self.port, **kwargs)
 
         dut    = DUT()
         driver = DMAReaderDriver(dut.dma)
         mem    = DRAMMemory(data_width, len(mem_expected), init=mem_expected)
+        self.cmds = []
 
         generators = [
             driver.read([adr for adr, data in pattern]),
             driver.read_handler(),
             mem.read_handler(dut.port),
+            self.cmd_counter(dut.port, self.cmds),
         ]
         run_simulation(dut, generators)
         self.assertEqual(driver.data, [data for adr, data in pattern])
@@ -175,3 +199,111 @@ class TestDMA(MemoryTestDataMixin, unittest.TestCase):
         # Verify DMAReader with a buffered FIFO.
         data = self.pattern_test_data["32bit_long_sequential"]
         self.dma_reader_test(data["pattern"], data["expected"], data_width=32, fifo_buffered=True)
+
+    def test_dma_reader_bursts(self):
+        # Verify DMAReader with sequential 32-bit datas coalesced into native bursts.
+        data = self.pattern_test_data["32bit_long_sequential"]
+        self.dma_reader_test(data["pattern"], data["expected"], data_width=32, burst_width=2)
+        self.assertEqual(len(self.cmds), len(data["pattern"])//4)
+
+    # LiteDRAMCopyEngine ---------------------------------------------------------------------------
+
+    def copy_engine_test(self, src, dst, length, memset=False, pattern=0, burst_width=0,
+        abort_after=None, **kwargs):
+        class DUT(Module):
+            def __init__(self):
+                self.read_port  = LiteDRAMNativeReadPort(address_width=32, data_width=32,
+                    burst_width=burst_width)
+                self.write_port = LiteDRAMNativeWritePort(address_width=32, data_width=32,
+                    burst_width=burst_width)
+                self.submodules.engine = LiteDRAMCopyEngine(self.read_port, self.write_port, **kwargs)
+
+        init = [0x10000000 + i for i in range(128)]
+        expected = init.copy()
+        for i in range(length):
+            expected[dst + i] = pattern if memset else init[src + i]
+
+        dut  = DUT()
+        mem  = DRAMMemory(32, len(init), init=init)
+        cmds = []
+
+        @passive
+        def cmd_monitor():
+            while True:
+                for port, kind in [(dut.read_port, "r"), (dut.write_port, "w")]:
+                    if (yield port.cmd.valid) and (yield port.cmd.ready):
+                        cmds.append(kind)
+                yield
+
+        def main_generator():
+            engine = dut.engine
+            if abort_after is not None:
+                # Start a copy from another source, abort it and re-arm the engine.
+                yield engine._src.storage.eq((src + 1)*4)
+                yield engine._dst.storage.eq(dst*4)
+                yield engine._length.storage.eq(length*4)
+                yield engine._enable.storage.eq(1)
+                for _ in range(abort_after):
+                    yield
+                yield engine._enable.storage.eq(0)
+                yield
+            yield engine._src.storage.eq(src*4)
+            yield engine._dst.storage.eq(dst*4)
+            yield engine._length.storage.eq(length*4)
+            yield engine._pattern.storage.eq(pattern)
+            yield engine._mode.fields.memset.eq(memset)
+            self.assertEqual((yield engine.ev.done.pending), 0)
+            yield engine._enable.storage.eq(1)
+            yield
+            while not (yield engine._done.status):
+                yield
+            self.assertEqual((yield engine.ev.done.pending), 1)
+            self.assertEqual((yield engine._offset.status), length)
+
+        generators = [
+            main_generator(),
+            mem.read_handler(dut.read_port),
+            mem.write_handler(dut.write_port),
+            cmd_monitor(),
+            timeout_generator(3000),
+        ]
+        run_simulation(dut, generators)
+        self.assertEqual(mem.mem, expected)
+        return cmds
+
+    def test_copy_engine_memcpy(self):
+        # Verify memcpy with a length that is not a multiple of the chunk length.
+        cmds = self.copy_engine_test(src=3, dst=64, length=37, fifo_depth=8)
+        self.assertEqual(cmds.count("r"), 37)
+        self.assertEqual(cmds.count("w"), 37)
+
+    def test_copy_engine_memcpy_chunks(self):
+        # Verify memcpy reads/writes are grouped in chunks (no read/write ping-pong).
+        cmds = self.copy_engine_test(src=0, dst=64, length=32, fifo_depth=16, chunk_length=8)
+        switches = sum(a != b for a, b in zip(cmds, cmds[1:]))
+        self.assertEqual(switches, 2*32//8 - 1)
+
+    def test_copy_engine_memcpy_chunks_unaligned(self):
+        # Verify chunks are aligned on chunk_length boundaries of the source.
+        cmds = self.copy_engine_test(src=3, dst=64, length=32, fifo_depth=16, chunk_length=8)
+        chunks = [len(list(group)) for kind, group in itertools.groupby(cmds) if kind == "r"]
+        self.assertEqual(chunks, [5, 8, 8, 8, 3])
+
+    def test_copy_engine_abort(self):
+        # Verify an aborted copy is drained and the engine re-armed.
+        self.copy_engine_test(src=0, dst=64, length=8, fifo_depth=8, abort_after=6)
+        self.copy_engine_test(src=0, dst=64, length=8, fifo_depth=8, abort_after=6, burst_width=2)
+
+    def test_copy_engine_memcpy_bursts(self):
+        # Verify memcpy over Native ports with bursts.
+        cmds = self.copy_engine_test(src=8, dst=72, length=32, fifo_depth=16, burst_width=2)
+        self.assertLess(len(cmds), 2*32)
+
+    def test_copy_engine_memset(self):
+        # Verify memset with a pattern (read port unused).
+        cmds = self.copy_engine_test(src=0, dst=5, length=50, memset=True, pattern=0xdeadbeef)
+        self.assertEqual(cmds.count("r"), 0)
+
+    def test_copy_engine_empty(self):
+        # Verify a zero length transfer completes immediately.
+        self.copy_engine_test(src=0, dst=0, length=0)
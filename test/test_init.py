@@ -8,7 +8,7 @@ import os
 import difflib
 import unittest
 
-from litedram.init import get_sdram_phy_c_header, get_sdram_phy_py_header
+from litedram.init import get_sdram_phy_c_header, get_sdram_phy_py_header, get_sdram_phy_init_sequence
 
 
 def compare_with_reference(test_case, content, filename):
@@ -73,3 +73,18 @@ class TestInit(unittest.TestCase):
         #update_c_reference(c_header, "ddr4_init.h")
         compare_with_reference(self, c_header, "ddr4_init.h")
         compare_with_reference(self, py_header, "ddr4_init.py")
+
+    def test_burst_chop(self):
+        from litedram.modules import MT41K128M16, MT40A256M16
+        from litedram.phy.model import get_sdram_phy_settings
+        for module in [MT41K128M16(100e6, "1:4"), MT40A256M16(100e6, "1:4")]:
+            with self.subTest(memtype=module.memtype):
+                phy_settings = get_sdram_phy_settings(module.memtype, data_width=16, clk_freq=100e6)
+                phy_settings.add_burst_chop()
+                init_sequence, _ = get_sdram_phy_init_sequence(phy_settings, module.timing_settings)
+                # MR0 BL field set to on-the-fly BC4/BL8.
+                mr0 = [a for comment, a, ba, *_ in init_sequence if comment.startswith("Load Mode Register 0")]
+                self.assertEqual(mr0[0] & 0b11, 0b01)
+                c_header = get_sdram_phy_c_header(phy_settings, module.timing_settings,
+                    module.geom_settings)
+                self.assertIn("#define SDRAM_PHY_BURST_CHOP", c_header)
@@ -56,6 +56,18 @@ class TestSDRAMModules(unittest.TestCase):
                 self.assertEqual(cls.speedgrade_timings["3200"].tFAW, (16, 10))
                 self.assertEqual(module.timing_settings.tFAW, 4)
 
+    def test_ddr4_bank_group_timings(self):
+        module = litedram.modules.MT40A512M8(clk_freq=200e6, rate="1:4")
+        self.assertEqual(module.geom_settings.bankgroupbits, 2)
+        self.assertEqual(module.timing_settings.tWTR,   3)
+        self.assertEqual(module.timing_settings.tWTR_S, 2)
+        self.assertEqual(module.timing_settings.tCCD_S, 1)
+        self.assertEqual(module.timing_settings.tRRD_S, 2)
+        # Without bank groups, no short timings
+        module = litedram.modules.MT41K128M16(clk_freq=100e6, rate="1:4")
+        self.assertEqual(module.geom_settings.bankgroupbits, 0)
+        self.assertIsNone(module.timing_settings.tCCD_S)
+
     def test_h5tc4g63cfr_geometry_and_trfc(self):
         cls = litedram.modules.H5TC4G63CFR
         module = cls(clk_freq=100e6, rate="1:4")
@@ -315,6 +327,10 @@ class TestSPD(unittest.TestCase):
             self.assertEqual(sgt.tRP,            13.75)
             self.assertEqual(sgt.tRCD,           13.75)
             self.assertEqual(sgt.tRP + sgt.tRAS, 45.75)
+            self.assertEqual(module.geom_settings.bankgroupbits, 1)
+            tt = module.technology_timings
+            self.assertLessEqual(tt.tRRD_S[1], tt.tRRD[1])
+            self.assertLessEqual(tt.tWTR_S[1], tt.tWTR[1])
 
         with self.subTest(speedgrade="-3G2"):
             data = load_spd_reference("MTA4ATF51264HZ-3G2E1.csv")
@@ -4,8 +4,10 @@
 # Copyright (c) 2020 Antmicro <www.antmicro.com>
 # SPDX-License-Identifier: BSD-2-Clause
 
+import io
 import copy
 import random
+import contextlib
 import unittest
 from collections import namedtuple
 
@@ -15,12 +17,17 @@ from litex.soc.interconnect import stream
 
 from litedram.common import *
 from litedram.phy import dfi
+from litedram.phy.model import DFITimingsChecker, SDRAMPHYModel, get_sdram_phy_settings
+from litedram.modules import MT41K128M16
+from litedram.modules import _speedgrade_timings, _technology_timings
 from litedram.core.multiplexer import Multiplexer
+from litedram.core.controller import LiteDRAMController, ControllerSettings
+from litedram.core.crossbar import LiteDRAMCrossbar
 
 # load after "* imports" to avoid using Migen version of vcd.py
 from litex.gen.sim import run_simulation
 
-from test.common import timeout_generator, CmdRequestRWDriver
+from test.common import timeout_generator, CmdRequestRWDriver, NativePortDriver
 
 
 def dfi_cmd_to_char(cas_n, ras_n, we_n):
@@ -39,11 +46,14 @@ class BankMachineStub:
         self.cmd = stream.Endpoint(cmd_request_rw_layout(a=abits, ba=babits))
         self.refresh_req = Signal()
         self.refresh_gnt = Signal()
+        self.nwrites     = Signal(4)
+        self.age         = Signal(8)
 
 
 class RefresherStub:
     def __init__(self, babits, abits):
-        self.cmd = stream.Endpoint(cmd_request_rw_layout(a=abits, ba=babits))
+        self.cmd       = stream.Endpoint(cmd_request_rw_layout(a=abits, ba=babits))
+        self.bank_lock = Signal(2**babits)
 
 
 class MultiplexerDUT(Module):
@@ -139,6 +149,19 @@ class MultiplexerDUT(Module):
 
 
 class TestMultiplexer(unittest.TestCase):
+    ddr3_phy_settings = dict(
+        nphases      = 4,
+        rdphase      = 2,
+        wrphase      = 3,
+        rdcmdphase   = 1,
+        wrcmdphase   = 2,
+        cl           = 6,
+        cwl          = 5,
+        read_latency = 8,
+        dfi_databits = 2*16,
+        memtype      = "DDR3",
+    )
+
     def test_init(self):
         # Verify that instantiation of Multiplexer in MultiplexerDUT is correct. This will fail if
         # Multiplexer starts using any new setting from controller.settings.
@@ -152,10 +175,9 @@ class TestMultiplexer(unittest.TestCase):
         dut = MultiplexerDUT()
         run_simulation(dut, main_generator(dut))
 
-    def test_fsm_read_to_write_latency(self):
+    def fsm_read_to_write_latency_test(self, rtw, phy_settings=None):
         # Verify the timing of READ to WRITE transition.
         def main_generator(dut):
-            rtw = dut.settings.phy.read_latency
             expected = "r" + (rtw - 1) * ">" + "w"
             states = ""
 
@@ -175,9 +197,86 @@ class TestMultiplexer(unittest.TestCase):
 
             self.assertEqual(states, expected)
 
-        dut = MultiplexerDUT()
+        dut = MultiplexerDUT(phy_settings=phy_settings)
         run_simulation(dut, main_generator(dut))
 
+    def test_fsm_read_to_write_latency(self):
+        # Without CL, wait for the read data (read_latency).
+        self.fsm_read_to_write_latency_test(rtw=MultiplexerDUT.default_phy_settings["read_latency"])
+
+    def test_fsm_read_to_write_latency_from_cl_cwl(self):
+        # DDR3 1:4: RL + BL/2 - WL + 2 = 6 + 4 - 5 + 2 = 7 DRAM clk, READ on phase 2, WRITE on
+        # phase 3, so WRITE can be issued 2 cycles after READ instead of read_latency.
+        self.fsm_read_to_write_latency_test(rtw=2, phy_settings=self.ddr3_phy_settings)
+
+    def test_fsm_read_to_write_latency_override(self):
+        # PHY settings can force the READ to WRITE latency.
+        phy_settings = dict(self.ddr3_phy_settings, rtw_latency=4)
+        self.fsm_read_to_write_latency_test(rtw=4, phy_settings=phy_settings)
+
+    def read_to_write_timings_test(self, phy_settings, burst_chop=False):
+        # Issue back to back READs on a bank until read_time expires, then a WRITE on the same bank
+        # as soon as possible, and return the output of DFITimingsChecker.
+        def main_generator(dut):
+            fsm = dut.multiplexer.fsm
+            yield from dut.bm_drivers[0].read()
+            yield from dut.bm_drivers[1].write()
+            yield
+            for _ in range(3):
+                # Wait for the READ accepted when leaving READ state.
+                while not ((yield dut.bank_machines[0].cmd.ready) and
+                           (yield fsm.state) == fsm.encoding["READ"] and
+                           (yield fsm.next_state) != fsm.encoding["READ"]):
+                    yield
+                yield from dut.bm_drivers[0].write()
+                yield
+                while not (yield dut.bank_machines[0].cmd.ready):
+                    yield
+                yield from dut.bm_drivers[0].read()
+            for _ in range(8):
+                yield
+
+        dut = MultiplexerDUT(
+            controller_settings = dict(read_time=4),
+            phy_settings        = phy_settings)
+        cl  = dut.settings.phy.cl
+        cwl = dut.settings.phy.cwl
+        timings = {"tCK": 2.5, "tRTW": (cl + 4 + 2 - cwl, None)}
+        for name in ["tRP", "tRCD", "tWR", "tWTR", "tREFI", "tRFC", "tFAW", "tCCD", "tRRD",
+                     "tRC", "tRAS", "tZQCS"]:
+            timings[name] = None
+        dut.submodules.checker = DFITimingsChecker(
+            dfi          = dut.dfi,
+            nbanks       = 2**dut.settings.geom.bankbits,
+            nphases      = dut.settings.phy.nphases,
+            timings      = timings,
+            refresh_mode = None,
+            memtype      = dut.settings.phy.memtype,
+            burst_chop   = burst_chop)
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_simulation(dut, [main_generator(dut), timeout_generator(200)])
+        return output.getvalue()
+
+    def test_read_to_write_timings(self):
+        # READ to WRITE turnaround derived from CL/CWL must respect tRTW.
+        output = self.read_to_write_timings_test(self.ddr3_phy_settings)
+        self.assertNotIn("violation", output)
+
+    def test_read_to_write_timings_violation(self):
+        # Sanity check that DFITimingsChecker detects a too short READ to WRITE turnaround.
+        output = self.read_to_write_timings_test(dict(self.ddr3_phy_settings, rtw_latency=1))
+        self.assertIn("tRTW violation", output)
+
+    def test_read_to_write_timings_burst_chop(self):
+        # With burst chop, READs from the drivers have A12 cleared (BC4): the turnaround is shorter
+        # but must still respect tRTW of BC4 READs.
+        phy_settings = dict(self.ddr3_phy_settings, burst_chop=True)
+        output = self.read_to_write_timings_test(phy_settings, burst_chop=True)
+        self.assertNotIn("violation", output)
+        output = self.read_to_write_timings_test(phy_settings, burst_chop=False)
+        self.assertIn("tRTW violation", output)
+
     def test_fsm_write_to_read_latency(self):
         # Verify the timing of WRITE to READ transition.
         def main_generator(dut):
@@ -213,6 +312,23 @@ class TestMultiplexer(unittest.TestCase):
         ]
         run_simulation(dut, generators)
 
+    def test_writing_hint(self):
+        # Verify the direction hint follows the FSM (writes from the RTW turnaround).
+        def main_generator(dut):
+            yield from dut.bm_drivers[0].write()
+            yield from dut.bm_drivers[1].read()
+            for _ in range(40):
+                state = (yield from dut.fsm_state())
+                self.assertEqual((yield dut.multiplexer.writing), state not in ["READ", "WTR", "REFRESH"])
+                yield
+
+        dut = MultiplexerDUT()
+        generators = [
+            main_generator(dut),
+            timeout_generator(50),
+        ]
+        run_simulation(dut, generators)
+
     def test_steer_read_correct_phases(self):
         # Check that correct phases are being used during READ.
         def main_generator(dut):
@@ -293,6 +409,48 @@ class TestMultiplexer(unittest.TestCase):
         ]
         run_simulation(dut, generators)
 
+    def cmd_age_order_test(self, requests, ages, controller_settings=None, phy_settings=None):
+        # Issue requests from several bank machines at once and return the order of acceptance.
+        order = []
+
+        def main_generator(dut):
+            for bm, request in requests.items():
+                yield dut.bank_machines[bm].age.eq(ages.get(bm, 0))
+                yield from dut.bm_drivers[bm].request(request)
+            pending = set(requests.keys())
+            while pending:
+                yield
+                for bm in sorted(pending):
+                    if (yield dut.bank_machines[bm].cmd.ready):
+                        order.append(bm)
+                        pending.remove(bm)
+                        yield from dut.bm_drivers[bm].nop()
+
+        dut = MultiplexerDUT(controller_settings=controller_settings, phy_settings=phy_settings)
+        run_simulation(dut, [main_generator(dut), timeout_generator(100)])
+        return order
+
+    def test_cmd_age_oldest_first(self):
+        # Verify that, with aging, ties between reads are broken by age instead of round-robin.
+        requests = {0: "r", 1: "r", 2: "r"}
+        ages     = {0: 3, 1: 10, 2: 7}
+        order = self.cmd_age_order_test(requests, ages)
+        self.assertEqual(order, [0, 1, 2])
+        order = self.cmd_age_order_test(requests, ages, controller_settings=dict(cmd_age_threshold=16))
+        self.assertEqual(order, [1, 2, 0])
+        order = self.cmd_age_order_test(requests, {}, controller_settings=dict(cmd_age_threshold=16))
+        self.assertEqual(order, [0, 1, 2])
+
+    def test_cmd_age_threshold(self):
+        # Verify that, with aging, row hits are preferred unless a request is older than the
+        # threshold.
+        requests = {2: "a", 3: "r"}
+        settings = dict(cmd_age_threshold=16)
+        phy      = dict(nphases=1)
+        self.assertEqual(self.cmd_age_order_test(requests, {}, phy_settings=phy), [2, 3])
+        self.assertEqual(self.cmd_age_order_test(requests, {2: 15, 3: 0}, settings, phy), [3, 2])
+        self.assertEqual(self.cmd_age_order_test(requests, {2: 16, 3: 0}, settings, phy), [2, 3])
+
     def test_ras_trrd(self):
         # Verify tRRD.
         def main_generator(dut):
@@ -357,6 +515,73 @@ class TestMultiplexer(unittest.TestCase):
         ]
         run_simulation(dut, generators)
 
+    def test_ras_trrd_bank_groups(self):
+        # Verify tRRD_S between ACTs to different bank groups.
+        def main_generator(dut):
+            yield from dut.bm_drivers[2].activate()
+            yield
+            while not (yield dut.bank_machines[2].cmd.ready):
+                yield
+            yield from dut.bm_drivers[2].nop()
+            yield from dut.bm_drivers[3].activate()
+            yield from dut.bm_drivers[4].activate()
+            yield
+
+            # Bank 4 (other bank group) only waits for tRRD_S, bank 3 (same bank group) for tRRD
+            ras_time = {}
+            for cycle in range(1, 8):
+                for n in [3, 4]:
+                    if (yield dut.bank_machines[n].cmd.ready):
+                        ras_time[n] = cycle
+                        yield from dut.bm_drivers[n].nop()
+                yield
+
+            self.assertEqual(ras_time, {4: 2, 3: 6})
+
+        dut = MultiplexerDUT(
+            geom_settings   = dict(bankgroupbits=1),
+            timing_settings = dict(tRRD=6, tRRD_S=2))
+        generators = [
+            main_generator(dut),
+            timeout_generator(50),
+        ]
+        run_simulation(dut, generators)
+
+    def test_cas_tccd_bank_groups(self):
+        # Verify that CAS alternate between bank groups to only wait for tCCD_S.
+        cas_cycles = []
+
+        def main_generator(dut):
+            for n in [0, 1, 4]:
+                yield from dut.bm_drivers[n].read()
+            for _ in range(32):
+                yield
+
+        @passive
+        def dfi_monitor(dfi):
+            cycle = 0
+            while True:
+                for p in dfi.phases:
+                    if not (yield p.cas_n):
+                        cas_cycles.append((cycle, (yield p.bank)))
+                cycle += 1
+                yield
+
+        dut = MultiplexerDUT(
+            geom_settings   = dict(bankgroupbits=1),
+            timing_settings = dict(tCCD=2, tCCD_S=1))
+        generators = [
+            main_generator(dut),
+            dfi_monitor(dut.dfi),
+        ]
+        run_simulation(dut, generators)
+
+        # Banks 0/1 are in bank group 0, bank 4 in bank group 1.
+        self.assertGreater(len(cas_cycles), 20)
+        for (prev_cycle, prev_bank), (cycle, bank) in zip(cas_cycles, cas_cycles[1:]):
+            self.assertNotEqual(prev_bank >> 2, bank >> 2)
+            self.assertEqual(cycle - prev_cycle, 1)
+
     def test_fsm_anti_starvation(self):
         # Check that anti-starvation works according to controller settings.
         def main_generator(dut):
@@ -392,6 +617,79 @@ class TestMultiplexer(unittest.TestCase):
         ]
         run_simulation(dut, generators)
 
+    def test_fsm_write_batching(self):
+        # Check that reads keep priority until the high watermark and writes drain to low watermark.
+        def main_generator(dut):
+            yield from dut.bm_drivers[2].read()
+            yield from dut.bm_drivers[3].write()
+            yield dut.bank_machines[3].nwrites.eq(3)
+            yield
+
+            # Reads keep priority below the high watermark
+            for _ in range(16):
+                self.assertEqual((yield from dut.fsm_state()), "READ")
+                yield
+
+            # High watermark reached: READ -> RTW -> WRITE
+            yield dut.bank_machines[4].nwrites.eq(1)
+            while (yield from dut.fsm_state()) != "WRITE":
+                yield
+
+            # Writes are drained while above the low watermark, even with reads available
+            yield dut.bank_machines[4].nwrites.eq(0)
+            for _ in range(8):
+                self.assertEqual((yield from dut.fsm_state()), "WRITE")
+                yield
+
+            # Low watermark reached: WRITE -> WTR
+            yield dut.bank_machines[3].nwrites.eq(1)
+            yield
+            yield
+            self.assertEqual((yield from dut.fsm_state()), "WTR")
+
+        # Disable anti-starvation to only check watermarks.
+        controller_settings = dict(read_time=0, write_time=0,
+            write_high_watermark=4, write_low_watermark=1)
+        dut = MultiplexerDUT(controller_settings=controller_settings)
+        generators = [
+            main_generator(dut),
+            timeout_generator(100),
+        ]
+        run_simulation(dut, generators)
+
+    def test_fsm_write_batching_unavailable(self):
+        # Check that queued writes above the watermarks only hold the bus when they can be issued.
+        def main_generator(dut):
+            yield from dut.bm_drivers[2].read()
+            # Writes above the high watermark, but row not opened yet.
+            yield from dut.bm_drivers[3].activate()
+            yield dut.bank_machines[3].nwrites.eq(4)
+            yield
+
+            # Reads keep the bus, even after read anti-starvation
+            for _ in range(2*dut.settings.read_time):
+                self.assertEqual((yield from dut.fsm_state()), "READ")
+                yield
+
+            # Row opened: READ -> RTW -> WRITE
+            yield from dut.bm_drivers[3].write()
+            while (yield from dut.fsm_state()) != "WRITE":
+                yield
+
+            # Row closed again (ex. precharged for a refresh): WRITE -> WTR before write anti-starvation
+            yield from dut.bm_drivers[3].precharge()
+            yield
+            yield
+            self.assertEqual((yield from dut.fsm_state()), "WTR")
+
+        controller_settings = dict(write_high_watermark=4, write_low_watermark=1)
+        dut = MultiplexerDUT(controller_settings=controller_settings)
+        generators = [
+            main_generator(dut),
+            timeout_generator(200),
+        ]
+        run_simulation(dut, generators)
+
     def test_write_datapath(self):
         # Verify that data is transmitted from native interface to DFI.
         def main_generator(dut):
@@ -482,6 +780,41 @@ class TestMultiplexer(unittest.TestCase):
         dut = MultiplexerDUT()
         run_simulation(dut, main_generator(dut))
 
+    def test_refresh_per_bank_requires_gnt(self):
+        # With per-bank refresh, only the locked bank machine gets the request and has to grant it.
+        def main_generator(dut):
+            def assert_dfi_cmd(cas, ras, we):
+                p = dut.dfi.phases[0]
+                cas_n, ras_n, we_n = (yield p.cas_n), (yield p.ras_n), (yield p.we_n)
+                self.assertEqual((cas_n, ras_n, we_n), (1 - cas, 1 - ras, 1 - we))
+
+            yield dut.refresher.bank_lock.eq(1 << 3)
+            yield from dut.refresh_driver.refresh()
+            yield
+
+            # Only the locked bank machine gets the request
+            for n, bm in enumerate(dut.bank_machines):
+                self.assertEqual((yield bm.refresh_req), int(n == 3))
+
+            # Other bank machines granting does not start the refresh
+            for n, bm in enumerate(dut.bank_machines):
+                if n != 3:
+                    yield bm.refresh_gnt.eq(1)
+            for _ in range(8):
+                yield
+                yield from assert_dfi_cmd(cas=0, ras=0, we=0)
+                self.assertNotEqual((yield from dut.fsm_state()), "REFRESH")
+
+            # Refresh command once the locked bank machine grants
+            yield dut.bank_machines[3].refresh_gnt.eq(1)
+            yield
+            yield
+            yield
+            yield from assert_dfi_cmd(cas=1, ras=1, we=0)
+
+        dut = MultiplexerDUT(controller_settings=dict(refresh_per_bank=True))
+        run_simulation(dut, main_generator(dut))
+
     def test_requests_from_multiple_bankmachines(self):
         # Check complex communication scenario with requests from multiple bank machines
         # The communication is greatly simplified - data path is completely ignored, no responses
@@ -581,3 +914,116 @@ class TestMultiplexer(unittest.TestCase):
                         self.assertEqual(phase_snap.wrdata_en, 1)
                     if cmd == "r":
                         self.assertEqual(phase_snap.rddata_en, 1)
+
+    def controller_timings_test(self, controller_settings, nranks=1, trefi=None):
+        # Run random traffic from several ports through a LiteDRAMController and return the output
+        # of DFITimingsChecker.
+        clk_freq = 100e6
+        module   = MT41K128M16(clk_freq, "1:4")
+        phy      = get_sdram_phy_settings(memtype=module.memtype, data_width=16, clk_freq=clk_freq,
+            nranks=nranks)
+        if trefi is not None:
+            module.timing_settings.tREFI = trefi
+        dut      = Module()
+        dut.submodules.controller = controller = LiteDRAMController(phy, module.geom_settings,
+            module.timing_settings, clk_freq, ControllerSettings(**controller_settings))
+        dut.submodules.crossbar = crossbar = LiteDRAMCrossbar(controller.interface)
+
+        timings = {"tCK": (1e9 / clk_freq) / phy.nphases}
+        for name in _speedgrade_timings + _technology_timings:
+            timings[name] = module.get(name)
+        timings["tRTW"] = (phy.cl + burst_lengths[phy.memtype]//2 + 2 - phy.cwl, None)
+        timings["tRTRS"] = (1, None)
+        dut.submodules.checker = DFITimingsChecker(
+            dfi          = controller.dfi,
+            nbanks       = 2**module.geom_settings.bankbits,
+            nphases      = phy.nphases,
+            timings      = timings,
+            refresh_mode = None,
+            memtype      = phy.memtype,
+            nranks       = nranks)
+
+        drivers = [NativePortDriver(crossbar.get_port()) for _ in range(4)]
+        prng    = random.Random(42)
+
+        def master(driver):
+            for _ in range(8):
+                addr = prng.randrange(2**12)
+                if prng.randrange(2):
+                    yield from driver.write(addr, data=prng.randrange(2**32), wait_data=False)
+                else:
+                    yield from driver.read(addr, wait_data=False)
+            yield from driver.wait_all()
+
+        generators = [master(driver) for driver in drivers] + [timeout_generator(2000)]
+        for driver in drivers:
+            generators += driver.generators()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_simulation(dut, generators)
+        return output.getvalue()
+
+    def test_pipelined_choosers_timings(self):
+        # Verify that pipelined choosers keep the command protocol and DRAM timings intact.
+        for settings in [{}, dict(with_pipelined_choosers=True),
+                         dict(with_pipelined_choosers=True, cmd_age_threshold=16)]:
+            with self.subTest(settings=settings):
+                output = self.controller_timings_test(settings)
+                self.assertNotIn("violation", output)
+
+    def test_multi_rank_timings(self):
+        # Verify that rank switches (tRTRS) and refreshes staggered across the ranks keep the DRAM
+        # timings intact.
+        output = self.controller_timings_test(dict(refresh_per_rank=True), nranks=2, trefi=200)
+        self.assertNotIn("violation", output)
+
+    def test_burst_chop(self):
+        # Verify with SDRAMPHYModel that chopped (BC4) accesses only transfer the first half of the
+        # native word, from/to the half selected by chop_upper.
+        clk_freq = 100e6
+        module   = MT41K128M16(clk_freq, "1:4")
+        phy      = get_sdram_phy_settings(memtype=module.memtype, data_width=16, clk_freq=clk_freq)
+        phy.add_burst_chop()
+        # Reduce the number of rows to keep the simulated memory small (A12 still required).
+        module.geom_settings = GeomSettings(bankbits=3, rowbits=4, colbits=10)
+        module.geom_settings.addressbits = 13
+        dut      = Module()
+        dut.submodules.controller = controller = LiteDRAMController(phy, module.geom_settings,
+            module.timing_settings, clk_freq)
+        dut.submodules.crossbar = crossbar = LiteDRAMCrossbar(controller.interface)
+        dut.submodules.sdrphy   = sdrphy   = SDRAMPHYModel(module, phy, clk_freq=clk_freq)
+        dut.comb += controller.dfi.connect(sdrphy.dfi)
+        port   = crossbar.get_port()
+        driver = NativePortDriver(port)
+        half   = port.data_width//2
+        mask   = 2**half - 1
+        rdata  = []
+
+        def chop(upper):
+            yield port.cmd.chop.eq(1)
+            yield port.cmd.chop_upper.eq(upper)
+
+        def main_generator():
+            yield from driver.write(0x10, data=0x0123456789abcdef_fedcba9876543210)
+            yield from chop(upper=1)
+            yield from driver.write(0x10, data=0x55555555_aaaaaaaa)
+            yield from chop(upper=0)
+            yield from driver.write(0x20, data=(0x11111111 << half) | 0x22222222)
+            yield port.cmd.chop.eq(0)
+            for adr in [0x10, 0x20]:
+                rdata.append((yield from driver.read(adr)))
+            for upper in [0, 1]:
+                yield from chop(upper=upper)
+                rdata.append((yield from driver.read(0x10)) & mask)
+
+        generators = [main_generator(), timeout_generator(5000)] + driver.generators()
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            run_simulation(dut, generators)
+        self.assertNotIn("violation", output.getvalue())
+        self.assertEqual([hex(d) for d in rdata], [hex(d) for d in [
+            0x55555555aaaaaaaa_fedcba9876543210,
+            0x22222222,
+            0xfedcba9876543210,
+            0x55555555aaaaaaaa,
+        ]])
@@ -0,0 +1,139 @@
+#
+# This file is part of LiteDRAM.
+#
+# SPDX-License-Identifier: BSD-2-Clause
+
+import unittest
+
+from migen import *
+
+from litedram.core.perfmon import PerfMonitor, bank_events_layout, multiplexer_events_layout
+
+from test.common import timeout_generator
+
+
+class PerfMonitorDUT(Module):
+    def __init__(self, nbanks=4, depth=8, period_bits=8):
+        self.period_bits = period_bits
+        self.banks = [Record(bank_events_layout(depth)) for _ in range(nbanks)]
+        self.mux   = Record(multiplexer_events_layout)
+        self.submodules.perfmon = PerfMonitor(self.banks, self.mux, period_bits)
+
+
+class TestPerfMonitor(unittest.TestCase):
+    def perfmon_test(self, dut, timeline, ncycles):
+        # Drive events for `ncycles` (timeline: cycle -> list of (record, field, value)), then wait
+        # for the end of the period and return the snapshot of the counters for each bank.
+        results = {}
+        perfmon = dut.perfmon
+
+        def main_generator(dut):
+            for cycle in range(ncycles):
+                for record, field, value in timeline.get(cycle, []):
+                    yield getattr(record, field).eq(value)
+                yield
+                for record, field, value in timeline.get(cycle, []):
+                    yield getattr(record, field).eq(0)
+            for _ in range(2**dut.period_bits):
+                yield
+            for bank in range(len(dut.banks)):
+                yield from perfmon.bank.write(bank)
+                yield from perfmon.update.write(1)
+                yield
+                results[bank] = {}
+                for name in ["row_hits", "row_misses", "row_conflicts", "activates", "precharges",
+                             "occupancy_sum"]:
+                    results[bank][name] = (yield from getattr(perfmon, "bank_" + name).read())
+            for name in ["row_hits", "row_misses", "row_conflicts", "activates", "precharges",
+                         "occupancy_sum", "refresh_stalls", "rtw_turnarounds", "wtr_turnarounds",
+                         "read_cycles", "write_cycles", "refresh_cycles", "turnaround_cycles"]:
+                results[name] = (yield from getattr(perfmon, name).read())
+
+        run_simulation(dut, [main_generator(dut), timeout_generator(1000)])
+        return results
+
+    def test_bank_counters(self):
+        # Verify that row hits/misses/conflicts, activates and precharges are counted per bank and
+        # in aggregate.
+        dut = PerfMonitorDUT()
+        timeline = {
+            1: [(dut.banks[0], "row_miss", 1), (dut.banks[1], "row_miss", 1)],
+            2: [(dut.banks[0], "activate", 1), (dut.banks[1], "activate", 1)],
+            4: [(dut.banks[0], "row_hit", 1)],
+            5: [(dut.banks[1], "row_conflict", 1)],
+            6: [(dut.banks[1], "precharge", 1)],
+            7: [(dut.banks[0], "row_hit", 1), (dut.banks[2], "row_miss", 1)],
+        }
+        results = self.perfmon_test(dut, timeline, ncycles=16)
+        self.assertEqual(results[0], dict(row_hits=2, row_misses=1, row_conflicts=0,
+            activates=1, precharges=0, occupancy_sum=0))
+        self.assertEqual(results[1], dict(row_hits=0, row_misses=1, row_conflicts=1,
+            activates=1, precharges=1, occupancy_sum=0))
+        self.assertEqual(results[2]["row_misses"], 1)
+        self.assertEqual(results[3]["row_misses"], 0)
+        self.assertEqual(results["row_hits"],      2)
+        self.assertEqual(results["row_misses"],    3)
+        self.assertEqual(results["row_conflicts"], 1)
+        self.assertEqual(results["activates"],     2)
+        self.assertEqual(results["precharges"],    1)
+
+    def test_occupancy(self):
+        # Verify that the command buffer occupancy is accumulated over the period.
+        dut = PerfMonitorDUT()
+        timeline = {
+            cycle: [(dut.banks[0], "level", 3), (dut.banks[3], "level", 1)] for cycle in range(10)
+        }
+        results = self.perfmon_test(dut, timeline, ncycles=10)
+        self.assertEqual(results[0]["occupancy_sum"], 30)
+        self.assertEqual(results[3]["occupancy_sum"], 10)
+        self.assertEqual(results["occupancy_sum"],    40)
+
+    def test_multiplexer_counters(self):
+        # Verify that Multiplexer state cycles, turnarounds and refresh stalls are counted.
+        dut = PerfMonitorDUT()
+        timeline = {}
+        for cycle in range(0, 5):
+            timeline[cycle] = [(dut.mux, "read", 1)]
+        timeline[4] += [(dut.mux, "rtw", 1)]
+        for cycle in range(5, 7):
+            timeline[cycle] = [(dut.mux, "turnaround", 1)]
+        for cycle in range(7, 10):
+            timeline[cycle] = [(dut.mux, "write", 1)]
+        timeline[9] += [(dut.mux, "wtr", 1)]
+        for cycle in range(8, 12):
+            timeline[cycle] = timeline.get(cycle, []) + [(dut.mux, "refresh_stall", 1)]
+        for cycle in range(10, 12):
+            timeline[cycle] += [(dut.mux, "refresh", 1)]
+        results = self.perfmon_test(dut, timeline, ncycles=12)
+        self.assertEqual(results["read_cycles"],       5)
+        self.assertEqual(results["turnaround_cycles"], 2)
+        self.assertEqual(results["write_cycles"],      3)
+        self.assertEqual(results["refresh_cycles"],    2)
+        self.assertEqual(results["rtw_turnarounds"],   1)
+        self.assertEqual(results["wtr_turnarounds"],   1)
+        self.assertEqual(results["refresh_stalls"],    4)
+
+    def test_snapshot(self):
+        # Verify that status registers only change on update, with the values of the last period.
+        dut = PerfMonitorDUT(nbanks=1, period_bits=4)
+
+        def main_generator(dut):
+            perfmon = dut.perfmon
+            # Row hit every 4 cycles for 3 periods.
+            for cycle in range(3*2**4):
+                yield dut.banks[0].row_hit.eq(cycle % 4 == 0)
+                yield
+            yield dut.banks[0].row_hit.eq(0)
+            self.assertEqual((yield from perfmon.row_hits.read()), 0)
+            yield from perfmon.update.write(1)
+            yield
+            self.assertEqual((yield from perfmon.row_hits.read()), 4)
+            # No more row hits: status unchanged until the next update.
+            for _ in range(2*2**4):
+                yield
+            self.assertEqual((yield from perfmon.row_hits.read()), 4)
+            yield from perfmon.update.write(1)
+            yield
+            self.assertEqual((yield from perfmon.row_hits.read()), 0)
+
+        run_simulation(dut, [main_generator(dut), timeout_generator(500)])
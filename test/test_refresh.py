@@ -9,7 +9,7 @@ import unittest
 from migen import *
 
 from litedram.core.multiplexer import cmd_request_rw_layout
-from litedram.core.refresher import RefreshSequencer, RefreshTimer, Refresher
+from litedram.core.refresher import RefreshSequencer, RefreshTimer, RefreshCredit, Refresher
 
 
 def c2bool(c):
@@ -111,3 +111,206 @@ class TestRefresh(unittest.TestCase):
         for postponing in [1, 2, 4, 8]:
             with self.subTest(postponing=postponing):
                 self.refresher_test(postponing)
+
+    def refresher_per_bank_settings(self, memtype="LPDDR4"):
+        class Obj: pass
+        settings = Obj()
+        settings.with_refresh = True
+        settings.refresh_per_bank = True
+        settings.timing = Obj()
+        settings.timing.tREFI  = 1024
+        settings.timing.tRP    = 1
+        settings.timing.tRFC   = 16
+        settings.timing.tRFCpb = 8
+        settings.timing.tRRD   = 2
+        settings.timing.tZQCS  = None
+        settings.geom = Obj()
+        settings.geom.addressbits = 16
+        settings.geom.bankbits    = 3
+        settings.phy = Obj()
+        settings.phy.nranks  = 1
+        settings.phy.memtype = memtype
+        return settings
+
+    def test_refresher_per_bank(self):
+        # Per-bank refreshes are rotated across the banks every tREFI/nbanks, only locking the
+        # targeted bank until tRFCpb after the REFpb.
+        settings = self.refresher_per_bank_settings()
+        def generator(dut):
+            dut.errors = 0
+            yield dut.cmd.ready.eq(1)
+            for i in range(16):
+                while (yield dut.cmd.valid) == 0:
+                    yield
+                if (yield dut.bank_lock) != (1 << (i % 8)):
+                    dut.errors += 1
+                # REFpb to the targeted bank
+                while not ((yield dut.cmd.cas) and (yield dut.cmd.ras)):
+                    yield
+                if (yield dut.cmd.ba) != (i % 8) or (yield dut.cmd.a) != 0:
+                    dut.errors += 1
+                # Bank kept locked for tRFCpb after the refresh command
+                while (yield dut.cmd.last) == 0:
+                    yield
+                for _ in range(settings.timing.tRFCpb):
+                    yield
+                    if (yield dut.bank_lock) != (1 << (i % 8)):
+                        dut.errors += 1
+                yield
+                yield
+                if (yield dut.bank_lock) != 0:
+                    dut.errors += 1
+
+        def period_checker(dut):
+            starts = []
+            valid  = 0
+            for cycle in range(16*settings.timing.tREFI//8):
+                if (yield dut.cmd.valid) and not valid:
+                    starts.append(cycle)
+                valid = (yield dut.cmd.valid)
+                yield
+            periods = [b - a for a, b in zip(starts, starts[1:])]
+            self.assertEqual(set(periods), {settings.timing.tREFI//8})
+
+        dut = Refresher(settings, clk_freq=100e6)
+        run_simulation(dut, [generator(dut), period_checker(dut)])
+        self.assertEqual(dut.errors, 0)
+
+    def test_refresher_per_bank_unsupported(self):
+        settings = self.refresher_per_bank_settings(memtype="DDR3")
+        with self.assertRaises(ValueError):
+            Refresher(settings, clk_freq=100e6)
+
+    def refresher_per_rank_settings(self, nranks=2):
+        class Obj: pass
+        settings = Obj()
+        settings.with_refresh = True
+        settings.refresh_per_rank = True
+        settings.timing = Obj()
+        settings.timing.tREFI = 1024
+        settings.timing.tRP   = 1
+        settings.timing.tRFC  = 16
+        settings.timing.tZQCS = None
+        settings.geom = Obj()
+        settings.geom.addressbits = 16
+        settings.geom.bankbits    = 3
+        settings.phy = Obj()
+        settings.phy.nranks  = nranks
+        settings.phy.memtype = "DDR3"
+        return settings
+
+    def test_refresher_per_rank(self):
+        # Refreshes are staggered across the ranks every tREFI/nranks, only locking the BankMachines
+        # of the targeted rank until tRFC after the refresh, which is only sent to this rank.
+        settings = self.refresher_per_rank_settings()
+        def generator(dut):
+            dut.errors = 0
+            yield dut.cmd.ready.eq(1)
+            for i in range(8):
+                rank_lock = 0xff << (8*(i % 2))
+                while (yield dut.cmd.valid) == 0:
+                    yield
+                if (yield dut.bank_lock) != rank_lock or (yield dut.ranks) != (1 << (i % 2)):
+                    dut.errors += 1
+                # Auto Refresh
+                while not ((yield dut.cmd.cas) and (yield dut.cmd.ras)):
+                    yield
+                # Rank kept locked for tRFC after the refresh command
+                for _ in range(settings.timing.tRFC):
+                    yield
+                    if (yield dut.bank_lock) != rank_lock:
+                        dut.errors += 1
+                while (yield dut.bank_lock) != 0:
+                    yield
+
+        def period_checker(dut):
+            starts = []
+            valid  = 0
+            for cycle in range(8*settings.timing.tREFI//2):
+                if (yield dut.cmd.valid) and not valid:
+                    starts.append(cycle)
+                valid = (yield dut.cmd.valid)
+                yield
+            periods = [b - a for a, b in zip(starts, starts[1:])]
+            self.assertEqual(set(periods), {settings.timing.tREFI//2})
+
+        dut = Refresher(settings, clk_freq=100e6)
+        run_simulation(dut, [generator(dut), period_checker(dut)])
+        self.assertEqual(dut.errors, 0)
+
+    def test_refresher_per_rank_unsupported(self):
+        settings = self.refresher_per_rank_settings(nranks=1)
+        with self.assertRaises(ValueError):
+            Refresher(settings, clk_freq=100e6)
+
+    def refresher_pull_in_test(self, postponing, pull_in, idle, cycles):
+        class Obj: pass
+        settings = Obj()
+        settings.with_refresh = True
+        settings.refresh_pull_in = pull_in
+        settings.timing = Obj()
+        settings.timing.tREFI = 128
+        settings.timing.tRP   = 1
+        settings.timing.tRFC  = 2
+        settings.timing.tZQCS = None
+        settings.geom = Obj()
+        settings.geom.addressbits = 16
+        settings.geom.bankbits    = 3
+        settings.phy = Obj()
+        settings.phy.nranks = 1
+
+        starts = []
+        def generator(dut):
+            yield dut.cmd.ready.eq(1)
+            valid = 0
+            for cycle in range(cycles):
+                yield dut.idle.eq(idle(cycle))
+                if (yield dut.cmd.valid) and not valid:
+                    starts.append(cycle)
+                valid = (yield dut.cmd.valid)
+                yield
+
+        dut = Refresher(settings, clk_freq=100e6, postponing=postponing)
+        run_simulation(dut, [generator(dut)])
+        return starts
+
+    def test_refresher_pull_in_idle(self):
+        # While idle, refreshes are pulled in until the credit is full, then issued every tREFI.
+        trefi = 128
+        starts = self.refresher_pull_in_test(postponing=8, pull_in=4, idle=lambda c: 1, cycles=8*trefi)
+        self.assertTrue(all(start < trefi//2 for start in starts[:4]))
+        periods = [b - a for a, b in zip(starts[4:], starts[5:])]
+        self.assertEqual(set(periods), {trefi})
+        self.assertEqual(len(starts), 4 + 7)
+
+    def test_refresher_pull_in_busy(self):
+        # While busy, refreshes are postponed up to the limit, then issued every tREFI. Once idle,
+        # the postponed refreshes are caught up and refreshes are pulled in.
+        trefi = 128
+        starts = self.refresher_pull_in_test(postponing=8, pull_in=4, idle=lambda c: int(c >= 12*trefi),
+            cycles=12*trefi + trefi//2)
+        self.assertEqual(starts[0]//trefi, 8)
+        periods = [b - a for a, b in zip(starts[:5], starts[1:5])]
+        self.assertEqual(set(periods), {trefi})
+        # Caught up: 7 postponed refreshes + 4 pulled in.
+        self.assertEqual(len([start for start in starts if start >= 12*trefi]), 7 + 4)
+
+    def test_refresh_credit_overdue(self):
+        # The forced request is kept when another tREFI elapses before the refresh is done, and the
+        # extra postponed refresh is accounted.
+        def generator(dut, req_os, credits):
+            yield dut.idle.eq(0)
+            for req_i, done in [(1, 0)]*4 + [(0, 0), (0, 1), (0, 0), (0, 1), (0, 0), (0, 1)]:
+                yield dut.req_i.eq(req_i)
+                yield dut.done.eq(done)
+                yield
+                req_os.append((yield dut.req_o))
+                credits.append((yield dut.credit))
+
+        dut     = RefreshCredit(postponing=2, pull_in=4)
+        req_os  = []
+        credits = []
+        run_simulation(dut, generator(dut, req_os, credits))
+        self.assertEqual(credits, [0, -1, -2, -3, -3, -3, -2, -2, -1, -1])
+        self.assertEqual(req_os,  [0,  0,  1,  1,  1,  1,  1,  1,  0,  0])
+
@@ -18,7 +18,7 @@ from test.common import CmdRequestRWDriver
 
 
 class SteererDUT(Module):
-    def __init__(self, nranks, dfi_databits, nphases):
+    def __init__(self, nranks, dfi_databits, nphases, with_refresh_ranks=False):
         a, ba         = 13, 3
         nop           = Record(cmd_request_layout(a=a, ba=ba))
         choose_cmd    = stream.Endpoint(cmd_request_rw_layout(a=a, ba=ba))
@@ -28,7 +28,8 @@ class SteererDUT(Module):
         self.commands = [nop, choose_cmd, choose_req, refresher_cmd]
         self.dfi = dfi.Interface(addressbits=a, bankbits=ba, nranks=nranks, databits=dfi_databits,
                                  nphases=nphases)
-        self.submodules.steerer = _Steerer(self.commands, self.dfi)
+        self.refresh_ranks = Signal(nranks) if with_refresh_ranks else None
+        self.submodules.steerer = _Steerer(self.commands, self.dfi, self.refresh_ranks)
 
         # NOP is not an endpoint and does not have is_* signals
         self.drivers = [CmdRequestRWDriver(req, i, ep_layout=i != 0, rw_layout=i != 0)
@@ -194,6 +195,29 @@ class TestSteerer(unittest.TestCase):
         dut = SteererDUT(nranks=2, dfi_databits=16, nphases=2)
         run_simulation(dut, main_generator(dut))
 
+    def test_select_refresh_ranks_on_refresh(self):
+        # With refresh_ranks (per-rank refresh), only the refreshed ranks should be selected.
+        def main_generator(dut):
+            yield from dut.drivers[STEER_NOP].nop()
+            yield dut.steerer.sel[0].eq(STEER_REFRESH)
+            yield dut.steerer.sel[1].eq(STEER_NOP)
+            yield from dut.drivers[STEER_REFRESH].refresh()
+            yield dut.commands[STEER_REFRESH].ready.eq(1)
+
+            for ranks, phase_cs_n in [(0b01, 0b10), (0b10, 0b01), (0b11, 0b00)]:
+                with self.subTest(ranks=ranks):
+                    yield dut.refresh_ranks.eq(ranks)
+                    yield
+                    yield
+
+                    p = dut.dfi.phases[0]
+                    self.assertEqual((yield p.cas_n), 0)
+                    self.assertEqual((yield p.ras_n), 0)
+                    self.assertEqual((yield p.cs_n),  phase_cs_n)
+
+        dut = SteererDUT(nranks=2, dfi_databits=16, nphases=2, with_refresh_ranks=True)
+        run_simulation(dut, main_generator(dut))
+
     def test_reset_n_high(self):
         # Reset_n should be 1 for all phases at all times.
         def main_generator(dut):
@@ -18,7 +18,8 @@ from test.common import DRAMMemory, MemoryTestDataMixin, timeout_generator
 
 
 class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
-    def wishbone_readback_test(self, pattern, mem_expected, wishbone, port, base_address=0):
+    def wishbone_readback_test(self, pattern, mem_expected, wishbone, port, base_address=0,
+        **kwargs):
         class DUT(Module):
             def __init__(self):
                 self.port = port
@@ -26,7 +27,8 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
                 self.submodules += LiteDRAMWishbone2Native(
                     wishbone     = self.wb,
                     port         = self.port,
-                    base_address = base_address)
+                    base_address = base_address,
+                    **kwargs)
                 self.mem = DRAMMemory(port.data_width, len(mem_expected))
 
         def main_generator(dut):
@@ -44,10 +46,12 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
         run_simulation(dut, generators, vcd_name='sim.vcd')
         self.assertEqual(dut.mem.mem, mem_expected)
 
-    def wishbone_burst_readback_test(self, base_address=0):
+    def wishbone_burst_readback_test(self, base_address=0, port_data_width=128, burst_width=0,
+        native_write_cmds=1, native_read_cmds=1):
         class DUT(Module):
             def __init__(self):
-                self.port = LiteDRAMNativePort("both", address_width=30, data_width=128)
+                self.port = LiteDRAMNativePort("both", address_width=30, data_width=port_data_width,
+                    burst_width=burst_width)
                 self.wb   = wishbone.Interface(adr_width=30, data_width=32)
                 self.submodules += LiteDRAMWishbone2Native(
                     wishbone     = self.wb,
@@ -116,6 +120,7 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
 
         values   = [0x01234567, 0x89abcdef, 0x0badcafe, 0x55aa33cc]
         readback = []
+        partial  = []
 
         wishbone_base = base_address//(32//8)
 
@@ -124,6 +129,9 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
             for _ in range(16):
                 yield
             readback[:] = (yield from wishbone_burst_read(dut.wb, wishbone_base, len(values)))
+            # Shorter burst, prefetched words not requested are discarded.
+            partial[:]  = (yield from wishbone_burst_read(dut.wb, wishbone_base + 1, 2))
+            partial.append((yield from dut.wb.read(wishbone_base + 3)))
 
         dut = DUT()
         generators = [
@@ -135,8 +143,88 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
         ]
         run_simulation(dut, generators, vcd_name='sim.vcd')
         self.assertEqual(readback, values)
-        self.assertEqual(dut.native_write_cmds, 1)
-        self.assertEqual(dut.native_read_cmds, 1)
+        self.assertEqual(partial,  values[1:])
+        self.assertEqual(dut.native_write_cmds, native_write_cmds)
+        self.assertEqual(dut.native_read_cmds,  native_read_cmds + 2)
+
+    @passive
+    def native_latency_handler(self, port, latency, mem=None):
+        # Accept a command per cycle and return the read data after latency cycles (mem content,
+        # address by default).
+        mem     = {} if mem is None else mem
+        pending = []
+        writes  = []
+        cycle   = 0
+        yield port.cmd.ready.eq(1)
+        while True:
+            yield port.rdata.valid.eq(0)
+            yield port.wdata.ready.eq(len(writes) > 0)
+            if pending and pending[0][0] <= cycle:
+                adr = pending.pop(0)[1]
+                yield port.rdata.valid.eq(1)
+                yield port.rdata.data.eq(mem.get(adr, adr))
+            yield
+            if writes and (yield port.wdata.valid):
+                mem[writes.pop(0)] = (yield port.wdata.data)
+            if (yield port.cmd.valid):
+                if (yield port.cmd.we):
+                    writes.append((yield port.cmd.addr))
+                else:
+                    pending.append((cycle + latency, (yield port.cmd.addr)))
+            cycle += 1
+
+    def wishbone_pipelined_access(self, wb, stall, accesses):
+        # Issue the accesses (adr, data, we) back to back and return the data of the acks.
+        acks = []
+        i    = 0
+        yield wb.cyc.eq(1)
+        yield wb.sel.eq(2**len(wb.sel) - 1)
+        while len(acks) < len(accesses):
+            if i < len(accesses):
+                adr, data, we = accesses[i]
+                yield wb.stb.eq(1)
+                yield wb.adr.eq(adr)
+                yield wb.dat_w.eq(data)
+                yield wb.we.eq(we)
+            else:
+                yield wb.stb.eq(0)
+            yield
+            if (yield wb.ack):
+                acks.append((yield wb.dat_r))
+            if (i < len(accesses)) and not (yield stall):
+                i += 1
+        yield wb.cyc.eq(0)
+        yield wb.stb.eq(0)
+        yield
+        return acks
+
+    def wishbone_pipelined_readback_test(self, pattern, mem_expected, wishbone, port):
+        class DUT(Module):
+            def __init__(self):
+                self.port = port
+                self.wb   = wishbone
+                self.submodules.wb2native = LiteDRAMWishbone2Native(
+                    wishbone  = self.wb,
+                    port      = self.port,
+                    pipelined = True)
+                self.mem = DRAMMemory(port.data_width, len(mem_expected))
+
+        def main_generator(dut):
+            writes = [(adr, data, 1) for adr, data in pattern]
+            reads  = [(adr, 0,    0) for adr, data in pattern]
+            yield from self.wishbone_pipelined_access(dut.wb, dut.wb2native.stall, writes)
+            data_r = (yield from self.wishbone_pipelined_access(dut.wb, dut.wb2native.stall, reads))
+            self.assertEqual(data_r, [data for adr, data in pattern])
+
+        dut = DUT()
+        generators = [
+            main_generator(dut),
+            dut.mem.write_handler(dut.port),
+            dut.mem.read_handler(dut.port),
+            timeout_generator(10000),
+        ]
+        run_simulation(dut, generators)
+        self.assertEqual(dut.mem.mem, mem_expected)
 
     def test_wishbone_8bit(self):
         # Verify Wishbone with 8-bit data width.
@@ -207,6 +295,10 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
     def test_wishbone_incrementing_burst_32bit_to_128bit_base_address(self):
         self.wishbone_burst_readback_test(base_address=0x10000000)
 
+    def test_wishbone_incrementing_burst_32bit_native_bursts(self):
+        # Incrementing read bursts are issued as native bursts, writes remain single words.
+        self.wishbone_burst_readback_test(port_data_width=32, burst_width=2, native_write_cmds=4)
+
     def test_wishbone_32bit_base_address(self):
         # Verify Wishbone with 32-bit data width and non-zero base address.
         data   = self.pattern_test_data["32bit"]
@@ -234,3 +326,188 @@ class TestWishbone(MemoryTestDataMixin, unittest.TestCase):
         origin  = 0x10000000
         pattern = [(adr + origin//(32//8), data) for adr, data in data["pattern"]]
         self.wishbone_readback_test(pattern, data["expected"], wb, port, base_address=origin)
+
+    def test_wishbone_pipelined_32bit(self):
+        # Verify pipelined Wishbone with 32-bit data width.
+        data = self.pattern_test_data["32bit"]
+        wb   = wishbone.Interface(adr_width=30, data_width=32)
+        port = LiteDRAMNativePort("both", address_width=30, data_width=32)
+        self.wishbone_pipelined_readback_test(data["pattern"], data["expected"], wb, port)
+
+    def test_wishbone_pipelined_32bit_to_128bit(self):
+        # Verify pipelined Wishbone with 32-bit data width up-converted to 128-bit data width.
+        data = self.pattern_test_data["32bit_to_128bit"]
+        wb   = wishbone.Interface(adr_width=30, data_width=32)
+        port = LiteDRAMNativePort("both", address_width=30, data_width=128)
+        self.wishbone_pipelined_readback_test(data["pattern"], data["expected"], wb, port)
+
+    def test_wishbone_pipelined_outstanding_reads(self):
+        # Verify that pipelined reads overlap their latency.
+        latency = 8
+        nreads  = 8
+
+        class DUT(Module):
+            def __init__(self, pipelined):
+                self.port = LiteDRAMNativePort("both", address_width=30, data_width=32)
+                self.wb   = wishbone.Interface(adr_width=30, data_width=32)
+                self.submodules.wb2native = LiteDRAMWishbone2Native(
+                    wishbone        = self.wb,
+                    port            = self.port,
+                    pipelined       = pipelined,
+                    max_outstanding = 4)
+
+        def run(pipelined):
+            dut    = DUT(pipelined)
+            cycle  = [0]
+            result = {}
+
+            @passive
+            def cycle_counter():
+                while True:
+                    yield
+                    cycle[0] += 1
+
+            def main_generator(dut):
+                start = cycle[0]
+                if pipelined:
+                    reads = [(adr, 0, 0) for adr in range(nreads)]
+                    data_r = (yield from self.wishbone_pipelined_access(
+                        dut.wb, dut.wb2native.stall, reads))
+                else:
+                    data_r = []
+                    for adr in range(nreads):
+                        data_r.append((yield from dut.wb.read(adr)))
+                result["data"]   = data_r
+                result["cycles"] = cycle[0] - start
+
+            run_simulation(dut, [
+                main_generator(dut),
+                self.native_latency_handler(dut.port, latency),
+                cycle_counter(),
+                timeout_generator(1000),
+            ])
+            return result
+
+        classic   = run(pipelined=False)
+        pipelined = run(pipelined=True)
+        self.assertEqual(classic["data"],   list(range(nreads)))
+        self.assertEqual(pipelined["data"], list(range(nreads)))
+        self.assertLess(2*pipelined["cycles"], classic["cycles"])
+
+    def test_wishbone_prefetch_32bit(self):
+        # Verify Wishbone with 32-bit data width and prefetch (reads following writes).
+        data = self.pattern_test_data["32bit"]
+        wb   = wishbone.Interface(adr_width=30, data_width=32)
+        port = LiteDRAMNativePort("both", address_width=30, data_width=32)
+        self.wishbone_readback_test(data["pattern"], data["expected"], wb, port, prefetch_depth=4)
+
+    def test_wishbone_prefetch_32bit_to_128bit(self):
+        # Verify Wishbone with 32-bit data width up-converted to 128-bit data width and prefetch.
+        data = self.pattern_test_data["32bit_to_128bit"]
+        wb   = wishbone.Interface(adr_width=30, data_width=32)
+        port = LiteDRAMNativePort("both", address_width=30, data_width=128)
+        self.wishbone_readback_test(data["pattern"], data["expected"], wb, port, prefetch_depth=4)
+
+    def test_wishbone_prefetch_sequential_reads(self):
+        # Verify that sequential reads are served from the prefetched words and that writes
+        # invalidate them.
+        latency = 8
+        nreads  = 16
+
+        class DUT(Module):
+            def __init__(self, prefetch_depth):
+                self.port = LiteDRAMNativePort("both", address_width=30, data_width=32)
+                self.wb   = wishbone.Interface(adr_width=30, data_width=32)
+                self.submodules.wb2native = LiteDRAMWishbone2Native(
+                    wishbone       = self.wb,
+                    port           = self.port,
+                    prefetch_depth = prefetch_depth)
+                self.read_cmds = 0
+
+        @passive
+        def cmd_monitor(dut):
+            while True:
+                yield
+                if (yield dut.port.cmd.valid) and not (yield dut.port.cmd.we):
+                    dut.read_cmds += 1
+
+        def run(prefetch_depth):
+            dut    = DUT(prefetch_depth)
+            cycle  = [0]
+            result = {}
+
+            @passive
+            def cycle_counter():
+                while True:
+                    yield
+                    cycle[0] += 1
+
+            def main_generator(dut):
+                start  = cycle[0]
+                data_r = []
+                for adr in range(nreads):
+                    data_r.append((yield from dut.wb.read(adr)))
+                result["cycles"] = cycle[0] - start
+                # Write to a prefetched word then read it.
+                yield from dut.wb.write(nreads + 1, 0x5a5a5a5a)
+                for adr in range(nreads, nreads + 4):
+                    data_r.append((yield from dut.wb.read(adr)))
+                # Random reads.
+                for adr in [0x100, 0x80, 0x40]:
+                    data_r.append((yield from dut.wb.read(adr)))
+                result["data"] = data_r
+
+            run_simulation(dut, [
+                main_generator(dut),
+                self.native_latency_handler(dut.port, latency),
+                cmd_monitor(dut),
+                cycle_counter(),
+                timeout_generator(2000),
+            ])
+            result["read_cmds"] = dut.read_cmds
+            return result
+
+        expected = list(range(nreads + 4)) + [0x100, 0x80, 0x40]
+        expected[nreads + 1] = 0x5a5a5a5a
+        classic  = run(prefetch_depth=0)
+        prefetch = run(prefetch_depth=4)
+        self.assertEqual(classic["data"],  expected)
+        self.assertEqual(prefetch["data"], expected)
+        self.assertLess(2*prefetch["cycles"], classic["cycles"])
+        # At most the prefetch depth read ahead at the end of each sequence.
+        self.assertLessEqual(prefetch["read_cmds"], classic["read_cmds"] + 3*4)
+
+    def test_wishbone_prefetch_invalidate(self):
+        # Verify that words read ahead are dropped on invalidate (writes of another master).
+        class DUT(Module):
+            def __init__(self):
+                self.port = LiteDRAMNativePort("both", address_width=30, data_width=32)
+                self.wb   = wishbone.Interface(adr_width=30, data_width=32)
+                self.submodules.wb2native = LiteDRAMWishbone2Native(
+                    wishbone       = self.wb,
+                    port           = self.port,
+                    prefetch_depth = 4)
+
+        mem    = {}
+        data_r = []
+
+        def main_generator(dut):
+            for adr in range(4):
+                data_r.append((yield from dut.wb.read(adr)))
+            for _ in range(32):
+                yield
+            # Words 4-7 are read ahead, another master writes word 5.
+            mem[5] = 0x5a5a5a5a
+            yield dut.wb2native.prefetcher.invalidate.eq(1)
+            yield
+            yield dut.wb2native.prefetcher.invalidate.eq(0)
+            for adr in range(4, 8):
+                data_r.append((yield from dut.wb.read(adr)))
+
+        dut = DUT()
+        run_simulation(dut, [
+            main_generator(dut),
+            self.native_latency_handler(dut.port, 8, mem),
+            timeout_generator(1000),
+        ])
+        self.assertEqual(data_r, [0, 1, 2, 3, 4, 0x5a5a5a5a, 6, 7])